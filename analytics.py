@@ -0,0 +1,245 @@
+"""
+Analítica del embudo de leads sobre tablas de agregados diarios.
+
+Los tableros leen analytics_*_daily en lugar de escanear conversations y
+failed_validations. El refresco es incremental: cada fuente guarda un
+high-water mark (updated_at / timestamp) y solo se recalculan los días que
+tocaron las filas nuevas o modificadas desde entonces.
+
+Usa su propia conexión (ANALYTICS_DATABASE_URL o DATABASE_URL), fuera del
+pool de NeonDB: corre como proceso aparte (cron o loop) y consume una de las
+conexiones reservadas (NEON_RESERVED_CONNECTIONS), nunca una del webhook.
+
+    python analytics.py refresh           # un refresco incremental
+    python analytics.py loop [segundos]   # refresca cada N segundos (300)
+    python analytics.py report [días]     # embudo de los últimos N días (30)
+"""
+import os
+import sys
+import time
+import logging
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from flows import QUOTE_FLOW
+
+# Evita dos refrescos a la vez (mismo espacio que MIGRATION_LOCK_ID y SENDER_LOCK_CLASS)
+ANALYTICS_LOCK_ID = 724003
+
+# Los días se cortan en hora de Perú
+TIMEZONE = os.getenv("ANALYTICS_TZ", "America/Lima")
+
+# Solo se procesa lo escrito hace más de LAG segundos: una transacción en curso
+# puede confirmar filas con updated_at/timestamp anterior a su commit
+LAG_SECONDS = float(os.getenv("ANALYTICS_LAG_SECONDS", 60))
+
+# Orden de los pasos del embudo
+FUNNEL_STEPS = [step for step, spec in QUOTE_FLOW.items() if spec]
+
+CHANGED_CONVERSATION_DAYS_SQL = """
+    SELECT ARRAY(
+        SELECT DISTINCT (created_at AT TIME ZONE %(tz)s)::date FROM conversations
+        WHERE updated_at > %(since)s AND updated_at <= %(until)s
+    ), ARRAY(
+        SELECT DISTINCT (completed_at AT TIME ZONE %(tz)s)::date FROM conversations
+        WHERE updated_at > %(since)s AND updated_at <= %(until)s AND completed_at IS NOT NULL
+    )
+"""
+
+CHANGED_VALIDATION_DAYS_SQL = """
+    SELECT ARRAY(
+        SELECT DISTINCT (timestamp AT TIME ZONE %(tz)s)::date FROM failed_validations
+        WHERE timestamp > %(since)s AND timestamp <= %(until)s
+    )
+"""
+
+# Cada día se recalcula completo (idempotente) con un rango por índice.
+# Quien sale con 'salir' queda COMPLETED en FINISHED sin hora de llamada: EXITED
+FUNNEL_SQL = """
+    DELETE FROM analytics_funnel_daily WHERE day = ANY(%(days)s::date[]);
+    INSERT INTO analytics_funnel_daily (day, step, status, conversations)
+    SELECT d.day, c.current_step,
+           CASE WHEN c.status = 'COMPLETED' AND c.preferred_call_time IS NULL THEN 'EXITED' ELSE c.status END,
+           COUNT(*)
+    FROM unnest(%(days)s::date[]) AS d(day)
+    JOIN conversations c
+        ON c.created_at >= d.day::timestamp AT TIME ZONE %(tz)s
+        AND c.created_at < (d.day + 1)::timestamp AT TIME ZONE %(tz)s
+    GROUP BY 1, 2, 3;
+"""
+
+COMPLETIONS_SQL = """
+    DELETE FROM analytics_completions_daily WHERE day = ANY(%(days)s::date[]);
+    INSERT INTO analytics_completions_daily (day, category, model, location, completions, leads)
+    SELECT d.day, COALESCE(c.category, ''), COALESCE(c.model, ''), COALESCE(c.location, ''),
+           COUNT(*), COUNT(c.preferred_call_time)
+    FROM unnest(%(days)s::date[]) AS d(day)
+    JOIN conversations c
+        ON c.completed_at >= d.day::timestamp AT TIME ZONE %(tz)s
+        AND c.completed_at < (d.day + 1)::timestamp AT TIME ZONE %(tz)s
+    WHERE c.status = 'COMPLETED'
+    GROUP BY 1, 2, 3, 4;
+"""
+
+VALIDATION_SQL = """
+    DELETE FROM analytics_validation_daily WHERE day = ANY(%(days)s::date[]);
+    INSERT INTO analytics_validation_daily (day, step, failures, conversations, retries, max_retry)
+    SELECT d.day, f.step, COUNT(*), COUNT(DISTINCT f.phone_number),
+           COUNT(*) FILTER (WHERE f.retry_count > 1), MAX(f.retry_count)
+    FROM unnest(%(days)s::date[]) AS d(day)
+    JOIN failed_validations f
+        ON f.timestamp >= d.day::timestamp AT TIME ZONE %(tz)s
+        AND f.timestamp < (d.day + 1)::timestamp AT TIME ZONE %(tz)s
+    GROUP BY d.day, f.step;
+"""
+
+
+def connect():
+    """Conexión dedicada, marcada para distinguirla en pg_stat_activity"""
+    conn = psycopg2.connect(
+        os.getenv("ANALYTICS_DATABASE_URL") or os.environ["DATABASE_URL"],
+        application_name="whatsapp-bot-analytics"
+    )
+    with conn.cursor() as cursor:
+        cursor.execute("SET statement_timeout = %s", (int(os.getenv("ANALYTICS_STATEMENT_TIMEOUT_MS", 120000)),))
+    conn.commit()
+    return conn
+
+
+def _high_water(cursor, source):
+    cursor.execute("SELECT high_water FROM analytics_state WHERE source = %s", (source,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _set_high_water(cursor, source, value):
+    cursor.execute("""
+        INSERT INTO analytics_state (source, high_water) VALUES (%s, %s)
+        ON CONFLICT (source) DO UPDATE SET high_water = EXCLUDED.high_water, refreshed_at = NOW()
+    """, (source, value))
+
+
+def refresh(conn):
+    """
+    Refresco incremental de los agregados, en una sola transacción.
+    Returns: {tabla: días recalculados}, o None si otro proceso está refrescando
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (ANALYTICS_LOCK_ID,))
+            if not cursor.fetchone()[0]:
+                conn.rollback()
+                return None
+
+            cursor.execute("SELECT NOW() - make_interval(secs => %s)", (LAG_SECONDS,))
+            until = cursor.fetchone()[0]
+            params = {"tz": TIMEZONE, "until": until}
+
+            since = _high_water(cursor, "conversations") or "-infinity"
+            cursor.execute(CHANGED_CONVERSATION_DAYS_SQL, dict(params, since=since))
+            funnel_days, completion_days = cursor.fetchone()
+            if funnel_days:
+                cursor.execute(FUNNEL_SQL, dict(params, days=funnel_days))
+            if completion_days:
+                cursor.execute(COMPLETIONS_SQL, dict(params, days=completion_days))
+            _set_high_water(cursor, "conversations", until)
+
+            since = _high_water(cursor, "failed_validations") or "-infinity"
+            cursor.execute(CHANGED_VALIDATION_DAYS_SQL, dict(params, since=since))
+            validation_days = cursor.fetchone()[0]
+            if validation_days:
+                cursor.execute(VALIDATION_SQL, dict(params, days=validation_days))
+            _set_high_water(cursor, "failed_validations", until)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return {
+        "analytics_funnel_daily": len(funnel_days),
+        "analytics_completions_daily": len(completion_days),
+        "analytics_validation_daily": len(validation_days),
+    }
+
+
+def funnel(conn, days=30):
+    """
+    Embudo de los últimos `days` días, solo desde los agregados.
+    Returns: [{step, reached, waiting, failures, retry_rate}] en orden del flujo.
+    reached: conversaciones que llegaron al paso; waiting: siguen ahí (abandono).
+    Las derivadas a la asesora o que salieron no tienen paso conocido y no suman
+    """
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                SELECT step, status, SUM(conversations) AS conversations
+                FROM analytics_funnel_daily
+                WHERE day > CURRENT_DATE - %s
+                GROUP BY step, status
+            """, (days,))
+            by_step = {}
+            waiting = {}
+            for row in cursor.fetchall():
+                if row["status"] not in ("IN_PROGRESS", "COMPLETED"):
+                    continue
+                by_step[row["step"]] = by_step.get(row["step"], 0) + row["conversations"]
+                if row["status"] == "IN_PROGRESS":
+                    waiting[row["step"]] = row["conversations"]
+
+            cursor.execute("""
+                SELECT step, SUM(failures) AS failures, SUM(conversations) AS conversations
+                FROM analytics_validation_daily
+                WHERE day > CURRENT_DATE - %s
+                GROUP BY step
+            """, (days,))
+            failures = {row["step"]: row for row in cursor.fetchall()}
+    finally:
+        conn.rollback()
+
+    report = []
+    for i, step in enumerate(FUNNEL_STEPS):
+        reached = sum(by_step.get(later, 0) for later in FUNNEL_STEPS[i:])
+        failed = failures.get(step)
+        report.append({
+            "step": step,
+            "reached": reached,
+            "waiting": waiting.get(step, 0),
+            "failures": failed["failures"] if failed else 0,
+            "retry_rate": round(failed["conversations"] / reached, 4) if failed and reached else 0.0,
+        })
+    return report
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else "refresh"
+    conn = connect()
+    try:
+        if command == "refresh":
+            print(f"Días recalculados: {refresh(conn)}")
+        elif command == "loop":
+            interval = float(argv[2]) if len(argv) > 2 else 300
+            while True:
+                try:
+                    logging.info(f"Refresco de analítica: {refresh(conn)}")
+                except psycopg2.Error as e:
+                    logging.error(f"❌ Error refrescando analítica: {e}")
+                    if conn.closed:
+                        conn = connect()
+                time.sleep(interval)
+        elif command == "report":
+            days = int(argv[2]) if len(argv) > 2 else 30
+            print(f"{'paso':<20} {'llegaron':>9} {'esperando':>10} {'errores':>8} {'% reintento':>12}")
+            for row in funnel(conn, days):
+                print(f"{row['step']:<20} {row['reached']:>9} {row['waiting']:>10} "
+                      f"{row['failures']:>8} {row['retry_rate'] * 100:>11.1f}%")
+        else:
+            print(__doc__)
+            return 2
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv))
@@ -1,15 +1,23 @@
-from flask import Flask, request
+from flask import Flask, Response, request, jsonify
 import os
 import util
 import whatsappservices
 import logging
-from datetime import datetime
-import pytz
-import time
+import history
+import lead_export
+import metrics
 
 # Importar nuevos módulos
 from neon_db import db
-from conversation_intelligence import intelligence, response_builder
+from conversation_intelligence import response_builder
+import conversation_flow
+from conversation_queue import ConversationQueue
+from delayed_sender import DelayScheduler
+from outbound import OutboundDispatcher, ReplyPlan
+from outbox_worker import OutboxWorker
+from idempotency import SeenMessages
+from webhook_events import group_by_sender, submit_by_sender
+from db_pool import app_processes
 
 app = Flask(__name__)
 logging.basicConfig(
@@ -33,253 +41,254 @@ def Verifytoken():
     except Exception as e:
         return str(e), 500
 
-@app.route('/whatsapp', methods=['POST'])
-def RecivedMessage():
-    try:
-        body = request.get_json()
-        entry = body["entry"][0]
-        changes = entry["changes"][0]
-        value = changes["value"]
-        
-        if "messages" in value:
-            message = value["messages"][0]
-            number = message["from"]
-            text_user = util.GetTextUser(message)
-            
-            # Log mensaje entrante
-            db.log_message(number, 'incoming', text_user, 
-                          content_type=message.get('type', 'text'))
-            
-            # Procesar conversación
-            process_conversation(text_user, number)
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Métricas en formato de texto de Prometheus (incluye /stats como gauges)"""
+    return Response(metrics.registry.expose(), mimetype=metrics.CONTENT_TYPE)
 
-        return "EVENT_RECEIVED", 200
-    except Exception as e:
-        logging.error(f"Error en webhook: {e}")
-        return "EVENT_RECEIVED", 200
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(collect_stats())
 
-def get_time_greeting():
-    """Obtiene saludo según hora en Perú"""
-    tz_peru = pytz.timezone('America/Lima')
-    hora_actual = datetime.now(tz_peru).hour
-    
-    if 5 <= hora_actual < 12:
-        return "Buenos días"
-    elif 12 <= hora_actual < 18:
-        return "Buenas tardes"
-    else:
-        return "Buenas noches"
+def collect_stats():
+    return {
+        "queue": conversation_queue.stats(),
+        "outbound": outbound.stats(),
+        "outbox": outbox_worker.stats() if OUTBOX_ENABLED else None,
+        "whatsapp_api": whatsappservices.get_client().stats(),
+        "conversation_cache": db.conversation_cache.stats(),
+        "db_pool": db.pool_stats(),
+        "seen_messages": seen_messages.stats(),
+        "retry_counter": db.retry_counter.stats(),
+        "message_log_pending": db.message_writer.pending()
+    }
 
-def send_with_delay(data, number):
-    """Envía mensaje con delay humanizado"""
-    time.sleep(response_builder.typing_delay())
-    result = whatsappservices.SendMessageWhatsapp(data)
-    
-    # Log mensaje saliente
-    if result:
-        content = data.get('text', {}).get('body', '') or str(data.get('interactive', ''))
-        db.log_message(number, 'outgoing', content, 
-                      content_type=data.get('type', 'text'))
-    
-    return result
+def streaming_allowed():
+    """
+    Las descargas en streaming ocupan el hilo que las sirve durante toda la
+    transferencia: solo se aceptan en un servidor con varios hilos (gunicorn
+    gthread, ver gunicorn.conf.py), nunca en un worker sync que además
+    atiende el webhook.
+    """
+    return bool(request.environ.get("wsgi.multithread"))
 
-def process_conversation(text, number):
-    """Máquina de estados principal con validaciones"""
-    
-    # Obtener o crear conversación
-    conversation = db.get_or_create_conversation(number)
-    step = conversation.get("current_step")
-    
-    # ====== DETECCIÓN DE INTENCIONES GLOBALES ======
-    intent = intelligence.detect_intent(text)
-    
-    if intent == 'ubicacion':
-        msg = "📍 Nuestra sede está en:\n\n*ISUZU CAMIONES AUTOMOTRIZ CISNE*"
-        data = util.TextMessage(msg, number)
-        send_with_delay(data, number)
-        
-        # Enviar ubicación
-        location_data = util.LocationMessage(number)
-        send_with_delay(location_data, number)
-        
-        msg_continue = "¿Deseas continuar con la cotización? Responde *SI* para continuar."
-        data = util.TextMessage(msg_continue, number)
-        send_with_delay(data, number)
-        return
-    
-    elif intent == 'hablar_humano':
-        db.handoff_to_human(number, "Cliente solicitó atención humana")
-        
-        msg = "🙋‍♀️ Entendido. En un momento la asesora *Gabriela Paucar* se comunicará contigo personalmente.\n\n📞 También puedes llamarnos directamente al *01-XXX-XXXX*"
-        data = util.TextMessage(msg, number)
-        send_with_delay(data, number)
-        
-        # TODO: Notificación Telegram deshabilitada por ahora
-        logging.info(f"HANDOFF solicitado por {number}")
-        return
-    
-    elif intent == 'salir':
-        db.complete_conversation(number)
-        msg = "Entendido. Si cambias de opinión, escríbenos cuando quieras. ¡Hasta pronto! 👋"
-        data = util.TextMessage(msg, number)
-        send_with_delay(data, number)
-        return
+@app.route('/advisor/history/<number>', methods=['GET'])
+def conversation_history(number):
+    """
+    Historial de un número para la asesora (Authorization: Bearer ADVISOR_TOKEN).
+    ?limit=N&before=<cursor>: una página JSON con el cursor de la siguiente.
+    ?stream=1: todo el historial desde `before` en NDJSON, sin cargarlo en memoria.
+    """
+    if not history.advisor_authorized(request.headers.get("Authorization")):
+        return "UNAUTHORIZED", 401
+    try:
+        before = history.decode_cursor(request.args.get("before"))
+        limit = history.page_size(request.args.get("limit"))
+    except ValueError:
+        return "INVALID_PARAMS", 400
     
-    # ====== FLUJO CONVERSACIONAL ======
+    if request.args.get("stream") == "1":
+        if not streaming_allowed():
+            return "STREAMING_REQUIRES_THREADED_WORKER", 503
+        rows = db.iter_conversation_history(number, before, page_size=history.MAX_PAGE_SIZE)
+        return Response(history.ndjson(rows), mimetype="application/x-ndjson")
     
-    # --- PASO 0: SALUDO INICIAL ---
-    if step == "START":
-        msg = "👋 Te saluda el *Asistente Virtual* de *Gabriela Paucar* - 👩🏻‍💼 Asesora Comercial de ISUZU CAMIONES AUTOMOTRIZ CISNE.\n📍 SEDE LIMA.\n\nPara atenderte mejor, por favor indícame: *¿Cuál es tu nombre y apellido?*"
-        data = util.TextMessage(msg, number)
-        send_with_delay(data, number)
-        
-        db.update_conversation_step(number, "WAITING_NAME")
+    page = db.get_conversation_history(number, limit, before)
+    return jsonify({
+        "messages": [history.serialize(row) for row in page],
+        "next": history.encode_cursor(page[-1]) if len(page) == limit else None
+    })
+
+@app.route('/advisor/leads', methods=['GET'])
+def export_leads():
+    """
+    Leads COMPLETED y HUMAN_HANDOFF en CSV, en streaming (mismo token que el historial).
+    ?since=AAAA-MM-DD&until=AAAA-MM-DD&after_updated_at=<ISO>&after_id=N (updated_at e id
+    de la última fila ya recibida, para pedir solo lo nuevo o modificado)
+    """
+    if not history.advisor_authorized(request.headers.get("Authorization")):
+        return "UNAUTHORIZED", 401
+    try:
+        since, until, after = lead_export.parse_range(request.args)
+    except ValueError:
+        return "INVALID_PARAMS", 400
+    if not streaming_allowed():
+        # Exportar con `python lead_export.py` o servir la app con gthread
+        return "STREAMING_REQUIRES_THREADED_WORKER", 503
     
-    # --- PASO 1: CAPTURAR NOMBRE ---
-    elif step == "WAITING_NAME":
-        # Extraer nombre limpio
-        name = intelligence.extract_name(text)
-        
-        if len(name.split()) < 2:
-            # Nombre muy corto, validación fallida
-            retry_count = db.log_failed_validation(number, step, text, "Nombre y Apellido")
-            error_msg = response_builder.format_error_retry(step, retry_count)
-            data = util.TextMessage(error_msg, number)
-            send_with_delay(data, number)
-            return
+    # Conexión propia (cursor con nombre abierto durante toda la descarga), no del pool
+    conn = lead_export.connect()
+    response = Response(lead_export.csv_chunks(lead_export.iter_batches(conn, since, until, after)),
+                        mimetype="text/csv",
+                        headers={"Content-Disposition": "attachment; filename=leads.csv"})
+    response.call_on_close(conn.close)
+    return response
+
+@app.route('/whatsapp', methods=['POST'])
+def RecivedMessage():
+    """
+    Solo valida y encola: la máquina de estados corre en los workers
+    de conversation_queue para responder a Meta en milisegundos.
+    Se procesan todos los mensajes y estados del lote, no solo el primero.
+    """
+    with metrics.webhook_seconds.time():
+        return handle_webhook(request.get_json(silent=True))
+
+def handle_webhook(body):
+    try:
+        if not isinstance(body, dict) or not body.get("entry"):
+            return "INVALID_PAYLOAD", 400
         
-        # Nombre válido
-        db.update_conversation_step(number, "WAITING_DNI_LOC", name=name)
+        # Los reenvíos de Meta (IDs ya vistos) se descartan aquí mismo
+        messages_by_sender, statuses, invalid = group_by_sender(body, is_new=seen_messages.add)
+        if invalid:
+            logging.warning(f"Webhook con {invalid} eventos inválidos ignorados")
         
-        saludo = get_time_greeting()
-        msg = f"{saludo} estimado *{name}*. Un gusto saludarte.\n\nPara continuar, por favor bríndame tu *DNI o RUC* y desde qué *Departamento/Provincia* nos escribes.\n\n_Ejemplo: 10283749, Huancayo_"
+        if statuses:
+            db.update_message_statuses(statuses)
         
-        data = util.TextMessage(msg, number)
-        send_with_delay(data, number)
-    
-    # --- PASO 2: CAPTURAR DNI Y UBICACIÓN ---
-    elif step == "WAITING_DNI_LOC":
-        # Extraer DNI y ubicación
-        extracted = intelligence.extract_dni_location(text)
+        if not submit_by_sender(messages_by_sender, conversation_queue.submit_batch, seen_messages.discard):
+            # Worker apagándose: que Meta reintente en otro
+            return "SHUTTING_DOWN", 503
+
+        return "EVENT_RECEIVED", 200
+    except Exception as e:
+        logging.error(f"Error en webhook: {e}")
+        return "EVENT_RECEIVED", 200
+
+def handle_incoming_message(number, message):
+    """
+    Procesa un turno encolado (corre en un worker de la cola).
+    Un turno puede ser un mensaje o varios fusionados por coalesce_messages.
+    """
+    with db.sender_lock(number):
+        originals = []
+        for original in message.get("_merged", [message]):
+            message_id = original.get("id")
+            if message_id and not db.claim_message(message_id, number):
+                logging.info(f"Mensaje duplicado ignorado: {message_id}")
+                continue
+            originals.append(original)
         
-        if not extracted['dni'] or not extracted['location']:
-            retry_count = db.log_failed_validation(number, step, text, "DNI/RUC + Ciudad")
-            error_msg = response_builder.format_error_retry(step, retry_count)
-            data = util.TextMessage(error_msg, number)
-            send_with_delay(data, number)
+        if not originals:
             return
         
-        # Datos válidos
-        db.update_conversation_step(
-            number, 
-            "WAITING_CATEGORY",
-            dni_ruc=extracted['dni'],
-            location=extracted['location']
-        )
-        
-        # Enviar botones de categoría
-        buttons = ["Camión Isuzu", "Camionetas"]
-        msg_body = "🚘 *Tipo de unidad*\n\n¿En qué tipo de unidad estás interesado?"
-        
-        data = util.ButtonsMessage(number, msg_body, buttons)
-        send_with_delay(data, number)
-    
-    # --- PASO 3: ELEGIR CATEGORÍA ---
-    elif step == "WAITING_CATEGORY":
-        # Validar categoría
-        category = intelligence.validate_category(text)
-        
-        if not category:
-            retry_count = db.log_failed_validation(number, step, text, "Camión o Camioneta")
-            error_msg = response_builder.format_error_retry(step, retry_count)
+        conversation = db.get_or_create_conversation(number)
+        texts = []
+        for original in originals:
+            text = util.GetTextUser(original)
+            texts.append(text)
             
-            # Reenviar botones
-            buttons = ["Camión Isuzu", "Camionetas"]
-            msg_body = f"{error_msg}\n\n🚘 *Tipo de unidad*\n\n¿En qué tipo de unidad estás interesado?"
-            data = util.ButtonsMessage(number, msg_body, buttons)
-            send_with_delay(data, number)
-            return
-        
-        # Categoría válida
-        db.update_conversation_step(number, "WAITING_MODEL", category=category)
+            # Log mensaje entrante (cada mensaje original por separado)
+            db.log_message(number, 'incoming', text, 
+                          content_type=original.get('type', 'text'),
+                          conversation_id=conversation.get("id"),
+                          wa_message_id=original.get("id"))
         
-        # Preparar lista de modelos
-        options = []
-        msg_body = ""
-        header_list = "Modelos Disponibles"
+        # Procesar conversación
+        process_conversation(" ".join(texts), number, conversation)
 
-        if "Camión" in category:
-            options = [
-                {"id": "mod_1", "title": "FVR 10ton", "description": "Ideal para carga pesada"},
-                {"id": "mod_2", "title": "NLR 3TON", "description": "Urbano y versátil"},
-                {"id": "mod_3", "title": "NPS 4x4", "description": "Todo terreno"}
-            ]
-            msg_body = "Excelente elección. Isuzu es líder en camiones. ¿Qué modelo buscas?"
-            
-        else:  # Camionetas
-            options = [
-                {"id": "mod_4", "title": "Chevrolet Captiva", "description": "SUV Familiar"},
-                {"id": "mod_5", "title": "Subaru XL", "description": "Aventura y confort"}
-            ]
-            msg_body = "¿Qué camioneta se ajusta a tus necesidades?"
+def should_debounce(number):
+    """Esperar más mensajes solo si la conversación está en un paso fusionable"""
+    return conversation_flow.should_debounce(db.conversation_cache.peek(number))
 
-        data = util.ListMessage(number, header_list, msg_body, options, "Ver Modelos")
-        send_with_delay(data, number)
-    
-    # --- PASO 4: ELEGIR MODELO ---
-    elif step == "WAITING_MODEL":
-        # Guardar modelo seleccionado
-        db.update_conversation_step(number, "WAITING_COLOR", model=text)
-        
-        buttons = ["Blanco", "Rojo", "Azul"]
-        msg = f"Perfecto, el *{text}* es una gran máquina.\n¿Tienes algún color de preferencia?"
-        
-        data = util.ButtonsMessage(number, msg, buttons)
-        send_with_delay(data, number)
-    
-    # --- PASO 5: ELEGIR COLOR ---
-    elif step == "WAITING_COLOR":
-        # Validar color
-        color = intelligence.validate_color(text)
-        
-        if not color:
-            color = text.capitalize()  # Aceptar cualquier texto como color
-        
-        db.update_conversation_step(number, "WAITING_CALL_TIME", color=color)
-        
-        conv = db.get_or_create_conversation(number)
-        nombre = conv.get("name", "")
-        modelo = conv.get("model", "")
-        
-        msg = f"Gracias *{nombre}*. Tengo registrado tu interés en un *{modelo}* color {color}.\n\n📞 *¿A qué hora prefieres que la asesora Gabriela te llame?*\n\n_Ejemplo: Mañana 10am, Hoy 3pm, etc._"
-        
-        data = util.TextMessage(msg, number)
-        send_with_delay(data, number)
+def coalesce_messages(number, messages):
+    """Fusiona mensajes partidos según el paso actual (ver conversation_flow)"""
+    return conversation_flow.coalesce_messages(db.conversation_cache.peek(number), messages)
+
+def log_outgoing(number, conversation_id, data, result):
+    """Registra el mensaje ya enviado (con su ID para seguir los estados de entrega)"""
+    content_type, content = util.GetPayloadContent(data)
+    sent = result.get('messages') or [{}]
+    db.log_message(number, 'outgoing', content, 
+                  content_type=content_type,
+                  conversation_id=conversation_id,
+                  wa_message_id=sent[0].get('id'))
+
+def send_throttled(data):
+    """Envío del outbox respetando el mismo límite de throughput"""
+    outbound.bucket.acquire()
+    return whatsappservices.SendMessageWhatsapp(data)
+
+def process_conversation(text, number, conversation=None):
+    """
+    Ejecuta un turno de la máquina de estados y despacha la respuesta
+    completa como un solo plan (en orden, con delay humanizado).
+    """
+    # Obtener o crear conversación
+    if conversation is None:
+        conversation = db.get_or_create_conversation(number)
     
-    # --- PASO 6: AGENDAR LLAMADA ---
-    elif step == "WAITING_CALL_TIME":
-        db.update_conversation_step(number, "FINISHED", preferred_call_time=text)
-        
-        # Marcar como completada
-        db.complete_conversation(number)
-        
-        msg = "✅ ¡Perfecto! La asesora *Gabriela Paucar* se comunicará contigo en el horario indicado.\n\n🙏 Muchas gracias por contactar a *Isuzu Automotriz Cisne*.\n\n_Si necesitas algo más, escríbeme cuando quieras._"
-        data = util.TextMessage(msg, number)
-        send_with_delay(data, number)
-        
-        # Log de lead completado
-        logging.info(f"✅ Lead completado: {number}")
+    reply = ReplyPlan(number, conversation.get("id"))
+    conversation_flow.run_state_machine(text, number, conversation, reply, db.log_failed_validation)
+    commit_turn(reply)
+
+def commit_turn(reply):
+    """
+    Guarda la transición del turno y despacha su respuesta.
+    Con OUTBOX_ENABLED ambas se confirman en la misma transacción y el
+    OutboxWorker entrega los mensajes (con reintentos si la API falla).
+    """
+    if OUTBOX_ENABLED:
+        messages = [(data, response_builder.typing_delay()) for data in reply.messages]
+        for _, delay in messages:
+            metrics.typing_delay_seconds.observe(delay)
+        if reply.next_step:
+            db.update_conversation_step(reply.number, reply.next_step, outbox=messages, **reply.fields)
+        elif messages:
+            db.enqueue_outbox(reply.number, reply.conversation_id, messages)
+        outbox_worker.wake()
+        return
     
-    # --- CONVERSACIÓN TERMINADA ---
-    elif step == "FINISHED":
-        msg = "Tu solicitud ya fue registrada. La asesora Gabriela se comunicará contigo pronto.\n\n¿Deseas hacer *otra cotización*? Responde *SI* para comenzar de nuevo."
-        data = util.TextMessage(msg, number)
-        send_with_delay(data, number)
-        
-        # Si dice "si", reiniciar conversación
-        if text.lower() in ['si', 'sí', 'yes', 'ok']:
-            db.update_conversation_step(number, "START")
-            process_conversation("", number)  # Trigger START
+    if reply.next_step:
+        db.update_conversation_step(reply.number, reply.next_step, **reply.fields)
+    outbound.submit(reply)
+
+# Outbox durable: respuestas confirmadas junto con la transición de paso.
+# Activo por defecto: sin él un envío fallido se pierde (OUTBOX_ENABLED=0 lo apaga)
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "1") == "1"
+
+# IDs de mensajes ya recibidos (filtro rápido de reenvíos)
+seen_messages = SeenMessages(max_entries=int(os.getenv("SEEN_MESSAGES_MAX", 50000)))
+
+# Envíos con delay humanizado (sin dormir hilos)
+delayed_sender = DelayScheduler(dispatch_threads=int(os.getenv("SEND_THREADS", 4)))
+
+# Servicio de envío: planes de respuesta + límite de throughput de la Graph API.
+# WHATSAPP_MAX_MPS es el límite del número de WhatsApp Business: cada proceso
+# (workers × nodos) se queda con su parte
+outbound = OutboundDispatcher(
+    delayed_sender,
+    send=whatsappservices.SendMessageWhatsapp,
+    typing_delay=response_builder.typing_delay,
+    on_sent=log_outgoing,
+    rate=float(os.getenv("WHATSAPP_MAX_MPS", 80)) / app_processes()
+)
+
+outbox_worker = OutboxWorker(
+    db,
+    send=send_throttled,
+    on_sent=log_outgoing,
+    batch_size=int(os.getenv("OUTBOX_BATCH_SIZE", 20)),
+    poll_interval=float(os.getenv("OUTBOX_POLL_SECONDS", 300)),
+    max_attempts=int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5)),
+    concurrency=int(os.getenv("SEND_THREADS", 4)),
+    retention_seconds=float(os.getenv("OUTBOX_RETENTION_DAYS", 7)) * 86400
+)
+if OUTBOX_ENABLED:
+    outbox_worker.start()
+
+# Workers en segundo plano (orden garantizado por remitente)
+conversation_queue = ConversationQueue(
+    handle_incoming_message,
+    workers=int(os.getenv("QUEUE_WORKERS", 4)),
+    debounce=float(os.getenv("MESSAGE_DEBOUNCE_SECONDS", 1.5)),
+    max_debounce=float(os.getenv("MESSAGE_DEBOUNCE_MAX_SECONDS", 4)),
+    should_debounce=should_debounce,
+    coalesce=coalesce_messages
+)
+
+metrics.registry.add_collector("bot", collect_stats)
 
 if __name__ == '__main__':
     port = int(os.getenv("PORT", 8080))
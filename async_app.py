@@ -0,0 +1,272 @@
+"""
+Modo async del bot (APP_MODE=async): mismo flujo que app.py sobre un solo
+event loop, con aiohttp para el webhook y la Graph API, asyncpg para Neon y
+asyncio.sleep para los delays humanizados.
+
+    gunicorn -c gunicorn.conf.py          # con APP_MODE=async
+    python async_app.py                   # desarrollo local
+"""
+import asyncio
+import os
+import logging
+import time
+from aiohttp import web
+
+import history
+import lead_export
+import metrics
+import util
+import conversation_flow
+from async_db import AsyncNeonDB
+from async_whatsapp import AsyncWhatsAppClient
+from conversation_intelligence import response_builder
+from conversation_queue import AsyncConversationQueue
+from outbound import AsyncOutboundDispatcher, ReplyPlan
+from idempotency import SeenMessages
+from webhook_events import group_by_sender, submit_by_sender
+from db_pool import app_processes
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+
+class Bot:
+    """Servicios del modo async; se crean al arrancar el event loop"""
+
+    def __init__(self):
+        self.db = AsyncNeonDB(
+            flush_size=int(os.getenv("MESSAGE_LOG_BATCH_SIZE", 100)),
+            flush_interval=float(os.getenv("MESSAGE_LOG_FLUSH_SECONDS", 1.0)),
+            processed_retention=float(os.getenv("PROCESSED_MESSAGES_RETENTION_DAYS", 7)) * 86400
+        )
+        self.whatsapp = AsyncWhatsAppClient.from_env()
+        self.seen_messages = SeenMessages(max_entries=int(os.getenv("SEEN_MESSAGES_MAX", 50000)))
+        self.outbound = AsyncOutboundDispatcher(
+            send=self.send,
+            typing_delay=response_builder.typing_delay,
+            on_sent=self.log_outgoing,
+            rate=float(os.getenv("WHATSAPP_MAX_MPS", 80))
+        )
+        self.queue = AsyncConversationQueue(
+            self.handle_incoming_message,
+            concurrency=int(os.getenv("ASYNC_CONCURRENCY", 100)),
+            debounce=float(os.getenv("MESSAGE_DEBOUNCE_SECONDS", 1.5)),
+            max_debounce=float(os.getenv("MESSAGE_DEBOUNCE_MAX_SECONDS", 4)),
+            should_debounce=self.should_debounce,
+            coalesce=self.coalesce_messages
+        )
+
+    async def send(self, data):
+        started = time.perf_counter()
+        result = await self.whatsapp.send(data)
+        metrics.whatsapp_seconds.observe(time.perf_counter() - started, "ok" if result is not None else "error")
+        return result
+
+    def should_debounce(self, number):
+        return conversation_flow.should_debounce(self.db.conversation_cache.peek(number))
+
+    def coalesce_messages(self, number, messages):
+        return conversation_flow.coalesce_messages(self.db.conversation_cache.peek(number), messages)
+
+    async def handle_incoming_message(self, number, message):
+        """Equivalente async de app.handle_incoming_message + process_conversation"""
+        async with self.db.sender_lock(number):
+            originals = []
+            for original in message.get("_merged", [message]):
+                message_id = original.get("id")
+                if message_id and not await self.db.claim_message(message_id, number):
+                    logging.info(f"Mensaje duplicado ignorado: {message_id}")
+                    continue
+                originals.append(original)
+
+            if not originals:
+                return
+
+            conversation = await self.db.get_or_create_conversation(number)
+            texts = []
+            for original in originals:
+                text = util.GetTextUser(original)
+                texts.append(text)
+                self.db.log_message(number, 'incoming', text,
+                                    content_type=original.get('type', 'text'),
+                                    conversation_id=conversation.get("id"),
+                                    wa_message_id=original.get("id"))
+
+            reply = ReplyPlan(number, conversation.get("id"))
+            conversation_flow.run_state_machine(" ".join(texts), number, conversation, reply,
+                                                self.db.log_failed_validation)
+
+            if reply.next_step:
+                await self.db.update_conversation_step(number, reply.next_step, **reply.fields)
+            self.outbound.submit(reply)
+
+    def log_outgoing(self, number, conversation_id, data, result):
+        content_type, content = util.GetPayloadContent(data)
+        sent = result.get('messages') or [{}]
+        self.db.log_message(number, 'outgoing', content,
+                            content_type=content_type,
+                            conversation_id=conversation_id,
+                            wa_message_id=sent[0].get('id'))
+
+    def stats(self):
+        return {
+            "mode": "async",
+            "queue": self.queue.stats(),
+            "outbound": self.outbound.stats(),
+            "whatsapp_api": self.whatsapp.stats(),
+            "conversation_cache": self.db.conversation_cache.stats(),
+            "db_pool": self.db.pool_stats(),
+            "seen_messages": self.seen_messages.stats(),
+            "retry_counter": self.db.retry_counter.stats(),
+            "message_log_pending": self.db.pending()
+        }
+
+    async def start(self, app):
+        # Sin outbox, el orden de envío por número solo vale dentro de un proceso
+        if app_processes() > 1:
+            raise RuntimeError("El modo async no admite varios workers/nodos; use el modo sync")
+        if os.getenv("OUTBOX_ENABLED", "0") == "1":
+            logging.warning("OUTBOX_ENABLED no aplica en modo async; se envía directo")
+        await self.db.connect()
+
+    async def stop(self, app):
+        # Terminar de procesar los mensajes ya aceptados antes de salir
+        await self.queue.stop(timeout=float(os.getenv("QUEUE_DRAIN_TIMEOUT", 20)))
+        await self.outbound.drain(timeout=5)
+        await self.whatsapp.close()
+        await self.db.close()
+
+
+BOT = web.AppKey("bot", Bot)
+routes = web.RouteTableDef()
+
+
+@routes.get('/welcome')
+async def index(request):
+    return web.Response(text="Bot ISUZU Gabriela Paucar - FASE 1 Activo ✅")
+
+
+@routes.get('/whatsapp')
+async def verify_token(request):
+    access_token = os.getenv("VERIFY_TOKEN")
+    token = request.query.get("hub.verify_token")
+    challenge = request.query.get("hub.challenge")
+    if token is not None and challenge is not None and token == access_token:
+        return web.Response(text=challenge)
+    return web.Response(text="Auth Failed", status=403)
+
+
+@routes.get('/stats')
+async def stats(request):
+    return web.json_response(request.app[BOT].stats())
+
+
+@routes.get('/metrics')
+async def prometheus_metrics(request):
+    return web.Response(body=metrics.registry.expose().encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+@routes.get('/advisor/history/{number}')
+async def conversation_history(request):
+    """Mismo historial para la asesora que app.conversation_history"""
+    if not history.advisor_authorized(request.headers.get("Authorization")):
+        return web.Response(text="UNAUTHORIZED", status=401)
+    try:
+        before = history.decode_cursor(request.query.get("before"))
+        limit = history.page_size(request.query.get("limit"))
+    except ValueError:
+        return web.Response(text="INVALID_PARAMS", status=400)
+
+    db = request.app[BOT].db
+    number = request.match_info["number"]
+    if request.query.get("stream") == "1":
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        async for row in db.iter_conversation_history(number, before, page_size=history.MAX_PAGE_SIZE):
+            await response.write(history.ndjson_line(row))
+        await response.write_eof()
+        return response
+
+    page = await db.get_conversation_history(number, limit, before)
+    return web.json_response({
+        "messages": [history.serialize(row) for row in page],
+        "next": history.encode_cursor(page[-1]) if len(page) == limit else None
+    })
+
+
+@routes.get('/advisor/leads')
+async def export_leads(request):
+    """Mismo CSV que app.export_leads; el cursor psycopg2 avanza en un hilo"""
+    if not history.advisor_authorized(request.headers.get("Authorization")):
+        return web.Response(text="UNAUTHORIZED", status=401)
+    try:
+        since, until, after = lead_export.parse_range(request.query)
+    except ValueError:
+        return web.Response(text="INVALID_PARAMS", status=400)
+
+    conn = await asyncio.to_thread(lead_export.connect)
+    chunks = lead_export.csv_chunks(lead_export.iter_batches(conn, since, until, after))
+    try:
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/csv",
+            "Content-Disposition": "attachment; filename=leads.csv"
+        })
+        await response.prepare(request)
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+    finally:
+        await asyncio.to_thread(chunks.close)
+        await asyncio.to_thread(conn.close)
+
+
+@routes.post('/whatsapp')
+async def received_message(request):
+    """Solo valida y encola, igual que el webhook del modo sync"""
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    with metrics.webhook_seconds.time():
+        return handle_webhook(request.app[BOT], body)
+
+
+def handle_webhook(bot, body):
+    try:
+        if not isinstance(body, dict) or not body.get("entry"):
+            return web.Response(text="INVALID_PAYLOAD", status=400)
+
+        messages_by_sender, statuses, invalid = group_by_sender(body, is_new=bot.seen_messages.add)
+        if invalid:
+            logging.warning(f"Webhook con {invalid} eventos inválidos ignorados")
+
+        if statuses:
+            bot.db.update_message_statuses(statuses)
+
+        if not submit_by_sender(messages_by_sender, bot.queue.submit_batch, bot.seen_messages.discard):
+            # Worker apagándose: que Meta reintente en otro
+            return web.Response(text="SHUTTING_DOWN", status=503)
+
+        return web.Response(text="EVENT_RECEIVED")
+    except Exception as e:
+        logging.error(f"Error en webhook: {e}")
+        return web.Response(text="EVENT_RECEIVED")
+
+
+async def create_app():
+    """Fábrica de la aplicación (aiohttp.GunicornWebWorker acepta corrutinas)"""
+    app = web.Application()
+    bot = Bot()
+    app[BOT] = bot
+    metrics.registry.add_collector("bot", bot.stats)
+    app.add_routes(routes)
+    app.on_startup.append(bot.start)
+    app.on_shutdown.append(bot.stop)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.getenv("PORT", 8080)))
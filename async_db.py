@@ -0,0 +1,353 @@
+import asyncio
+import os
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+
+import asyncpg
+import psycopg2
+
+import metrics
+from batch_writer import STATUS_RANK
+from conversation_cache import ConversationCache
+from db_migrations import apply_migrations
+from db_pool import pool_size_from_env, SENDER_LOCK_CLASS
+from history import COLUMNS as HISTORY_COLUMNS
+from retry_counter import RetryCounter
+
+
+@metrics.instrument_methods(exclude=("sender_lock", "pending", "pool_stats", "iter_conversation_history"))
+class AsyncNeonDB:
+    """
+    Acceso a Neon para el modo async (asyncpg).
+
+    Expone las mismas operaciones que usa el flujo de NeonDB, pero como
+    corrutinas sobre un pool asyncpg. Los mensajes, estados de entrega y
+    errores de validación se acumulan en memoria y una tarea los vuelca en
+    lote (un INSERT/UPDATE con unnest por tabla), igual que MessageLogWriter.
+    La misma tarea purga processed_messages vencidos.
+    """
+
+    PURGE_PROCESSED_SQL = """
+        DELETE FROM processed_messages
+        WHERE wa_message_id IN (
+            SELECT wa_message_id FROM processed_messages
+            WHERE received_at < NOW() - make_interval(secs => $1::float8)
+            LIMIT $2
+        )
+    """
+    PURGE_BATCH = 10000
+
+    MESSAGES_SQL = """
+        INSERT INTO messages
+        (conversation_id, phone_number, message_type, content_type, content, intent, wa_message_id)
+        SELECT
+            COALESCE(v.conversation_id, (
+                SELECT id FROM conversations c WHERE c.phone_number = v.phone_number
+                ORDER BY created_at DESC LIMIT 1
+            )),
+            v.phone_number, v.message_type, v.content_type, v.content, v.intent, v.wa_message_id
+        FROM unnest($1::int[], $2::text[], $3::text[], $4::text[], $5::text[], $6::text[], $7::text[])
+            AS v(conversation_id, phone_number, message_type, content_type, content, intent, wa_message_id)
+    """
+
+    STATUS_SQL = """
+        UPDATE messages m
+        SET delivery_status = v.status,
+            status_updated_at = to_timestamp(v.ts)
+        FROM unnest($1::text[], $2::text[], $3::bigint[]) AS v(wa_message_id, status, ts)
+        WHERE m.wa_message_id = v.wa_message_id
+        AND (m.status_updated_at IS NULL OR m.status_updated_at <= to_timestamp(v.ts))
+    """
+
+    FAILED_VALIDATIONS_SQL = """
+        INSERT INTO failed_validations
+        (phone_number, step, user_input, expected_format, retry_count)
+        SELECT * FROM unnest($1::text[], $2::text[], $3::text[], $4::text[], $5::int[])
+    """
+
+    def __init__(self, dsn=None, flush_size=100, flush_interval=1.0, max_buffer=10000,
+                 processed_retention=7 * 86400, purge_interval=3600.0):
+        self.dsn = dsn or os.getenv("DATABASE_URL")
+        if not self.dsn:
+            raise Exception("❌ La variable DATABASE_URL no está configurada en Railway")
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.processed_retention = processed_retention
+        self.purge_interval = purge_interval
+        self.pool = None
+        self.sender_locks = os.getenv("SENDER_LOCKS", "0") == "1"
+
+        self.conversation_cache = ConversationCache(
+            max_entries=int(os.getenv("CONVERSATION_CACHE_SIZE", 5000)),
+            ttl=float(os.getenv("CONVERSATION_CACHE_TTL", 900))
+        )
+        self.retry_counter = RetryCounter(window=float(os.getenv("RETRY_WINDOW_SECONDS", 300)))
+
+        self._messages = deque()
+        self._statuses = {}        # wa_message_id -> (status, ts)
+        self._failures = deque(maxlen=max_buffer)
+        self._dropped = 0
+        self._flush_wanted = None
+        self._flush_task = None
+
+    async def connect(self):
+        """Crea el pool, aplica migraciones y arranca el volcado en lote"""
+        if os.getenv("RUN_MIGRATIONS", "1") == "1":
+            await asyncio.to_thread(self._apply_migrations)
+
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=1,
+            max_size=pool_size_from_env(),
+            max_inactive_connection_lifetime=float(os.getenv("DB_POOL_MAX_LIFETIME", 1800)),
+            command_timeout=float(os.getenv("DB_STATEMENT_TIMEOUT_MS", 15000)) / 1000,
+            # El endpoint -pooler de Neon (PgBouncer en modo transacción) no
+            # admite sentencias preparadas con nombre entre transacciones
+            statement_cache_size=0 if "-pooler" in self.dsn else 100,
+            server_settings={"statement_timeout": os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000")}
+        )
+        self._flush_wanted = asyncio.Event()
+        self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+        logging.info("✅ Conexión a Neon DB exitosa (asyncpg)")
+
+    def _apply_migrations(self):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            apply_migrations(conn)
+        finally:
+            conn.close()
+
+    def _acquire(self):
+        return self.pool.acquire(timeout=float(os.getenv("DB_POOL_TIMEOUT", 5)))
+
+    @asynccontextmanager
+    async def sender_lock(self, phone_number):
+        """Mismo advisory lock por número que NeonDB.sender_lock"""
+        if not self.sender_locks:
+            yield
+            return
+
+        async with self._acquire() as conn:
+            await conn.execute("SELECT pg_advisory_lock($1, hashtext($2))", SENDER_LOCK_CLASS, phone_number)
+            try:
+                self.conversation_cache.invalidate(phone_number)
+                yield
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1, hashtext($2))", SENDER_LOCK_CLASS, phone_number)
+
+    # ==================== CONVERSACIONES ====================
+
+    async def get_or_create_conversation(self, phone_number):
+        """Mismo upsert atómico que NeonDB.get_or_create_conversation"""
+        cached = self.conversation_cache.get(phone_number)
+        if cached is not None:
+            return cached
+
+        async with self._acquire() as conn:
+            for _ in range(2):
+                row = await conn.fetchrow("""
+                    WITH ins AS (
+                        INSERT INTO conversations (phone_number, current_step, status)
+                        VALUES ($1, 'START', 'IN_PROGRESS')
+                        ON CONFLICT (phone_number) WHERE status != 'COMPLETED' DO NOTHING
+                        RETURNING *
+                    )
+                    SELECT * FROM ins
+                    UNION ALL
+                    SELECT * FROM conversations
+                    WHERE phone_number = $1 AND status != 'COMPLETED'
+                    AND NOT EXISTS (SELECT 1 FROM ins)
+                """, phone_number)
+                if row is not None:
+                    break
+
+        conversation = dict(row)
+        self.conversation_cache.put(phone_number, conversation)
+        return dict(conversation)
+
+    async def update_conversation_step(self, phone_number, step, **kwargs):
+        """Actualiza el paso actual y opcionalmente otros campos"""
+        fields = {key: value for key, value in kwargs.items() if value is not None}
+        assignments = ["current_step = $1"]
+        values = [step]
+        for key, value in fields.items():
+            values.append(value)
+            assignments.append(f"{key} = ${len(values)}")
+        values.append(phone_number)
+
+        async with self._acquire() as conn:
+            await conn.execute(f"""
+                UPDATE conversations
+                SET {', '.join(assignments)}
+                WHERE phone_number = ${len(values)}
+                AND status != 'COMPLETED'
+            """, *values)
+
+        self.conversation_cache.update(phone_number, current_step=step, **fields)
+
+    # ==================== MENSAJES ====================
+
+    def log_message(self, phone_number, message_type, content, content_type='text', intent=None,
+                    conversation_id=None, wa_message_id=None):
+        """Agrega el mensaje al lote (no bloquea)"""
+        self._messages.append((conversation_id, phone_number, message_type, content_type,
+                               content, intent, wa_message_id))
+        self._trim_messages()
+        self._maybe_flush(len(self._messages))
+
+    def _trim_messages(self):
+        overflow = len(self._messages) - self.max_buffer
+        if overflow > 0:
+            # Neon caído por mucho tiempo: descartamos lo más antiguo
+            for _ in range(overflow):
+                self._messages.popleft()
+            self._dropped += overflow
+            logging.error(f"Buffer de mensajes lleno, {overflow} filas descartadas")
+
+    def update_message_statuses(self, statuses):
+        """statuses: lista de (wa_message_id, status, unix_timestamp)"""
+        for wa_message_id, status, ts in statuses:
+            self._merge_status(wa_message_id, status, ts)
+        self._maybe_flush(len(self._statuses))
+
+    def _merge_status(self, wa_message_id, status, ts):
+        current = self._statuses.get(wa_message_id)
+        if current is None or (ts, STATUS_RANK.get(status, 0)) >= (current[1], STATUS_RANK.get(current[0], 0)):
+            if current is None and len(self._statuses) >= self.max_buffer:
+                self._dropped += 1
+                return
+            self._statuses[wa_message_id] = (status, ts)
+
+    async def claim_message(self, wa_message_id, phone_number):
+        """Returns: True si es la primera vez que se ve el mensaje"""
+        async with self._acquire() as conn:
+            result = await conn.execute("""
+                INSERT INTO processed_messages (wa_message_id, phone_number)
+                VALUES ($1, $2)
+                ON CONFLICT (wa_message_id) DO NOTHING
+            """, wa_message_id, phone_number)
+        return result.endswith(" 1")
+
+    async def get_conversation_history(self, phone_number, limit=50, before=None):
+        """Misma página keyset que NeonDB.get_conversation_history"""
+        keyset = "AND (timestamp, id) < ($3, $4)" if before is not None else ""
+        async with self._acquire() as conn:
+            rows = await conn.fetch(f"""
+                SELECT {', '.join(HISTORY_COLUMNS)}
+                FROM messages
+                WHERE phone_number = $1 {keyset}
+                ORDER BY timestamp DESC, id DESC
+                LIMIT $2
+            """, phone_number, limit, *(before or ()))
+        return [dict(row) for row in rows]
+
+    async def iter_conversation_history(self, phone_number, before=None, page_size=500):
+        """Todo el historial desde `before`, página a página (generador async)"""
+        while True:
+            page = await self.get_conversation_history(phone_number, page_size, before)
+            for row in page:
+                yield row
+            if len(page) < page_size:
+                return
+            before = (page[-1]["timestamp"], page[-1]["id"])
+
+    # ==================== VALIDACIONES ====================
+
+    def log_failed_validation(self, phone_number, step, user_input, expected_format):
+        """Registra el intento fallido (en lote) y devuelve el número de reintento"""
+        retry_count = self.retry_counter.record(phone_number, step)
+        self._failures.append((phone_number, step, user_input, expected_format, retry_count))
+        self._maybe_flush(len(self._failures))
+        return retry_count
+
+    # ==================== VOLCADO EN LOTE ====================
+
+    def _maybe_flush(self, size):
+        if size >= self.flush_size and self._flush_wanted is not None:
+            self._flush_wanted.set()
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        next_purge = loop.time() + self.purge_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_wanted.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wanted.clear()
+            await self.flush()
+            if loop.time() >= next_purge:
+                try:
+                    purged = await self.purge_processed()
+                except Exception as e:
+                    purged = 0
+                    logging.error(f"Error purgando processed_messages: {e}")
+                # Lote lleno: queda más por borrar, sigue en el próximo ciclo
+                if purged < self.PURGE_BATCH:
+                    next_purge = loop.time() + self.purge_interval
+
+    async def purge_processed(self):
+        """Borra un lote de processed_messages vencidos. Returns: filas borradas"""
+        async with self._acquire() as conn:
+            result = await conn.execute(self.PURGE_PROCESSED_SQL, self.processed_retention, self.PURGE_BATCH)
+        return int(result.split()[-1])
+
+    async def flush(self):
+        """Vuelca mensajes, estados y validaciones pendientes en una transacción"""
+        messages, self._messages = self._messages, deque()
+        statuses, self._statuses = self._statuses, {}
+        failures, self._failures = self._failures, deque(maxlen=self.max_buffer)
+        if not messages and not statuses and not failures:
+            return 0
+
+        try:
+            async with self._acquire() as conn:
+                async with conn.transaction():
+                    if messages:
+                        await conn.execute(self.MESSAGES_SQL, *map(list, zip(*messages)))
+                    if statuses:
+                        await conn.execute(
+                            self.STATUS_SQL,
+                            list(statuses),
+                            [status for status, _ in statuses.values()],
+                            [ts for _, ts in statuses.values()]
+                        )
+                    if failures:
+                        await conn.execute(self.FAILED_VALIDATIONS_SQL, *map(list, zip(*failures)))
+            return len(messages)
+        except Exception as e:
+            logging.error(f"Error guardando lote de {len(messages)} mensajes / {len(statuses)} estados: {e}")
+            # Se reintentan en el próximo ciclo, delante de los nuevos, sin
+            # pasar de max_buffer (igual que MessageLogWriter)
+            self._messages.extendleft(reversed(messages))
+            self._trim_messages()
+            self._failures.extendleft(reversed(failures))
+            for wa_message_id, (status, ts) in statuses.items():
+                self._merge_status(wa_message_id, status, ts)
+            return 0
+
+    def pending(self):
+        return len(self._messages) + len(self._statuses) + len(self._failures)
+
+    def pool_stats(self):
+        if self.pool is None:
+            return None
+        return {
+            "max": self.pool.get_max_size(),
+            "size": self.pool.get_size(),
+            "idle": self.pool.get_idle_size()
+        }
+
+    async def close(self):
+        """Detiene el volcado, guarda lo pendiente y cierra el pool"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        if self.pool is not None:
+            await self.flush()
+            await self.pool.close()
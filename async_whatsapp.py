@@ -0,0 +1,160 @@
+import asyncio
+import json
+import os
+import random
+import time
+import logging
+from collections import deque
+
+import aiohttp
+
+from whatsappservices import DEFAULT_API_URL, RETRY_STATUS
+
+# Errores previos a que la API reciba el POST; un timeout de lectura no está aquí
+CONNECT_ERRORS = (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError, aiohttp.ServerDisconnectedError)
+
+
+class AsyncWhatsAppClient:
+    """
+    Cliente de la Graph API para el modo async (aiohttp).
+
+    Misma política que WhatsAppClient: conexiones keep-alive acotadas a
+    `pool_size`, timeouts, reintentos de 429/5xx/is_transient y de errores de
+    conexión (nunca de un timeout de lectura) con backoff respetando
+    Retry-After y registro de latencias. La sesión se crea dentro
+    del event loop en el primer envío.
+    """
+
+    def __init__(self, token, phone_id, base_url=DEFAULT_API_URL, pool_size=100,
+                 connect_timeout=3.05, read_timeout=10.0, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0):
+        self.api_url = f"{base_url.rstrip('/')}/{phone_id}/messages"
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.headers = {
+            "content-type": "application/json",
+            "authorization": "Bearer " + token
+        }
+        self.session = None
+
+        self._latencies = deque(maxlen=1000)
+        self._calls = 0
+        self._failures = 0
+        self._retries = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            token=os.getenv("WHATSAPP_TOKEN", ""),
+            phone_id=os.getenv("PHONE_NUMBER_ID"),
+            base_url=os.getenv("WHATSAPP_API_URL", DEFAULT_API_URL),
+            pool_size=int(os.getenv("WHATSAPP_POOL_SIZE", 100)),
+            connect_timeout=float(os.getenv("WHATSAPP_CONNECT_TIMEOUT", 3.05)),
+            read_timeout=float(os.getenv("WHATSAPP_READ_TIMEOUT", 10)),
+            max_retries=int(os.getenv("WHATSAPP_MAX_RETRIES", 3))
+        )
+
+    def _session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=self.timeout,
+                headers=self.headers
+            )
+        return self.session
+
+    async def send(self, data):
+        """
+        Envía un mensaje. Returns: dict con la respuesta de la API
+        (incluye messages[0].id) o None si falló tras los reintentos.
+        """
+        body = data if isinstance(data, (bytes, str)) else json.dumps(data)
+        session = self._session()
+
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                async with session.post(self.api_url, data=body) as response:
+                    text = await response.text()
+                    status = response.status
+                    retry_after_header = response.headers.get("Retry-After")
+            except CONNECT_ERRORS as e:
+                # No se pudo conectar (o el keep-alive estaba cerrado): es seguro reintentar
+                self._record(time.monotonic() - started, ok=False)
+                logging.warning(f"Graph API sin conexión (intento {attempt + 1}): {e}")
+                retry_after = None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self._record(time.monotonic() - started, ok=False)
+                logging.error(f"Graph API sin respuesta tras enviar, no se reintenta para no duplicar: {e}")
+                return None
+            else:
+                ok = status == 200
+                self._record(time.monotonic() - started, ok=ok)
+                payload = self._json(text)
+                if ok:
+                    return payload if payload is not None else {}
+
+                if not self._is_retryable(status, payload):
+                    logging.error(f"Graph API rechazó el mensaje ({status}): {text[:300]}")
+                    return None
+
+                retry_after = self._retry_after(retry_after_header)
+                logging.warning(f"Graph API {status} (intento {attempt + 1}), reintentando")
+
+            if attempt < self.max_retries:
+                self._retries += 1
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+
+        return None
+
+    @staticmethod
+    def _json(text):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _is_retryable(status, payload):
+        if status in RETRY_STATUS:
+            return True
+        # La Graph API marca algunos errores 4xx como transitorios
+        if isinstance(payload, dict):
+            return bool(payload.get("error", {}).get("is_transient"))
+        return False
+
+    @staticmethod
+    def _retry_after(value):
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        delay = self.backoff_base * (2 ** attempt)
+        return min(delay, self.backoff_max) * random.uniform(0.5, 1.0)
+
+    def _record(self, latency, ok):
+        self._calls += 1
+        if not ok:
+            self._failures += 1
+        self._latencies.append(latency)
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        stats = {"calls": self._calls, "failures": self._failures, "retries": self._retries}
+        if latencies:
+            stats["latency_p50"] = round(latencies[len(latencies) // 2], 4)
+            stats["latency_p95"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 4)
+        return stats
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
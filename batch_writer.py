@@ -0,0 +1,229 @@
+import threading
+import time
+import logging
+from collections import deque
+from psycopg2.extras import execute_values
+
+# Orden de los estados de entrega; ante el mismo timestamp gana el más avanzado
+STATUS_RANK = {"sent": 1, "delivered": 2, "read": 3, "failed": 4}
+
+
+class MessageLogWriter:
+    """
+    Buffer de escritura para la tabla messages.
+
+    log_message solo agrega la fila en memoria; un hilo en segundo plano la
+    vuelca con un INSERT multi-fila cuando el buffer llega a `flush_size`
+    filas o pasan `flush_interval` segundos, fuera del camino del webhook.
+    Los estados de entrega (sent/delivered/read) se acumulan igual y se
+    aplican con un solo UPDATE ... FROM (VALUES ...) después de los INSERT,
+    al igual que las filas de failed_validations (solo para análisis).
+
+    El mismo hilo purga cada `purge_interval` segundos los IDs de
+    processed_messages más viejos que `processed_retention` segundos.
+    """
+
+    INSERT_SQL = """
+        INSERT INTO messages
+        (conversation_id, phone_number, message_type, content_type, content, intent, wa_message_id)
+        VALUES %s
+    """
+
+    # Si el llamador no conoce la conversación, se resuelve dentro del mismo INSERT
+    ROW_TEMPLATE = """(
+        COALESCE(%(conversation_id)s, (
+            SELECT id FROM conversations WHERE phone_number = %(phone_number)s
+            ORDER BY created_at DESC LIMIT 1
+        )),
+        %(phone_number)s, %(message_type)s, %(content_type)s, %(content)s, %(intent)s,
+        %(wa_message_id)s
+    )"""
+
+    STATUS_SQL = """
+        UPDATE messages m
+        SET delivery_status = v.status,
+            status_updated_at = to_timestamp(v.ts)
+        FROM (VALUES %s) AS v(wa_message_id, status, ts)
+        WHERE m.wa_message_id = v.wa_message_id
+        AND (m.status_updated_at IS NULL OR m.status_updated_at <= to_timestamp(v.ts))
+    """
+
+    FAILED_VALIDATIONS_SQL = """
+        INSERT INTO failed_validations
+        (phone_number, step, user_input, expected_format, retry_count)
+        VALUES %s
+    """
+
+    # Lotes cortos: no frenar el volcado de mensajes ni bloquear el índice
+    PURGE_PROCESSED_SQL = """
+        DELETE FROM processed_messages
+        WHERE wa_message_id IN (
+            SELECT wa_message_id FROM processed_messages
+            WHERE received_at < NOW() - make_interval(secs => %s)
+            LIMIT %s
+        )
+    """
+    PURGE_BATCH = 10000
+
+    def __init__(self, db, flush_size=100, flush_interval=1.0, max_buffer=10000,
+                 processed_retention=7 * 86400, purge_interval=3600.0):
+        self.db = db
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.processed_retention = processed_retention
+        self.purge_interval = purge_interval
+        self._next_purge = time.monotonic() + purge_interval
+
+        self._buffer = deque()
+        self._statuses = {}       # wa_message_id -> (status, ts)
+        self._failures = deque(maxlen=max_buffer)
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._running = True
+        self._dropped = 0
+
+        self._thread = threading.Thread(target=self._flush_loop, name="message-log-writer", daemon=True)
+        self._thread.start()
+
+    def add(self, row):
+        with self._cond:
+            self._append([row])
+            if len(self._buffer) >= self.flush_size:
+                self._cond.notify()
+
+    def add_failed_validation(self, row):
+        """row: (phone_number, step, user_input, expected_format, retry_count)"""
+        with self._cond:
+            self._failures.append(row)
+            if len(self._failures) >= self.flush_size:
+                self._cond.notify()
+
+    def add_statuses(self, statuses):
+        """statuses: iterable de (wa_message_id, status, unix_ts)"""
+        with self._cond:
+            for wa_message_id, status, ts in statuses:
+                self._merge_status(wa_message_id, status, ts)
+            if len(self._statuses) >= self.flush_size:
+                self._cond.notify()
+
+    def _merge_status(self, wa_message_id, status, ts):
+        current = self._statuses.get(wa_message_id)
+        if current is None or (ts, STATUS_RANK.get(status, 0)) >= (current[1], STATUS_RANK.get(current[0], 0)):
+            if current is None and len(self._statuses) >= self.max_buffer:
+                self._dropped += 1
+                return
+            self._statuses[wa_message_id] = (status, ts)
+
+    def _append(self, rows):
+        self._buffer.extend(rows)
+        overflow = len(self._buffer) - self.max_buffer
+        if overflow > 0:
+            # Neon caído por mucho tiempo: descartamos lo más antiguo
+            for _ in range(overflow):
+                self._buffer.popleft()
+            self._dropped += overflow
+            logging.error(f"Buffer de mensajes lleno, {overflow} filas descartadas")
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while (self._running and len(self._buffer) < self.flush_size
+                       and len(self._statuses) < self.flush_size
+                       and len(self._failures) < self.flush_size):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                running = self._running
+
+            try:
+                self.flush()
+            except Exception as e:
+                # El hilo no debe morir: lo pendiente se reintenta en el próximo ciclo
+                logging.error(f"Error en el hilo de escritura de mensajes: {e}")
+            if not running:
+                return
+            if time.monotonic() >= self._next_purge:
+                try:
+                    purged = self.purge_processed()
+                except Exception as e:
+                    purged = 0
+                    logging.error(f"Error purgando processed_messages: {e}")
+                # Lote lleno: queda más por borrar, sigue en el próximo ciclo
+                if purged < self.PURGE_BATCH:
+                    self._next_purge = time.monotonic() + self.purge_interval
+
+    def flush(self):
+        """Vuelca lo pendiente: INSERT multi-fila, UPDATE de estados y validaciones"""
+        with self._flush_lock:
+            with self._cond:
+                rows = list(self._buffer)
+                self._buffer.clear()
+                statuses, self._statuses = self._statuses, {}
+                failures = list(self._failures)
+                self._failures.clear()
+            if not rows and not statuses and not failures:
+                return 0
+
+            conn = None
+            try:
+                conn = self.db.get_connection()
+                with conn.cursor() as cursor:
+                    if rows:
+                        execute_values(cursor, self.INSERT_SQL, rows,
+                                       template=self.ROW_TEMPLATE, page_size=len(rows))
+                    if statuses:
+                        execute_values(cursor, self.STATUS_SQL,
+                                       [(wa_id, status, ts) for wa_id, (status, ts) in statuses.items()],
+                                       page_size=len(statuses))
+                    if failures:
+                        execute_values(cursor, self.FAILED_VALIDATIONS_SQL, failures,
+                                       page_size=len(failures))
+                conn.commit()
+                return len(rows)
+            except Exception as e:
+                if conn is not None:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        pass
+                logging.error(f"Error guardando lote de {len(rows)} mensajes / {len(statuses)} estados: {e}")
+                # Se reintentan en el próximo ciclo, delante de los nuevos
+                # (también si no hubo conexión: pool agotado o Neon caído)
+                with self._cond:
+                    self._buffer.extendleft(reversed(rows))
+                    self._append([])
+                    for wa_message_id, (status, ts) in statuses.items():
+                        self._merge_status(wa_message_id, status, ts)
+                    self._failures.extendleft(reversed(failures))
+                return 0
+            finally:
+                if conn is not None:
+                    self.db.return_connection(conn)
+
+    def purge_processed(self):
+        """Borra un lote de processed_messages vencidos. Returns: filas borradas"""
+        conn = self.db.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(self.PURGE_PROCESSED_SQL, (self.processed_retention, self.PURGE_BATCH))
+                conn.commit()
+                return cursor.rowcount
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.db.return_connection(conn)
+
+    def pending(self):
+        with self._cond:
+            return len(self._buffer) + len(self._statuses) + len(self._failures)
+
+    def close(self, timeout=10.0):
+        """Detiene el hilo y vuelca lo que quede en el buffer"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join(timeout)
@@ -0,0 +1,94 @@
+"""
+Benchmark de extract_name, extract_dni_location y sanitize_text:
+patrones precompilados vs. la implementación anterior con re.sub por llamada.
+
+    python benchmarks/bench_extraction.py [--number N]
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation_intelligence import ConversationIntelligence
+
+NAME_CORPUS = [
+    "Hola soy Juan Perez",
+    "Buenos días, me llamo María López",
+    "Mi nombre es Carlos Huamán Quispe",
+    "hola, que tal, soy Rosa Mamani 😊",
+    "Jhonatan Ccori Condori",
+    "buenas noches mi nombre es Luz Marina Torres",
+    "Soy el Ing. Percy Ñahui",
+    "WILMER CHOQUEHUANCA",
+]
+
+DNI_LOC_CORPUS = [
+    "10283749, Huancayo",
+    "20512345678 Arequipa",
+    "mi dni es 45678912 y soy de Juliaca",
+    "RUC 10456789123, San Juan de Lurigancho",
+    "Cusco 70112233",
+    "Lima",
+    "dni 4567891 trujillo",
+]
+
+SANITIZE_CORPUS = NAME_CORPUS + DNI_LOC_CORPUS + ["¡¡Hola!! ¿Dónde están? 📍📍", "NLR 3TON - blanco :)"]
+
+
+# ==================== IMPLEMENTACIÓN ANTERIOR ====================
+
+def legacy_extract_name(text):
+    cleaned = text
+    for pattern in ConversationIntelligence.GREETING_PATTERNS:
+        cleaned = re.sub(pattern, '', cleaned, flags=re.IGNORECASE)
+    cleaned = re.sub(r'[^a-zA-ZáéíóúÁÉÍÓÚñÑ\s]', '', cleaned)
+    cleaned = ' '.join(cleaned.split())
+    return cleaned.strip().title()
+
+
+def legacy_extract_dni_location(text):
+    result = {"dni": None, "location": None}
+    dni_match = re.search(r'\b(\d{8}|\d{11})\b', text)
+    if dni_match:
+        result["dni"] = dni_match.group(1)
+        text = text.replace(dni_match.group(1), '')
+    location = re.sub(r'[,\s]+', ' ', text).strip().title()
+    if location:
+        result["location"] = location
+    return result
+
+
+def legacy_sanitize_text(text):
+    text = re.sub(r'[^\w\s,.]', '', text, flags=re.UNICODE)
+    return ' '.join(text.split())
+
+
+CASES = [
+    ("extract_name", legacy_extract_name, ConversationIntelligence.extract_name, NAME_CORPUS),
+    ("extract_dni_location", legacy_extract_dni_location, ConversationIntelligence.extract_dni_location, DNI_LOC_CORPUS),
+    ("sanitize_text", legacy_sanitize_text, ConversationIntelligence.sanitize_text, SANITIZE_CORPUS),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f"{'función':<22} {'antes µs':>10} {'después µs':>11} {'speedup':>8}")
+    for name, before_fn, after_fn, corpus in CASES:
+        calls = args.number * len(corpus)
+        before = timeit.timeit(lambda: [before_fn(t) for t in corpus], number=args.number)
+        after = timeit.timeit(lambda: [after_fn(t) for t in corpus], number=args.number)
+        print(f"{name:<22} {before / calls * 1e6:>10.2f} {after / calls * 1e6:>11.2f} {before / after:>7.2f}x")
+
+        for text in corpus:
+            if before_fn(text) != after_fn(text):
+                print(f"    resultado distinto para {text!r}: {before_fn(text)!r} → {after_fn(text)!r}")
+
+
+if __name__ == "__main__":
+    main()
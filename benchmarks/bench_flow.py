@@ -0,0 +1,58 @@
+"""
+Latencia de transición por paso del FlowEngine (sin base de datos ni red).
+
+    python benchmarks/bench_flow.py [--number N]
+
+Para cada paso ejecuta un turno con una respuesta válida y otro con una
+inválida (si el paso valida) y reporta µs por turno: detección de
+intención, validador, transición y construcción de los mensajes.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation_flow import engine
+from outbound import ReplyPlan
+
+NUMBER = "51999888777"
+CONVERSATION = {"id": 1, "name": "Juan Pérez", "category": "Camión Isuzu", "model": "NLR 3TON"}
+
+# Paso → (respuesta válida, respuesta inválida o None)
+INPUTS = {
+    "START": ("", None),
+    "WAITING_NAME": ("Hola, soy Juan Pérez", "Juan"),
+    "WAITING_DNI_LOC": ("45678912, Huancayo", "Huancayo"),
+    "WAITING_CATEGORY": ("Camión Isuzu", "moto"),
+    "WAITING_MODEL": ("NLR 3TON", None),
+    "WAITING_COLOR": ("Blanco", None),
+    "WAITING_CALL_TIME": ("mañana 10am", None),
+    "FINISHED": ("si", None),
+}
+
+
+def run_turn(step, text):
+    reply = ReplyPlan(NUMBER, 1)
+    engine.handle(text, NUMBER, dict(CONVERSATION, current_step=step), reply, lambda *args: 1)
+    return reply
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'paso':<20} {'válido µs':>10} {'inválido µs':>12}  → siguiente")
+    for step, (valid, invalid) in INPUTS.items():
+        ok = timeit.timeit(lambda: run_turn(step, valid), number=args.number) / args.number
+        bad = (timeit.timeit(lambda: run_turn(step, invalid), number=args.number) / args.number
+               if invalid is not None else None)
+        next_step = run_turn(step, valid).next_step
+        bad_text = f"{bad * 1e6:12.2f}" if bad is not None else f"{'-':>12}"
+        print(f"{step:<20} {ok * 1e6:10.2f} {bad_text}  → {next_step}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Micro-benchmark de detect_intent: matcher compilado vs. el bucle anterior.
+
+    python benchmarks/bench_intents.py [--keywords-scale N]
+
+--keywords-scale multiplica la tabla de keywords con sinónimos sintéticos
+para ver cómo crece cada implementación al agregar intenciones.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation_intelligence import ConversationIntelligence, compile_intent_matcher, normalize_text
+
+CORPUS = [
+    "Hola buenas tardes",
+    "Juan Carlos Pérez Quispe",
+    "45678912, Huancayo",
+    "Camión Isuzu",
+    "¿Dónde están ubicados?",
+    "quiero hablar con una persona por favor",
+    "es para uso personal, no para la empresa",
+    "NLR 3TON",
+    "Blanco",
+    "mañana 10am",
+    "ya no gracias, chau",
+    "no entiendo qué debo poner",
+    "ya no entiendo nada",
+    "mi nombre es Rosa Huamán de la localidad de Ate",
+    "20512345678 Arequipa",
+]
+
+
+def legacy_detect_intent(text, intent_keywords):
+    """Implementación anterior: substring por cada keyword de cada intención"""
+    text_lower = text.lower()
+    for intent, keywords in intent_keywords.items():
+        if any(keyword in text_lower for keyword in keywords):
+            return intent
+    return None
+
+
+def compiled_detect_intent(text, pattern, keyword_priority, intents):
+    best = None
+    for match in pattern.finditer(normalize_text(text)):
+        priority = keyword_priority[' '.join(match.group(1).split())]
+        if best is None or priority < best:
+            best = priority
+            if best == 0:
+                break
+    return intents[best] if best is not None else None
+
+
+def scaled_keywords(scale):
+    keywords = {}
+    for intent, words in ConversationIntelligence.INTENT_KEYWORDS.items():
+        keywords[intent] = list(words) + [f"{w}{i}x" for i in range(scale - 1) for w in words]
+    return keywords
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--keywords-scale", type=int, default=1)
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    keywords = scaled_keywords(args.keywords_scale)
+    pattern, keyword_priority = compile_intent_matcher(keywords)
+    intents = list(keywords)
+    total_keywords = sum(len(words) for words in keywords.values())
+
+    legacy = timeit.timeit(
+        lambda: [legacy_detect_intent(t, keywords) for t in CORPUS], number=args.number
+    )
+    compiled = timeit.timeit(
+        lambda: [compiled_detect_intent(t, pattern, keyword_priority, intents) for t in CORPUS], number=args.number
+    )
+    calls = args.number * len(CORPUS)
+
+    print(f"keywords: {total_keywords}, llamadas: {calls}")
+    print(f"bucle anterior : {legacy / calls * 1e6:8.2f} µs/llamada")
+    print(f"regex compilada: {compiled / calls * 1e6:8.2f} µs/llamada")
+    print(f"speedup        : {legacy / compiled:8.2f}x")
+
+    print("\nDiferencias de resultado (anterior → compilado):")
+    for text in CORPUS:
+        before = legacy_detect_intent(text, keywords)
+        after = compiled_detect_intent(text, pattern, keyword_priority, intents)
+        if before != after:
+            print(f"  {text!r}: {before} → {after}")
+
+
+if __name__ == "__main__":
+    main()
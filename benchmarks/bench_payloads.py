@@ -0,0 +1,53 @@
+"""
+Micro-benchmark de payloads: dict + json.dumps por envío vs. plantillas
+pre-serializadas de util.
+
+    python benchmarks/bench_payloads.py [--number N]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import util
+from flows import TRUCK_MODELS
+
+NUMBER = "51999888777"
+BUTTONS = ["Camión Isuzu", "Camionetas"]
+BUTTONS_BODY = "🚘 *Tipo de unidad*\n\n¿En qué tipo de unidad estás interesado?"
+LIST_BODY = "Excelente elección. Isuzu es líder en camiones. ¿Qué modelo buscas?"
+TEXT_BODY = "Gracias *Juan Pérez*. Tengo registrado tu interés en un *NLR 3TON* color Blanco."
+
+CASES = {
+    "texto": (
+        lambda: json.dumps(util.TextMessage(TEXT_BODY, NUMBER)).encode(),
+        util.TextTemplate(), TEXT_BODY,
+    ),
+    "botones": (
+        lambda: json.dumps(util.ButtonsMessage(NUMBER, BUTTONS_BODY, BUTTONS)).encode(),
+        util.ButtonsTemplate(BUTTONS), BUTTONS_BODY,
+    ),
+    "lista": (
+        lambda: json.dumps(util.ListMessage(NUMBER, "Modelos Disponibles", LIST_BODY, TRUCK_MODELS, "Ver Modelos")).encode(),
+        util.ListTemplate("Modelos Disponibles", TRUCK_MODELS, "Ver Modelos"), LIST_BODY,
+    ),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=50000)
+    args = parser.parse_args()
+
+    for name, (legacy, template, body) in CASES.items():
+        assert json.loads(legacy()) == json.loads(template.render(NUMBER, body))
+        before = timeit.timeit(legacy, number=args.number) / args.number
+        after = timeit.timeit(lambda: template.render(NUMBER, body), number=args.number) / args.number
+        print(f"{name:<8} dict+dumps {before * 1e6:6.2f} µs | plantilla {after * 1e6:6.2f} µs | {before / after:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Prueba de carga end-to-end del webhook contra un servidor en marcha.
+
+    # Terminal 1: Graph API simulada + carga (repetir con 1, 2, 4 workers)
+    python benchmarks/load_test.py --stub-port 9100 --database-url "$DATABASE_URL"
+
+    # Terminal 2: el bot apuntando a la Graph API simulada
+    WHATSAPP_API_URL=http://localhost:9100 WEB_CONCURRENCY=4 \\
+    MESSAGE_DEBOUNCE_SECONDS=0 gunicorn -c gunicorn.conf.py
+
+Cada remitente sintético recorre el flujo (saludo → nombre → DNI → categoría
+→ modelo) enviando sus mensajes en orden; los remitentes van en paralelo.
+Reporta la tasa de aceptación del webhook y, con --database-url, el
+throughput real de procesamiento (mensajes reclamados en processed_messages).
+"""
+import argparse
+import json
+import itertools
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FLOW = ["Hola", "Juan Pérez", "45678912, Huancayo", "Camión Isuzu", "NLR 3TON"]
+
+
+def start_graph_stub(port, latency):
+    """Graph API simulada: acepta cualquier POST y devuelve un message id"""
+    counter = itertools.count(1)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if latency:
+                time.sleep(latency)
+            body = json.dumps({"messages": [{"id": f"wamid.stub.{next(counter)}"}]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def webhook_payload(number, message_id, text):
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{"changes": [{"value": {"messages": [{
+            "from": number,
+            "id": message_id,
+            "timestamp": str(int(time.time())),
+            "type": "text",
+            "text": {"body": text}
+        }]}}]}]
+    }
+
+
+def run_sender(url, run_id, index, messages, pause):
+    number = f"51{run_id % 1000:03d}{index:06d}"
+    latencies = []
+    errors = 0
+    for i in range(messages):
+        payload = json.dumps(webhook_payload(
+            number, f"wamid.loadtest.{run_id}.{index}.{i}", FLOW[i % len(FLOW)]
+        )).encode()
+        request = urllib.request.Request(url, data=payload, headers={"Content-Type": "application/json"})
+        started = time.monotonic()
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                response.read()
+        except (urllib.error.URLError, OSError):
+            errors += 1
+        latencies.append(time.monotonic() - started)
+        if pause:
+            time.sleep(pause)
+    return latencies, errors
+
+
+def wait_processed(database_url, run_id, total, timeout):
+    """Espera a que todos los mensajes de la corrida se hayan reclamado"""
+    import psycopg2
+
+    conn = psycopg2.connect(database_url)
+    deadline = time.monotonic() + timeout
+    processed = 0
+    try:
+        while time.monotonic() < deadline:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT COUNT(*) FROM processed_messages WHERE wa_message_id LIKE %s",
+                    (f"wamid.loadtest.{run_id}.%",)
+                )
+                processed = cursor.fetchone()[0]
+            conn.rollback()
+            if processed >= total:
+                break
+            time.sleep(0.5)
+    finally:
+        conn.close()
+    return processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8080/whatsapp")
+    parser.add_argument("--senders", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=len(FLOW), help="mensajes por remitente")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--pause", type=float, default=0.0, help="segundos entre mensajes de un remitente")
+    parser.add_argument("--stub-port", type=int, help="levantar la Graph API simulada en este puerto")
+    parser.add_argument("--stub-latency", type=float, default=0.05)
+    parser.add_argument("--database-url", help="medir procesamiento real en processed_messages")
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    if args.stub_port:
+        start_graph_stub(args.stub_port, args.stub_latency)
+        print(f"Graph API simulada en http://localhost:{args.stub_port}")
+
+    run_id = int(time.time())
+    total = args.senders * args.messages
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(
+            lambda i: run_sender(args.url, run_id, i, args.messages, args.pause), range(args.senders)
+        ))
+    accepted_in = time.monotonic() - started
+
+    latencies = sorted(latency for sender, _ in results for latency in sender)
+    errors = sum(e for _, e in results)
+    print(f"mensajes: {total} ({args.senders} remitentes × {args.messages}), errores: {errors}")
+    print(f"webhook  : {total / accepted_in:8.1f} req/s, "
+          f"p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms")
+
+    if args.database_url:
+        processed = wait_processed(args.database_url, run_id, total, args.timeout)
+        elapsed = time.monotonic() - started
+        print(f"procesado: {processed}/{total} en {elapsed:.1f}s → {processed / elapsed:8.1f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+"""
+Benchmark reproducible del bot completo: reproduce webhooks sintéticos
+contra la app Flask en proceso, con la Graph API simulada y Neon local o
+en memoria.
+
+    python benchmarks/replay.py [--leads 200] [--concurrency 32] [--typing-delay 0]
+    python benchmarks/replay.py --database-url postgresql://localhost/bot_bench
+    python benchmarks/replay.py --typing-delay 2 --outbox       # outbox con delays reales
+    python benchmarks/replay.py --save-baseline benchmarks/baseline.json
+    python benchmarks/replay.py --baseline benchmarks/baseline.json [--tolerance 0.2]
+
+Cada lead sintético recorre START → FINISHED (una parte pasa por las
+intenciones globales: ubicación, hablar con la asesora, salir) y espera la
+respuesta del bot antes de enviar su siguiente mensaje, como un cliente
+real. Reporta p50/p95/p99 del webhook, tiempo hasta completar cada lead y
+mensajes/s. Con --baseline termina con código 1 si alguna métrica empeora
+más que la tolerancia.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from load_test import webhook_payload
+
+# Guiones: (mensaje del cliente, respuestas esperadas del bot)
+LEAD = [
+    ("Hola", 1),
+    ("Juan Pérez", 1),
+    ("45678912, Huancayo", 1),
+    ("Camión Isuzu", 1),
+    ("NLR 3TON", 1),
+    ("Blanco", 1),
+    ("Mañana 10am", 1),
+]
+SCENARIOS = {
+    "lead": LEAD,
+    "ubicacion": LEAD[:2] + [("¿Dónde queda la sede?", 3)] + LEAD[2:],
+    "hablar_humano": LEAD[:3] + [("Quiero hablar con la asesora", 1)],
+    "salir": LEAD[:4] + [("Ya no, gracias", 1)],
+}
+# De cada 20 leads: 14 completos, 3 con ubicación, 2 derivados, 1 se retira
+MIX = ["lead"] * 14 + ["ubicacion"] * 3 + ["hablar_humano"] * 2 + ["salir"]
+
+LATENCY_METRICS = ("webhook_p50_ms", "webhook_p95_ms", "webhook_p99_ms", "lead_p50_s", "lead_p95_s")
+THROUGHPUT_METRICS = ("incoming_per_sec", "outgoing_per_sec")
+
+
+class GraphStub:
+    """Graph API simulada: registra cuántos mensajes recibió cada número"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.delivered = {}
+        self._ids = itertools.count(1)
+        self._changed = threading.Condition()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if stub.latency:
+                    time.sleep(stub.latency)
+                stub._record(json.loads(body).get("to"))
+                response = json.dumps({"messages": [{"id": f"wamid.stub.{next(stub._ids)}"}]}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def _record(self, number):
+        with self._changed:
+            self.delivered[number] = self.delivered.get(number, 0) + 1
+            self._changed.notify_all()
+
+    def wait_for(self, number, count, timeout):
+        with self._changed:
+            return self._changed.wait_for(lambda: self.delivered.get(number, 0) >= count, timeout)
+
+    def total(self):
+        with self._changed:
+            return sum(self.delivered.values())
+
+
+class MemoryDB:
+    """
+    Sustituto en memoria de NeonDB con la interfaz que usa app.py.
+    `round_trip` simula la latencia de Neon en cada consulta. El outbox
+    respeta send_after y el orden por número igual que claim_outbox.
+    """
+
+    def __init__(self, round_trip=0.0):
+        from conversation_cache import ConversationCache
+        from retry_counter import RetryCounter
+
+        self.round_trip = round_trip
+        self.conversation_cache = ConversationCache()
+        self.retry_counter = RetryCounter()
+        self.message_writer = self
+        self._conversations = {}
+        self._claimed = set()
+        self._ids = itertools.count(1)
+        self._outbox = {}          # id -> fila pendiente
+        self._outbox_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _query(self):
+        if self.round_trip:
+            time.sleep(self.round_trip)
+
+    @contextmanager
+    def sender_lock(self, phone_number):
+        yield
+
+    def claim_message(self, wa_message_id, phone_number):
+        self._query()
+        with self._lock:
+            if wa_message_id in self._claimed:
+                return False
+            self._claimed.add(wa_message_id)
+            return True
+
+    def get_or_create_conversation(self, phone_number):
+        cached = self.conversation_cache.get(phone_number)
+        if cached is not None:
+            return cached
+        self._query()
+        with self._lock:
+            conversation = self._conversations.get(phone_number)
+            if conversation is None:
+                conversation = {"id": next(self._ids), "phone_number": phone_number,
+                                "current_step": "START", "status": "IN_PROGRESS"}
+                self._conversations[phone_number] = conversation
+            conversation = dict(conversation)
+        self.conversation_cache.put(phone_number, conversation)
+        return conversation
+
+    def update_conversation_step(self, phone_number, step, outbox=None, **kwargs):
+        self._query()
+        fields = {key: value for key, value in kwargs.items() if value is not None}
+        with self._lock:
+            conversation = self._conversations.get(phone_number)
+            if conversation is not None:
+                if outbox:
+                    self._insert_outbox(phone_number, conversation["id"], outbox)
+                conversation.update(fields, current_step=step)
+                if fields.get("status") == "COMPLETED":
+                    del self._conversations[phone_number]
+        self.conversation_cache.update(phone_number, current_step=step, **fields)
+
+    def _insert_outbox(self, phone_number, conversation_id, messages):
+        send_after = time.monotonic()
+        for payload, delay in messages:
+            send_after += delay
+            row_id = next(self._outbox_ids)
+            self._outbox[row_id] = {"id": row_id, "phone_number": phone_number, "conversation_id": conversation_id,
+                                    "payload": payload, "attempts": 0, "send_after": send_after}
+
+    def enqueue_outbox(self, phone_number, conversation_id, messages):
+        self._query()
+        with self._lock:
+            self._insert_outbox(phone_number, conversation_id, messages)
+
+    def _outbox_heads(self):
+        heads = {}
+        for row_id in sorted(self._outbox):
+            heads.setdefault(self._outbox[row_id]["phone_number"], self._outbox[row_id])
+        return heads.values()
+
+    def claim_outbox(self, limit=20, lease_seconds=60):
+        self._query()
+        now = time.monotonic()
+        with self._lock:
+            rows = sorted((row for row in self._outbox_heads() if row["send_after"] <= now),
+                          key=lambda row: row["id"])[:limit]
+            for row in rows:
+                row["attempts"] += 1
+                row["send_after"] = now + lease_seconds
+            return [dict(row) for row in rows]
+
+    def next_outbox_due(self):
+        self._query()
+        with self._lock:
+            due = [row["send_after"] for row in self._outbox_heads()]
+        return min(due) - time.monotonic() if due else None
+
+    def mark_outbox_sent(self, sent):
+        if not sent:
+            return
+        self._query()
+        with self._lock:
+            for row_id, _ in sent:
+                self._outbox.pop(row_id, None)
+
+    def mark_outbox_failed(self, outbox_id, error, retry_in=None):
+        self._query()
+        with self._lock:
+            if retry_in is None:
+                self._outbox.pop(outbox_id, None)
+            elif outbox_id in self._outbox:
+                self._outbox[outbox_id]["send_after"] = time.monotonic() + retry_in
+
+    def purge_outbox(self, older_than_seconds):
+        return 0
+
+    def log_message(self, *args, **kwargs):
+        pass
+
+    def update_message_statuses(self, statuses):
+        pass
+
+    def log_failed_validation(self, phone_number, step, user_input, expected_format):
+        return self.retry_counter.record(phone_number, step)
+
+    def pending(self):
+        return 0
+
+    def pool_stats(self):
+        return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_lead(app, stub, run_id, index, script, timeout):
+    """Un cliente: envía cada mensaje y espera la respuesta. Returns: (latencias, duración o None)"""
+    client = app.test_client()
+    number = f"519{run_id % 10000:04d}{index:05d}"
+    latencies = []
+    expected = 0
+    started = time.monotonic()
+    for turn, (text, replies) in enumerate(script):
+        body = json.dumps(webhook_payload(number, f"wamid.replay.{run_id}.{index}.{turn}", text))
+        sent = time.perf_counter()
+        response = client.post("/whatsapp", data=body, content_type="application/json")
+        latencies.append(time.perf_counter() - sent)
+        if response.status_code != 200:
+            return latencies, None
+        expected += replies
+        if not stub.wait_for(number, expected, timeout):
+            return latencies, None
+    return latencies, time.monotonic() - started
+
+
+def run(args):
+    stub = GraphStub(latency=args.graph_latency)
+    os.environ.update({
+        "WHATSAPP_API_URL": stub.url,
+        "WHATSAPP_TOKEN": "bench",
+        "PHONE_NUMBER_ID": "bench",
+        "TYPING_DELAY_MIN": str(args.typing_delay),
+        "TYPING_DELAY_MAX": str(args.typing_delay),
+        "MESSAGE_DEBOUNCE_SECONDS": str(args.debounce),
+        "WHATSAPP_MAX_MPS": str(args.max_mps),
+        "OUTBOX_ENABLED": "1" if args.outbox else "0",
+    })
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        import neon_db
+        neon_db.db = MemoryDB(round_trip=args.db_latency)
+
+    import app as bot
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    run_id = int(time.time())
+    scripts = [SCENARIOS[MIX[i % len(MIX)]] for i in range(args.leads)]
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(
+            lambda i: run_lead(bot.app, stub, run_id, i, scripts[i], args.timeout), range(args.leads)
+        ))
+    elapsed = time.monotonic() - started
+
+    if args.metrics_out:
+        with open(args.metrics_out, "w") as f:
+            f.write(bot.app.test_client().get("/metrics").get_data(as_text=True))
+    bot.conversation_queue.stop(timeout=5)
+    bot.delayed_sender.stop(timeout=5)
+    bot.outbox_worker.stop(timeout=5)
+
+    webhook = [latency for latencies, _ in results for latency in latencies]
+    leads = [duration for _, duration in results if duration is not None]
+    return {
+        "config": {key: getattr(args, key) for key in (
+            "leads", "concurrency", "typing_delay", "debounce", "graph_latency", "db_latency", "max_mps", "outbox"
+        )} | {"database": "postgres" if args.database_url else "memory"},
+        "results": {
+            "incoming": len(webhook),
+            "outgoing": stub.total(),
+            "leads_completed": len(leads),
+            "leads_failed": args.leads - len(leads),
+            "elapsed_s": round(elapsed, 3),
+            "webhook_p50_ms": round(percentile(webhook, 0.50) * 1000, 3),
+            "webhook_p95_ms": round(percentile(webhook, 0.95) * 1000, 3),
+            "webhook_p99_ms": round(percentile(webhook, 0.99) * 1000, 3),
+            "lead_p50_s": round(percentile(leads, 0.50), 3) if leads else None,
+            "lead_p95_s": round(percentile(leads, 0.95), 3) if leads else None,
+            "incoming_per_sec": round(len(webhook) / elapsed, 1),
+            "outgoing_per_sec": round(stub.total() / elapsed, 1),
+        }
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Returns: lista de regresiones respecto a la línea base"""
+    if baseline["config"] != report["config"]:
+        print(f"⚠️  Configuración distinta a la línea base: {baseline['config']}")
+    regressions = []
+    current, previous = report["results"], baseline["results"]
+    for key in LATENCY_METRICS:
+        if current.get(key) is not None and previous.get(key) and current[key] > previous[key] * (1 + tolerance):
+            regressions.append(f"{key}: {previous[key]} → {current[key]}")
+    for key in THROUGHPUT_METRICS:
+        if previous.get(key) and current[key] < previous[key] * (1 - tolerance):
+            regressions.append(f"{key}: {previous[key]} → {current[key]}")
+    if current["leads_failed"] > previous.get("leads_failed", 0):
+        regressions.append(f"leads_failed: {previous.get('leads_failed', 0)} → {current['leads_failed']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--leads", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32, help="clientes simultáneos")
+    parser.add_argument("--typing-delay", type=float, default=0.0, help="delay humanizado fijo en segundos")
+    parser.add_argument("--debounce", type=float, default=0.0, help="MESSAGE_DEBOUNCE_SECONDS")
+    parser.add_argument("--graph-latency", type=float, default=0.0, help="latencia de la Graph API simulada")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="round trip simulado de la BD en memoria")
+    parser.add_argument("--max-mps", type=float, default=1000.0, help="WHATSAPP_MAX_MPS")
+    parser.add_argument("--database-url", help="Postgres local en lugar de la BD en memoria")
+    parser.add_argument("--outbox", action="store_true", help="enviar por el outbox en lugar del despachador en memoria")
+    parser.add_argument("--timeout", type=float, default=30.0, help="espera máxima por respuesta")
+    parser.add_argument("--verbose", action="store_true", help="mostrar el log del bot")
+    parser.add_argument("--metrics-out", help="guardar el /metrics final en este archivo")
+    parser.add_argument("--save-baseline", help="guardar el resultado como línea base (JSON)")
+    parser.add_argument("--baseline", help="comparar contra esta línea base")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="empeoramiento tolerado (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    report = run(args)
+    results = report["results"]
+    print(f"leads    : {results['leads_completed']}/{args.leads} completos en {results['elapsed_s']}s "
+          f"({results['leads_failed']} sin respuesta)")
+    print(f"webhook  : p50 {results['webhook_p50_ms']} ms, p95 {results['webhook_p95_ms']} ms, "
+          f"p99 {results['webhook_p99_ms']} ms")
+    print(f"lead     : p50 {results['lead_p50_s']} s, p95 {results['lead_p95_s']} s")
+    print(f"mensajes : {results['incoming_per_sec']} entrantes/s, {results['outgoing_per_sec']} salientes/s")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Línea base guardada en {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"❌ {regression}")
+        if regressions:
+            sys.exit(1)
+        print("✅ Sin regresiones respecto a la línea base")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ConversationCache:
+    """
+    Cache en memoria del estado de conversación activo, por número de teléfono.
+
+    LRU acotado a `max_entries` con expiración por `ttl` segundos. NeonDB lo
+    actualiza en cada escritura (write-through), así la mayoría de turnos no
+    necesita leer la conversación desde Neon.
+    """
+
+    def __init__(self, max_entries=5000, ttl=900):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()   # number -> (expires_at, dict)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, number):
+        with self._lock:
+            entry = self._entries.get(number)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[number]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(number)
+            self.hits += 1
+            return dict(entry[1])
+
+    def peek(self, number):
+        """Como get(), pero sin afectar contadores ni el orden LRU"""
+        with self._lock:
+            entry = self._entries.get(number)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return dict(entry[1])
+
+    def put(self, number, conversation):
+        with self._lock:
+            self._entries[number] = (time.monotonic() + self.ttl, dict(conversation))
+            self._entries.move_to_end(number)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, number, **fields):
+        """Aplica una escritura ya confirmada en la BD (si el número está en cache)"""
+        with self._lock:
+            entry = self._entries.get(number)
+            if entry is None:
+                return
+            if fields.get("status") == "COMPLETED":
+                del self._entries[number]
+                return
+            entry[1].update(fields)
+            self._entries[number] = (time.monotonic() + self.ttl, entry[1])
+            self._entries.move_to_end(number)
+
+    def invalidate(self, number):
+        with self._lock:
+            self._entries.pop(number, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 4) if total else None
+            }
@@ -0,0 +1,298 @@
+"""
+Flujo conversacional compartido por el modo sync (app.py) y el async
+(async_app.py): motor de pasos compilado desde flows.py y reglas de fusión
+de mensajes.
+"""
+import logging
+import string
+import time
+from datetime import datetime
+import pytz
+
+import metrics
+import util
+from conversation_intelligence import intelligence, response_builder
+from flows import FLOWS, GLOBAL_INTENTS
+
+def should_debounce(conversation):
+    """Esperar más mensajes solo si la conversación está en un paso fusionable"""
+    return conversation is not None and conversation.get("current_step") in COALESCE_STEPS
+
+def coalesce_messages(conversation, messages):
+    """
+    Fusiona mensajes de texto seguidos en un solo turno mientras el paso
+    actual no tenga su dato completo ("Juan" + "Pérez" → "Juan Pérez").
+    Lo que sobra se reencola y se evalúa contra el siguiente paso.
+    conversation: estado actual (del cache), o None si no se conoce
+    Returns: (turnos, mensajes_a_reencolar)
+    """
+    is_complete = COALESCE_STEPS.get(conversation.get("current_step")) if conversation else None
+    if is_complete is None:
+        return messages, []
+    
+    pending = []
+    for i, message in enumerate(messages):
+        text = util.GetTextUser(message) if message.get("type") == "text" else None
+        
+        # Botones, listas o intenciones globales no se fusionan
+        if text is None or intelligence.detect_intent(text):
+            if pending:
+                return [merge_messages(pending)], messages[i:]
+            return [message], messages[i + 1:]
+        
+        pending.append(message)
+        if is_complete(" ".join(util.GetTextUser(m) for m in pending)):
+            return [merge_messages(pending)], messages[i + 1:]
+    
+    return [merge_messages(pending)], []
+
+def merge_messages(messages):
+    if len(messages) == 1:
+        return messages[0]
+    merged = dict(messages[-1])
+    merged["text"] = {"body": " ".join(util.GetTextUser(m) for m in messages)}
+    merged["_merged"] = messages
+    return merged
+
+def get_time_greeting():
+    """Obtiene saludo según hora en Perú"""
+    tz_peru = pytz.timezone('America/Lima')
+    hora_actual = datetime.now(tz_peru).hour
+    
+    if 5 <= hora_actual < 12:
+        return "Buenos días"
+    elif 12 <= hora_actual < 18:
+        return "Buenas tardes"
+    else:
+        return "Buenas noches"
+
+
+# ==================== VALIDADORES ====================
+# Cada validador recibe el texto y devuelve los campos a guardar, o None si
+# la respuesta no sirve para el paso.
+
+def _parse_full_name(text):
+    name = intelligence.extract_name(text)
+    return {"name": name} if len(name.split()) >= 2 else None
+
+def _parse_dni_location(text):
+    extracted = intelligence.extract_dni_location(text)
+    if not extracted['dni'] or not extracted['location']:
+        return None
+    return {"dni_ruc": extracted['dni'], "location": extracted['location']}
+
+def _parse_category(text):
+    category = intelligence.validate_category(text)
+    return {"category": category} if category else None
+
+def _parse_color(text):
+    # Se acepta cualquier texto como color
+    return {"color": intelligence.validate_color(text) or text.capitalize()}
+
+PARSERS = {
+    "full_name": _parse_full_name,
+    "dni_location": _parse_dni_location,
+    "category": _parse_category,
+    "model": lambda text: {"model": text},
+    "color": _parse_color,
+    "call_time": lambda text: {"preferred_call_time": text},
+}
+
+# Valores que los prompts pueden usar además de los campos de la conversación
+CONTEXT_PROVIDERS = {
+    "greeting": get_time_greeting,
+}
+
+
+# ==================== MOTOR ====================
+
+class _FormatContext(dict):
+    """Campos ausentes se muestran vacíos, como el .get(campo, "") anterior"""
+
+    def __missing__(self, key):
+        return ""
+
+
+class Prompt:
+    """
+    Mensaje de un paso compilado una vez: su plantilla queda serializada
+    (util.PayloadTemplate, con los límites de la API validados al compilar)
+    y por mensaje solo se insertan el número y el texto.
+    """
+
+    def __init__(self, spec):
+        self.kind = spec["type"]
+        self.spec = spec
+        self.body = spec.get("body", "")
+        self.fields = {name for _, name, _, _ in string.Formatter().parse(self.body) if name}
+        self.cases = None
+        if self.kind == "by_field":
+            self.cases = {value: Prompt(case) for value, case in spec["cases"].items()}
+        elif self.kind == "text":
+            self.template = util.TextTemplate()
+        elif self.kind == "buttons":
+            self.template = util.ButtonsTemplate(spec["buttons"])
+        elif self.kind == "list":
+            self.template = util.ListTemplate(spec["header"], spec["options"], spec.get("button", "Opciones"))
+        elif self.kind == "location":
+            self.template = util.LocationTemplate()
+        else:
+            raise ValueError(f"Tipo de prompt desconocido: {self.kind}")
+
+    def render(self, number, ctx, prefix=None):
+        if self.cases is not None:
+            return self.cases[ctx.get(self.spec["field"])].render(number, ctx, prefix)
+
+        body = self.body
+        if self.fields:
+            values = _FormatContext(ctx)
+            for name in self.fields:
+                if name in CONTEXT_PROVIDERS:
+                    values[name] = CONTEXT_PROVIDERS[name]()
+            body = body.format_map(values)
+        if prefix:
+            body = f"{prefix}\n\n{body}"
+        return self.template.render(number, body)
+
+
+class Step:
+    """Paso compilado de un flujo"""
+
+    def __init__(self, name, spec, flow):
+        self.name = name
+        self.flow = flow
+        self.prompt = Prompt(spec["prompt"]) if "prompt" in spec else None
+        self.reply = Prompt(spec["reply"]) if "reply" in spec else None
+        self.parse = PARSERS[spec["parse"]] if "parse" in spec else None
+        self.expected = spec.get("expected")
+        self.next = spec.get("next")
+        self.reprompt = spec.get("reprompt", False)
+        self.coalesce = spec.get("coalesce", False)
+        self.completes = spec.get("completes", False)
+        self.log = spec.get("log")
+        self.restart_on = frozenset(spec.get("restart_on", ()))
+        self.restart_to = spec.get("restart_to")
+
+    def next_step(self, ctx):
+        if isinstance(self.next, dict):
+            return self.next["cases"].get(ctx.get(self.next["by"]), self.next.get("default"))
+        return self.next
+
+
+class FlowEngine:
+    """
+    Ejecuta los flujos de flows.py: se compilan una vez en una tabla
+    paso → Step (despacho O(1) por mensaje) y las intenciones globales en
+    otra. No escribe en la base: la transición y los mensajes quedan en el
+    ReplyPlan y cada modo (sync/async) los confirma a su manera.
+    """
+
+    def __init__(self, flows, intents):
+        self.steps = {}
+        for flow_name, steps in flows.items():
+            for name, spec in steps.items():
+                if name in self.steps:
+                    raise ValueError(f"Paso {name} duplicado en los flujos {self.steps[name].flow} y {flow_name}")
+                self.steps[name] = Step(name, spec, flow_name)
+
+        self.intents = {}
+        for intent, spec in intents.items():
+            self.intents[intent] = {
+                "messages": [Prompt(message) for message in spec.get("messages", [])],
+                "next": spec.get("next"),
+                "set": dict(spec.get("set", {})),
+                "completes": spec.get("completes", False),
+                "log": spec.get("log"),
+            }
+        self.error_template = util.TextTemplate()
+        self._check_targets()
+
+    def _check_targets(self):
+        targets = [spec["next"] for spec in self.intents.values() if spec["next"]]
+        for step in self.steps.values():
+            if isinstance(step.next, dict):
+                targets.extend(step.next["cases"].values())
+                targets.append(step.next.get("default"))
+            else:
+                targets.append(step.next)
+            targets.append(step.restart_to)
+        missing = {target for target in targets if target and target not in self.steps}
+        if missing:
+            raise ValueError(f"Pasos inexistentes en los flujos: {sorted(missing)}")
+
+    def handle(self, text, number, conversation, reply, log_failed_validation):
+        """
+        Un turno: intención global o paso actual.
+        log_failed_validation(number, step, text, expected) -> retry_count
+        """
+        started = time.perf_counter()
+        name = intelligence.detect_intent(text)
+        intent = self.intents.get(name)
+        if intent is not None:
+            self._handle_intent(intent, number, conversation, reply)
+            metrics.step_seconds.observe(time.perf_counter() - started, f"intent:{name}")
+            return
+
+        step = self.steps.get(conversation.get("current_step"))
+        if step is not None:
+            self._handle_step(step, text, number, conversation, reply, log_failed_validation)
+            metrics.step_seconds.observe(time.perf_counter() - started, step.name)
+
+    def _handle_intent(self, intent, number, conversation, reply):
+        if intent["next"]:
+            fields = dict(intent["set"])
+            if intent["completes"]:
+                fields.update(status="COMPLETED", completed_at=datetime.now(pytz.utc))
+            reply.transition(intent["next"], **fields)
+        for prompt in intent["messages"]:
+            reply.add(prompt.render(number, conversation))
+        if intent["log"]:
+            logging.info(intent["log"].format(number=number))
+
+    def _handle_step(self, step, text, number, conversation, reply, log_failed_validation):
+        # Paso terminal: respuesta fija y, si corresponde, reinicio del flujo
+        if step.reply is not None:
+            reply.add(step.reply.render(number, conversation))
+            if text.lower() in step.restart_on:
+                reply.transition(step.restart_to)
+                restarted = dict(conversation, current_step=step.restart_to)
+                self._handle_step(self.steps[step.restart_to], "", number, restarted, reply, log_failed_validation)
+            return
+
+        fields = step.parse(text) if step.parse else {}
+        if fields is None:
+            retry_count = log_failed_validation(number, step.name, text, step.expected)
+            error_msg = response_builder.format_error_retry(step.name, retry_count)
+            if step.reprompt and step.prompt is not None:
+                reply.add(step.prompt.render(number, conversation, prefix=error_msg))
+            else:
+                reply.add(self.error_template.render(number, error_msg))
+            return
+
+        ctx = dict(conversation, **fields)
+        next_name = step.next_step(ctx)
+        if next_name is None:
+            return
+        if step.completes:
+            fields.update(status="COMPLETED", completed_at=datetime.now(pytz.utc))
+        reply.transition(next_name, **fields)
+
+        next_step = self.steps[next_name]
+        if next_step.prompt is not None:
+            reply.add(next_step.prompt.render(number, ctx))
+        if step.log:
+            logging.info(step.log.format(number=number))
+
+
+engine = FlowEngine(FLOWS, GLOBAL_INTENTS)
+
+# Pasos donde el cliente suele partir su respuesta en varios mensajes seguidos;
+# el validador indica cuándo el texto acumulado ya está completo
+COALESCE_STEPS = {
+    name: (lambda text, parse=step.parse: parse(text) is not None)
+    for name, step in engine.steps.items() if step.coalesce
+}
+
+def run_state_machine(text, number, conversation, reply, log_failed_validation):
+    """Un turno de la conversación (ver FlowEngine.handle)"""
+    engine.handle(text, number, conversation, reply, log_failed_validation)
@@ -1,5 +1,77 @@
+import os
 import re
-from typing import Optional, Dict, Tuple
+import unicodedata
+from typing import Optional, Dict, List, Tuple
+
+
+def normalize_text(text: str) -> str:
+    """
+    Minúsculas y sin tildes: "Dirección" → "direccion", "Ñaña" → "nana"
+    """
+    text = text.lower()
+    if text.isascii():
+        return text
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def _trie_regex(words: List[str]) -> str:
+    """
+    Arma una alternación factorizada por prefijos (trie), de modo que el motor
+    de regex nunca compara dos veces el mismo prefijo: "sede|salir|showroom"
+    → "s(?:alir|ede|howroom)".
+    """
+    trie: Dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = True
+
+    def build(node: Dict) -> str:
+        ends = '' in node
+        branches = [
+            (r'\s+' if ch == ' ' else re.escape(ch)) + build(child)
+            for ch, child in sorted(node.items()) if ch
+        ]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # Opcional greedy: si calza, se prefiere la keyword más larga ('asesora' sobre 'asesor')
+        return f'(?:{body})?' if ends else body
+
+    return build(trie)
+
+
+def compile_intent_matcher(intent_keywords: Dict[str, List[str]]) -> Tuple[re.Pattern, Dict[str, int]]:
+    """
+    Compila todas las keywords (sin tildes) en una sola regex por palabra
+    completa ('persona' no calza en 'personal').
+
+    El patrón es un lookahead evaluado en cada inicio de palabra, así las
+    coincidencias pueden solaparse: en "ya no entiendo" aparecen 'ya no'
+    (salir) y 'no entiendo' (ayuda), y gana la de mayor prioridad. En una
+    misma posición se captura la keyword más larga; por eso su prioridad
+    incluye la de las keywords que son palabras iniciales de ella.
+
+    Returns: (patrón, {keyword normalizada: prioridad}). La prioridad es el
+    orden de la intención en `intent_keywords`; si una keyword aparece en dos
+    intenciones gana la declarada primero.
+    """
+    keyword_priority: Dict[str, int] = {}
+    for priority, keywords in enumerate(intent_keywords.values()):
+        for keyword in keywords:
+            keyword_priority.setdefault(' '.join(normalize_text(keyword).split()), priority)
+
+    for keyword in keyword_priority:
+        keyword_priority[keyword] = min(
+            priority for other, priority in keyword_priority.items()
+            if keyword == other or keyword.startswith(other + ' ')
+        )
+
+    pattern = re.compile(r'\b(?=(' + _trie_regex(list(keyword_priority)) + r')\b)')
+    return pattern, keyword_priority
+
 
 class ConversationIntelligence:
     """
@@ -16,6 +88,17 @@ class ConversationIntelligence:
         r'^\s*mi\s+nombre\s+es\s+'
     ]
     
+    # Todos los saludos en una sola alternación; se repite para cubrir
+    # combinaciones como "Hola, buenos días, soy ..."
+    GREETING_RE = re.compile(
+        '^(?:' + '|'.join(p.lstrip('^') for p in GREETING_PATTERNS) + ')+',
+        re.IGNORECASE
+    )
+    NAME_INVALID_CHARS_RE = re.compile(r'[^a-zA-ZáéíóúÁÉÍÓÚñÑ\s]+')
+    DNI_RE = re.compile(r'\b(\d{8}|\d{11})\b')
+    PHONE_PERU_RE = re.compile(r'51\d{9}')
+    SANITIZE_RE = re.compile(r'[^\w\s,.]+')
+    
     # Palabras clave para detección de intenciones
     INTENT_KEYWORDS = {
         'ubicacion': [
@@ -37,6 +120,10 @@ class ConversationIntelligence:
         ]
     }
     
+    # Matcher compilado una sola vez; prioridad = orden de INTENT_KEYWORDS
+    INTENT_NAMES = list(INTENT_KEYWORDS)
+    INTENT_PATTERN, KEYWORD_PRIORITY = compile_intent_matcher(INTENT_KEYWORDS)
+    
     # Opciones válidas por categoría
     VALID_OPTIONS = {
         'category': ['camión', 'camion', 'isuzu', 'camioneta', 'camionetas'],
@@ -54,18 +141,13 @@ class ConversationIntelligence:
         - "Mi nombre es Carlos" → "Carlos"
         """
         # Remover saludos y frases introductorias
-        cleaned = text
-        for pattern in ConversationIntelligence.GREETING_PATTERNS:
-            cleaned = re.sub(pattern, '', cleaned, flags=re.IGNORECASE)
+        cleaned = ConversationIntelligence.GREETING_RE.sub('', text, count=1)
         
         # Limpiar caracteres especiales pero mantener tildes y ñ
-        cleaned = re.sub(r'[^a-zA-ZáéíóúÁÉÍÓÚñÑ\s]', '', cleaned)
-        
-        # Remover espacios extras
-        cleaned = ' '.join(cleaned.split())
+        cleaned = ConversationIntelligence.NAME_INVALID_CHARS_RE.sub('', cleaned)
         
-        # Title case
-        return cleaned.strip().title()
+        # Remover espacios extras y Title case
+        return ' '.join(cleaned.split()).title()
     
     @staticmethod
     def extract_dni_location(text: str) -> Dict[str, Optional[str]]:
@@ -79,14 +161,14 @@ class ConversationIntelligence:
         result = {"dni": None, "location": None}
         
         # Buscar DNI (8 dígitos) o RUC (11 dígitos)
-        dni_match = re.search(r'\b(\d{8}|\d{11})\b', text)
+        dni_match = ConversationIntelligence.DNI_RE.search(text)
         if dni_match:
             result["dni"] = dni_match.group(1)
             # Remover DNI del texto para extraer ubicación
-            text = text.replace(dni_match.group(1), '')
+            text = text[:dni_match.start()] + text[dni_match.end():]
         
         # Limpiar y extraer ubicación
-        location = re.sub(r'[,\s]+', ' ', text).strip().title()
+        location = ' '.join(text.replace(',', ' ').split()).title()
         if location:
             result["location"] = location
         
@@ -95,17 +177,22 @@ class ConversationIntelligence:
     @staticmethod
     def detect_intent(text: str) -> Optional[str]:
         """
-        Detecta intención del usuario basado en keywords
+        Detecta intención del usuario basado en keywords (una sola pasada,
+        sin tildes, por palabra completa y con coincidencias solapadas)
         
         Returns: 'ubicacion', 'ayuda', 'hablar_humano', 'salir', o None
         """
-        text_lower = text.lower()
+        keyword_priority = ConversationIntelligence.KEYWORD_PRIORITY
+        best = None
         
-        for intent, keywords in ConversationIntelligence.INTENT_KEYWORDS.items():
-            if any(keyword in text_lower for keyword in keywords):
-                return intent
+        for match in ConversationIntelligence.INTENT_PATTERN.finditer(normalize_text(text)):
+            priority = keyword_priority[' '.join(match.group(1).split())]
+            if best is None or priority < best:
+                best = priority
+                if best == 0:
+                    break
         
-        return None
+        return ConversationIntelligence.INTENT_NAMES[best] if best is not None else None
     
     @staticmethod
     def validate_category(text: str) -> Optional[str]:
@@ -142,7 +229,7 @@ class ConversationIntelligence:
         Valida formato de teléfono peruano
         Formato esperado: 51XXXXXXXXX (código país + 9 dígitos)
         """
-        return bool(re.match(r'^51\d{9}$', phone))
+        return ConversationIntelligence.PHONE_PERU_RE.fullmatch(phone) is not None
     
     @staticmethod
     def sanitize_text(text: str) -> str:
@@ -150,7 +237,7 @@ class ConversationIntelligence:
         Limpia texto de caracteres especiales y normaliza espacios
         """
         # Remover emojis y caracteres especiales
-        text = re.sub(r'[^\w\s,.]', '', text, flags=re.UNICODE)
+        text = ConversationIntelligence.SANITIZE_RE.sub('', text)
         # Normalizar espacios
         return ' '.join(text.split())
 
@@ -160,13 +247,17 @@ class ResponseBuilder:
     Construye respuestas dinámicas con personalización
     """
     
+    # Rango del delay humanizado en segundos (0 y 0 lo desactivan, p. ej. en benchmarks)
+    TYPING_DELAY_MIN = float(os.getenv("TYPING_DELAY_MIN", 1.5))
+    TYPING_DELAY_MAX = float(os.getenv("TYPING_DELAY_MAX", 3.0))
+    
     @staticmethod
     def typing_delay() -> float:
         """
         Retorna delay aleatorio para simular typing humano
         """
         import random
-        return random.uniform(1.5, 3.0)
+        return random.uniform(ResponseBuilder.TYPING_DELAY_MIN, ResponseBuilder.TYPING_DELAY_MAX)
     
     @staticmethod
     def format_error_retry(step: str, retry_count: int) -> str:
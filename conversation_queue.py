@@ -0,0 +1,377 @@
+import asyncio
+import heapq
+import threading
+import time
+import logging
+from collections import deque
+
+
+def _percentile(sorted_values, q):
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+def _split_turns(coalesce, number, items):
+    """
+    Aplica coalesce() a [(enqueued_at, item)].
+    Returns: (turnos, items a reencolar, mensajes fusionados)
+    """
+    if coalesce is None or len(items) < 2:
+        return items, [], 0
+
+    try:
+        turns, leftover = coalesce(number, [item for _, item in items])
+    except Exception as e:
+        logging.error(f"Error fusionando mensajes de {number}: {e}")
+        return items, [], 0
+
+    consumed = len(items) - len(leftover)
+    if len(turns) == consumed:
+        return [(items[i][0], turn) for i, turn in enumerate(turns)], items[consumed:], 0
+
+    # La latencia de un turno fusionado se mide desde el mensaje más antiguo
+    return [(items[0][0], turn) for turn in turns], items[consumed:], consumed - len(turns)
+
+
+def _latency_stats(stats, latencies):
+    if latencies:
+        stats["latency_p50"] = round(_percentile(latencies, 0.50), 4)
+        stats["latency_p95"] = round(_percentile(latencies, 0.95), 4)
+        stats["latency_max"] = round(latencies[-1], 4)
+    return stats
+
+
+class ConversationQueue:
+    """
+    Cola de procesamiento en segundo plano con orden garantizado por remitente.
+
+    Cada número tiene su propio buzón: un número nunca es atendido por dos
+    workers a la vez (sus mensajes se procesan en el orden en que llegaron),
+    pero números distintos se procesan en paralelo.
+
+    Debounce opcional: si should_debounce(number) es verdadero, el buzón
+    espera `debounce` segundos sin mensajes nuevos (máximo `max_debounce`
+    desde el primero) antes de entregarse, y coalesce(number, items) puede
+    fusionar los mensajes acumulados en un solo turno. Devuelve
+    (items_a_procesar, items_a_reencolar); los reencolados vuelven al frente
+    del buzón y se evalúan de nuevo con el estado ya actualizado.
+    """
+
+    def __init__(self, handler, workers=4, latency_samples=1000,
+                 debounce=0.0, max_debounce=None, should_debounce=None, coalesce=None):
+        self.handler = handler
+        self.num_workers = workers
+        self.debounce = debounce
+        self.max_debounce = max_debounce if max_debounce is not None else debounce * 3
+        self.should_debounce = should_debounce
+        self.coalesce = coalesce
+
+        self._cond = threading.Condition()
+        self._mailboxes = {}      # number -> deque[(enqueued_at, item)]
+        self._ready = deque()     # números con trabajo pendiente y sin worker
+        self._active = set()      # números en _ready, en espera o siendo procesados
+        self._delayed = []        # heap [(ready_at, number)] de buzones en debounce
+        self._ready_at = {}       # number -> ready_at vigente (las otras entradas del heap son viejas)
+        self._first_pending = {}  # number -> llegada del primer mensaje en debounce
+        self._running = True
+        self._threads = []
+
+        # Métricas
+        self._pending = 0
+        self._in_flight = 0
+        self._processed = 0
+        self._failed = 0
+        self._coalesced = 0
+        self._latencies = deque(maxlen=latency_samples)
+
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._worker_loop, name=f"conversation-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    # ==================== PRODUCTOR ====================
+
+    def submit(self, number, item):
+        """Encola un mensaje para el remitente indicado (no bloquea)"""
+        self.submit_batch(number, [item])
+
+    def submit_batch(self, number, items):
+        """Encola varios mensajes del mismo remitente de una vez, en orden"""
+        debounce = self._wants_debounce(number)
+
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("La cola de conversaciones está detenida")
+
+            mailbox = self._mailboxes.get(number)
+            if mailbox is None:
+                mailbox = self._mailboxes[number] = deque()
+            enqueued_at = time.monotonic()
+            mailbox.extend((enqueued_at, item) for item in items)
+            self._pending += len(items)
+
+            if number not in self._active:
+                self._active.add(number)
+                if debounce:
+                    self._schedule(number, enqueued_at)
+                else:
+                    self._ready.append(number)
+                    self._cond.notify()
+            elif number in self._ready_at:
+                # Sigue en debounce: cada mensaje nuevo reinicia la ventana
+                self._schedule(number, enqueued_at)
+
+    def _wants_debounce(self, number):
+        if self.debounce <= 0 or self.should_debounce is None:
+            return False
+        try:
+            return bool(self.should_debounce(number))
+        except Exception as e:
+            logging.error(f"Error evaluando debounce para {number}: {e}")
+            return False
+
+    def _schedule(self, number, last_arrival):
+        """Programa el buzón para cuando venza el debounce (con el lock tomado)"""
+        first = self._first_pending.setdefault(number, last_arrival)
+        ready_at = min(last_arrival + self.debounce, first + self.max_debounce)
+        self._ready_at[number] = ready_at
+        heapq.heappush(self._delayed, (ready_at, number))
+        self._cond.notify_all()
+
+    def _promote_due(self):
+        """Pasa a _ready los buzones cuyo debounce venció (con el lock tomado)"""
+        now = time.monotonic()
+        while self._delayed and (self._delayed[0][0] <= now or not self._running):
+            ready_at, number = heapq.heappop(self._delayed)
+            if self._ready_at.get(number) != ready_at:
+                continue
+            del self._ready_at[number]
+            self._first_pending.pop(number, None)
+            self._ready.append(number)
+
+    # ==================== WORKERS ====================
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                self._promote_due()
+                if self._ready:
+                    break
+                if not self._running and not self._delayed:
+                    return None, None
+                timeout = self._delayed[0][0] - time.monotonic() if self._delayed else None
+                self._cond.wait(timeout)
+
+            number = self._ready.popleft()
+            mailbox = self._mailboxes[number]
+            items = list(mailbox)
+            mailbox.clear()
+            self._pending -= len(items)
+            self._in_flight += len(items)
+            return number, items
+
+    def _release(self, number, requeue=()):
+        debounce = self._wants_debounce(number) if self._running else False
+
+        with self._cond:
+            mailbox = self._mailboxes[number]
+            if requeue:
+                mailbox.extendleft(reversed(requeue))
+                self._pending += len(requeue)
+
+            if mailbox:
+                # Quedan mensajes (reencolados o llegados mientras procesábamos)
+                if debounce:
+                    self._schedule(number, mailbox[-1][0])
+                else:
+                    self._ready.append(number)
+                    self._cond.notify()
+            else:
+                del self._mailboxes[number]
+                self._active.discard(number)
+                self._cond.notify_all()
+
+    def _split_turns(self, number, items):
+        turns, requeue, merged = _split_turns(self.coalesce, number, items)
+        if merged:
+            with self._cond:
+                self._coalesced += merged
+        return turns, requeue
+
+    def _worker_loop(self):
+        while True:
+            number, items = self._next_batch()
+            if number is None:
+                return
+
+            turns, requeue = self._split_turns(number, items)
+
+            for enqueued_at, item in turns:
+                try:
+                    self.handler(number, item)
+                    ok = True
+                except Exception as e:
+                    ok = False
+                    logging.error(f"Error procesando mensaje de {number}: {e}")
+
+                with self._cond:
+                    if ok:
+                        self._processed += 1
+                    else:
+                        self._failed += 1
+                    self._latencies.append(time.monotonic() - enqueued_at)
+
+            with self._cond:
+                self._in_flight -= len(items)
+            self._release(number, requeue)
+
+    # ==================== CONTROL ====================
+
+    def stop(self, timeout=10.0):
+        """Deja de aceptar mensajes y espera a que se vacíe la cola"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+            while self._active and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def stats(self):
+        """Profundidad de cola y latencia (espera + proceso) en segundos"""
+        with self._cond:
+            latencies = sorted(self._latencies)
+            stats = {
+                "workers": self.num_workers,
+                "depth": self._pending,
+                "senders_waiting": len(self._ready),
+                "senders_debouncing": len(self._ready_at),
+                "in_flight": self._in_flight,
+                "processed": self._processed,
+                "failed": self._failed,
+                "coalesced": self._coalesced,
+            }
+        return _latency_stats(stats, latencies)
+
+
+class AsyncConversationQueue:
+    """
+    Versión asyncio de ConversationQueue (mismo contrato de orden, debounce
+    y coalesce). Cada número con mensajes tiene una tarea que drena su buzón
+    en orden; `concurrency` limita cuántos turnos se procesan a la vez en
+    todo el proceso (el resto espera sin ocupar hilos).
+    handler debe ser una corrutina: await handler(number, item)
+    """
+
+    def __init__(self, handler, concurrency=100, latency_samples=1000,
+                 debounce=0.0, max_debounce=None, should_debounce=None, coalesce=None):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.debounce = debounce
+        self.max_debounce = max_debounce if max_debounce is not None else debounce * 3
+        self.should_debounce = should_debounce
+        self.coalesce = coalesce
+
+        self._mailboxes = {}      # number -> deque[(enqueued_at, item)]
+        self._tasks = {}          # number -> tarea que drena el buzón
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._running = True
+
+        # Métricas
+        self._pending = 0
+        self._in_flight = 0
+        self._processed = 0
+        self._failed = 0
+        self._coalesced = 0
+        self._latencies = deque(maxlen=latency_samples)
+
+    def submit_batch(self, number, items):
+        """Encola varios mensajes del mismo remitente (requiere event loop)"""
+        if not self._running:
+            raise RuntimeError("La cola de conversaciones está detenida")
+
+        mailbox = self._mailboxes.get(number)
+        if mailbox is None:
+            mailbox = self._mailboxes[number] = deque()
+        enqueued_at = time.monotonic()
+        mailbox.extend((enqueued_at, item) for item in items)
+        self._pending += len(items)
+
+        if number not in self._tasks:
+            self._tasks[number] = asyncio.get_running_loop().create_task(self._drain(number))
+
+    def _wants_debounce(self, number):
+        if not self._running or self.debounce <= 0 or self.should_debounce is None:
+            return False
+        try:
+            return bool(self.should_debounce(number))
+        except Exception as e:
+            logging.error(f"Error evaluando debounce para {number}: {e}")
+            return False
+
+    async def _wait_quiet(self, mailbox):
+        """Espera a que el remitente deje de escribir (o venza max_debounce)"""
+        first = mailbox[0][0]
+        while self._running:
+            ready_at = min(mailbox[-1][0] + self.debounce, first + self.max_debounce)
+            delay = ready_at - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def _drain(self, number):
+        mailbox = self._mailboxes[number]
+        try:
+            while mailbox:
+                if self._wants_debounce(number):
+                    await self._wait_quiet(mailbox)
+
+                items = list(mailbox)
+                mailbox.clear()
+                self._pending -= len(items)
+                self._in_flight += len(items)
+
+                turns, requeue, merged = _split_turns(self.coalesce, number, items)
+                self._coalesced += merged
+
+                for enqueued_at, item in turns:
+                    async with self._semaphore:
+                        try:
+                            await self.handler(number, item)
+                            self._processed += 1
+                        except Exception as e:
+                            self._failed += 1
+                            logging.error(f"Error procesando mensaje de {number}: {e}")
+                    self._latencies.append(time.monotonic() - enqueued_at)
+
+                self._in_flight -= len(items)
+                if requeue:
+                    # Vuelven al frente, delante de lo llegado mientras procesábamos
+                    mailbox.extendleft(reversed(requeue))
+                    self._pending += len(requeue)
+        finally:
+            del self._mailboxes[number]
+            del self._tasks[number]
+
+    async def stop(self, timeout=10.0):
+        """Deja de aceptar mensajes y espera a que se vacíe la cola"""
+        self._running = False
+        if self._tasks:
+            await asyncio.wait(list(self._tasks.values()), timeout=timeout)
+
+    def stats(self):
+        stats = {
+            "concurrency": self.concurrency,
+            "depth": self._pending,
+            "senders_active": len(self._tasks),
+            "in_flight": self._in_flight,
+            "processed": self._processed,
+            "failed": self._failed,
+            "coalesced": self._coalesced,
+        }
+        return _latency_stats(stats, sorted(self._latencies))
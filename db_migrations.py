@@ -0,0 +1,361 @@
+"""
+Migraciones versionadas del esquema de Neon (tablas + índices).
+
+Se aplican al iniciar la app (RUN_MIGRATIONS=1) o desde la línea de comandos:
+
+    python db_migrations.py upgrade   # aplica las pendientes
+    python db_migrations.py status    # lista aplicadas / pendientes
+    python db_migrations.py check     # EXPLAIN de las consultas calientes
+"""
+import os
+import sys
+import json
+import logging
+import psycopg2
+
+# Migraciones de esquema, en orden de versión. Cada una debe ser idempotente
+# (IF NOT EXISTS) porque bases creadas a mano ya pueden tener parte del esquema.
+MIGRATIONS = [
+    ("0000_baseline_schema", """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id SERIAL PRIMARY KEY,
+            phone_number VARCHAR(20) NOT NULL,
+            current_step VARCHAR(50) NOT NULL DEFAULT 'START',
+            status VARCHAR(20) NOT NULL DEFAULT 'IN_PROGRESS',
+            name VARCHAR(150),
+            dni_ruc VARCHAR(11),
+            location VARCHAR(150),
+            category VARCHAR(50),
+            model VARCHAR(100),
+            color VARCHAR(50),
+            preferred_call_time TEXT,
+            notes TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            completed_at TIMESTAMPTZ
+        );
+
+        CREATE TABLE IF NOT EXISTS messages (
+            id BIGSERIAL PRIMARY KEY,
+            conversation_id INTEGER REFERENCES conversations(id),
+            phone_number VARCHAR(20) NOT NULL,
+            message_type VARCHAR(10) NOT NULL,
+            content_type VARCHAR(20) NOT NULL DEFAULT 'text',
+            content TEXT,
+            intent VARCHAR(50),
+            timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS failed_validations (
+            id BIGSERIAL PRIMARY KEY,
+            phone_number VARCHAR(20) NOT NULL,
+            step VARCHAR(50) NOT NULL,
+            user_input TEXT,
+            expected_format TEXT,
+            retry_count INTEGER NOT NULL DEFAULT 1,
+            timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+
+        CREATE OR REPLACE FUNCTION set_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at = NOW();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS conversations_set_updated_at ON conversations;
+        CREATE TRIGGER conversations_set_updated_at
+            BEFORE UPDATE ON conversations
+            FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+    """),
+
+    ("0001_conversations_active_phone_unique", """
+        -- Cerrar conversaciones activas duplicadas: queda solo la más reciente por número
+        UPDATE conversations c
+        SET status = 'COMPLETED',
+            completed_at = COALESCE(c.completed_at, NOW()),
+            notes = 'Duplicado cerrado por migración 0001'
+        WHERE c.status != 'COMPLETED'
+        AND EXISTS (
+            SELECT 1 FROM conversations n
+            WHERE n.phone_number = c.phone_number
+            AND n.status != 'COMPLETED'
+            AND (n.created_at, n.id) > (c.created_at, c.id)
+        );
+
+        -- Una sola conversación no completada por número (base del upsert atómico)
+        CREATE UNIQUE INDEX IF NOT EXISTS conversations_active_phone_uidx
+            ON conversations (phone_number)
+            WHERE status != 'COMPLETED';
+    """),
+
+    ("0002_hot_query_indexes", """
+        -- Última conversación por número (log_message, get_conversation_summary)
+        CREATE INDEX IF NOT EXISTS conversations_phone_created_idx
+            ON conversations (phone_number, created_at DESC);
+
+        -- Historial por conversación, más reciente primero (get_conversation_history)
+        CREATE INDEX IF NOT EXISTS messages_conversation_timestamp_idx
+            ON messages (conversation_id, timestamp DESC);
+
+        -- Historial directo por número
+        CREATE INDEX IF NOT EXISTS messages_phone_timestamp_idx
+            ON messages (phone_number, timestamp DESC);
+
+        -- Reintentos recientes por número y paso (log_failed_validation)
+        CREATE INDEX IF NOT EXISTS failed_validations_phone_step_timestamp_idx
+            ON failed_validations (phone_number, step, timestamp DESC);
+    """),
+
+    ("0003_processed_messages", """
+        -- Idempotencia del webhook: un mensaje de WhatsApp se procesa una sola vez
+        CREATE TABLE IF NOT EXISTS processed_messages (
+            wa_message_id VARCHAR(128) PRIMARY KEY,
+            phone_number VARCHAR(20) NOT NULL,
+            received_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+
+        CREATE INDEX IF NOT EXISTS processed_messages_received_idx
+            ON processed_messages (received_at);
+    """),
+
+    ("0004_message_delivery_status", """
+        -- ID de WhatsApp y estado de entrega (callbacks "statuses" del webhook)
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS wa_message_id VARCHAR(128);
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS delivery_status VARCHAR(20);
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS status_updated_at TIMESTAMPTZ;
+
+        CREATE INDEX IF NOT EXISTS messages_wa_message_id_idx
+            ON messages (wa_message_id)
+            WHERE wa_message_id IS NOT NULL;
+    """),
+
+    ("0005_outbox", """
+        -- Mensajes salientes pendientes, confirmados junto con la transición de paso
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            phone_number VARCHAR(20) NOT NULL,
+            conversation_id INTEGER REFERENCES conversations(id),
+            payload JSONB NOT NULL,
+            status VARCHAR(10) NOT NULL DEFAULT 'PENDING',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            send_after TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            last_error TEXT,
+            wa_message_id VARCHAR(128),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            sent_at TIMESTAMPTZ
+        );
+
+        -- Reclamo de pendientes vencidos y "más antiguo pendiente por número"
+        CREATE INDEX IF NOT EXISTS outbox_pending_idx
+            ON outbox (send_after, id)
+            WHERE status = 'PENDING';
+        CREATE INDEX IF NOT EXISTS outbox_pending_phone_idx
+            ON outbox (phone_number, id)
+            WHERE status = 'PENDING';
+    """),
+
+    ("0006_analytics_rollups", """
+        -- Agregados diarios del embudo (analytics.py los refresca en forma incremental)
+        CREATE TABLE IF NOT EXISTS analytics_funnel_daily (
+            day DATE NOT NULL,
+            step VARCHAR(50) NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            conversations INTEGER NOT NULL,
+            PRIMARY KEY (day, step, status)
+        );
+
+        CREATE TABLE IF NOT EXISTS analytics_validation_daily (
+            day DATE NOT NULL,
+            step VARCHAR(50) NOT NULL,
+            failures INTEGER NOT NULL,
+            conversations INTEGER NOT NULL,
+            retries INTEGER NOT NULL,
+            max_retry INTEGER NOT NULL,
+            PRIMARY KEY (day, step)
+        );
+
+        CREATE TABLE IF NOT EXISTS analytics_completions_daily (
+            day DATE NOT NULL,
+            category VARCHAR(50) NOT NULL,
+            model VARCHAR(100) NOT NULL,
+            location VARCHAR(150) NOT NULL,
+            completions INTEGER NOT NULL,
+            leads INTEGER NOT NULL,
+            PRIMARY KEY (day, category, model, location)
+        );
+
+        -- High-water mark de cada fuente
+        CREATE TABLE IF NOT EXISTS analytics_state (
+            source VARCHAR(50) PRIMARY KEY,
+            high_water TIMESTAMPTZ NOT NULL,
+            refreshed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+
+        -- Filas modificadas desde el último refresco y recálculo por día
+        CREATE INDEX IF NOT EXISTS conversations_updated_idx
+            ON conversations (updated_at);
+        CREATE INDEX IF NOT EXISTS conversations_created_idx
+            ON conversations (created_at);
+        CREATE INDEX IF NOT EXISTS conversations_completed_idx
+            ON conversations (completed_at)
+            WHERE completed_at IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS failed_validations_timestamp_idx
+            ON failed_validations (timestamp);
+    """),
+
+    ("0007_messages_history_keyset", """
+        -- Paginación keyset del historial por número: (timestamp, id) desempata
+        -- mensajes del mismo instante (los lotes comparten NOW())
+        CREATE INDEX IF NOT EXISTS messages_phone_timestamp_id_idx
+            ON messages (phone_number, timestamp DESC, id DESC);
+
+        -- Prefijo del anterior, ya no aporta
+        DROP INDEX IF EXISTS messages_phone_timestamp_idx;
+    """),
+
+    ("0008_conversations_free_text", """
+        -- Respuestas libres del cliente (nombre, ciudad, modelo, color): los
+        -- parsers aceptan cualquier largo y un VARCHAR excedido hacía fallar
+        -- la transición (y su respuesta en el outbox). varchar → text no
+        -- reescribe la tabla
+        ALTER TABLE conversations
+            ALTER COLUMN name TYPE TEXT,
+            ALTER COLUMN location TYPE TEXT,
+            ALTER COLUMN model TYPE TEXT,
+            ALTER COLUMN color TYPE TEXT;
+    """),
+
+    ("0009_drop_unused_indexes", """
+        -- El historial ya no se pagina por conversación: solo costaba en cada INSERT
+        DROP INDEX IF EXISTS messages_conversation_timestamp_idx;
+
+        -- Los reintentos se cuentan en memoria (RetryCounter) y ya no se
+        -- consultan por número y paso; la analítica usa failed_validations_timestamp_idx
+        DROP INDEX IF EXISTS failed_validations_phone_step_timestamp_idx;
+    """),
+]
+
+# Evita que dos workers apliquen migraciones a la vez
+MIGRATION_LOCK_ID = 724001
+
+# Consultas calientes de NeonDB que deben resolverse por índice
+HOT_QUERIES = {
+    "get_or_create_conversation": ("""
+        SELECT * FROM conversations
+        WHERE phone_number = %s AND status != 'COMPLETED'
+    """, ("51999999999",)),
+    "log_message (conversation_id)": ("""
+        SELECT id FROM conversations WHERE phone_number = %s
+        ORDER BY created_at DESC LIMIT 1
+    """, ("51999999999",)),
+    "get_conversation_history": ("""
+        SELECT * FROM messages
+        WHERE phone_number = %s AND (timestamp, id) < (%s, %s)
+        ORDER BY timestamp DESC, id DESC LIMIT 50
+    """, ("51999999999", "infinity", 0)),
+}
+
+
+def _ensure_version_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version VARCHAR(100) PRIMARY KEY,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+
+
+def applied_versions(conn):
+    with conn.cursor() as cursor:
+        _ensure_version_table(cursor)
+        cursor.execute("SELECT version FROM schema_migrations")
+        return {row[0] for row in cursor.fetchall()}
+
+
+def apply_migrations(conn):
+    """
+    Aplica las migraciones pendientes en una sola transacción, serializada
+    entre workers/nodos con un advisory lock. Returns: versiones aplicadas
+    """
+    applied = []
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+            _ensure_version_table(cursor)
+            cursor.execute("SELECT version FROM schema_migrations")
+            done = {row[0] for row in cursor.fetchall()}
+
+            for version, sql in MIGRATIONS:
+                if version in done:
+                    continue
+                cursor.execute(sql)
+                cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (version,))
+                applied.append(version)
+                logging.info(f"Migración aplicada: {version}")
+        conn.commit()
+        return applied
+    except Exception as e:
+        conn.rollback()
+        logging.error(f"❌ Error aplicando migraciones: {e}")
+        raise
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def check_hot_queries(conn):
+    """
+    Ejecuta EXPLAIN de cada consulta caliente y verifica que use índices.
+
+    Con tablas pequeñas Postgres prefiere un Seq Scan aunque exista el índice,
+    por eso se desactiva enable_seqscan: si el plan igual hace Seq Scan es que
+    no hay índice utilizable. Returns: {consulta: (ok, [tipos de nodo])}
+    """
+    results = {}
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            for name, (sql, params) in HOT_QUERIES.items():
+                cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                nodes = [node["Node Type"] for node in _plan_nodes(plan[0]["Plan"])]
+                results[name] = ("Seq Scan" not in nodes, nodes)
+    finally:
+        conn.rollback()
+    return results
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else "upgrade"
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        if command == "upgrade":
+            applied = apply_migrations(conn)
+            print(f"Migraciones aplicadas: {', '.join(applied) or 'ninguna (al día)'}")
+        elif command == "status":
+            done = applied_versions(conn)
+            conn.commit()
+            for version, _ in MIGRATIONS:
+                print(f"{'[x]' if version in done else '[ ]'} {version}")
+        elif command == "check":
+            results = check_hot_queries(conn)
+            for name, (ok, nodes) in results.items():
+                print(f"{'OK  ' if ok else 'FAIL'} {name}: {' > '.join(nodes)}")
+            return 0 if all(ok for ok, _ in results.values()) else 1
+        else:
+            print(__doc__)
+            return 2
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv))
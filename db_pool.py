@@ -0,0 +1,214 @@
+import os
+import threading
+import time
+import logging
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+# Clase de advisory lock (forma de dos enteros) para serializar turnos por número
+SENDER_LOCK_CLASS = 724002
+
+
+def pool_size_per_worker(max_connections, processes=1, reserved=10, minimum=2):
+    """
+    Reparte el límite de conexiones de Neon entre todos los procesos de la app
+    (workers de gunicorn × nodos), dejando `reserved` libres para migraciones,
+    consola y reportes.
+    """
+    available = max(0, max_connections - reserved)
+    return max(minimum, available // max(1, processes))
+
+
+def app_processes():
+    """Procesos de la app que comparten Neon y el número de WhatsApp (workers × nodos)"""
+    return int(os.getenv("WEB_CONCURRENCY", 1)) * int(os.getenv("APP_NODES", 1))
+
+
+def pool_size_from_env(minimum=2):
+    """
+    DB_POOL_MAX explícito, o la parte de este proceso del límite de Neon.
+    Nunca menos que `minimum`: las conexiones que este proceso puede tener
+    tomadas a la vez; con menos, los hilos se bloquean esperando al pool.
+    """
+    if os.getenv("DB_POOL_MAX"):
+        size = int(os.getenv("DB_POOL_MAX"))
+    else:
+        size = pool_size_per_worker(
+            int(os.getenv("NEON_MAX_CONNECTIONS", 100)),
+            processes=app_processes(),
+            reserved=int(os.getenv("NEON_RESERVED_CONNECTIONS", 10))
+        )
+    if size < minimum:
+        logging.warning(f"⚠️ Pool de {size} conexiones menor que el mínimo de este proceso ({minimum}); se usa {minimum}")
+        size = minimum
+    return size
+
+
+class HealthCheckedPool:
+    """
+    Pool de conexiones thread-safe para Neon.
+
+    A diferencia de SimpleConnectionPool:
+    - getconn() espera como máximo `checkout_timeout` segundos si el pool está lleno
+    - las conexiones inactivas más de `ping_after` segundos se validan con SELECT 1
+      antes de entregarlas (Neon corta las conexiones ociosas)
+    - las conexiones con más de `max_lifetime` segundos se reciclan
+    - cada conexión nueva fija su statement_timeout
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, checkout_timeout=5.0,
+                 ping_after=30.0, max_lifetime=1800.0, statement_timeout_ms=15000):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.ping_after = ping_after
+        self.max_lifetime = max_lifetime
+        self.statement_timeout_ms = statement_timeout_ms
+
+        self._cond = threading.Condition()
+        self._idle = []          # [(conn, created_at, last_used)], LIFO
+        self._in_use = {}        # id(conn) -> created_at
+        self._total = 0
+        self._closed = False
+
+        # Estadísticas
+        self._checkouts = 0
+        self._checkout_failures = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._recycled = 0
+
+        for _ in range(minconn):
+            conn = self._connect()
+            with self._cond:
+                self._total += 1
+                self._idle.append((conn, time.monotonic(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        if self.statement_timeout_ms:
+            with conn.cursor() as cursor:
+                cursor.execute("SET statement_timeout = %s", (self.statement_timeout_ms,))
+            conn.commit()
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._total -= 1
+            self._recycled += 1
+            self._cond.notify()
+
+    def _is_healthy(self, conn, created_at, last_used):
+        now = time.monotonic()
+        if conn.closed or now - created_at > self.max_lifetime:
+            return False
+        if now - last_used > self.ping_after:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except Exception:
+                return False
+        return True
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+
+        while True:
+            candidate = None
+            create = False
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolError("connection pool is closed")
+                    if self._idle:
+                        candidate = self._idle.pop()
+                        break
+                    if self._total < self.maxconn:
+                        self._total += 1
+                        create = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._checkout_failures += 1
+                        raise PoolError(
+                            f"Sin conexiones libres tras {self.checkout_timeout}s ({self.maxconn} en uso)"
+                        )
+                    self._cond.wait(remaining)
+
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._total -= 1
+                        self._checkout_failures += 1
+                        self._cond.notify()
+                    raise
+                created_at = time.monotonic()
+            else:
+                conn, created_at, last_used = candidate
+                if not self._is_healthy(conn, created_at, last_used):
+                    logging.info("Conexión a Neon caducada, reciclando")
+                    self._discard(conn)
+                    continue
+
+            waited = time.monotonic() - started
+            with self._cond:
+                self._in_use[id(conn)] = created_at
+                self._checkouts += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            return conn
+
+    def putconn(self, conn, close=False):
+        with self._cond:
+            created_at = self._in_use.pop(id(conn), None)
+        if created_at is None:
+            raise PoolError("trying to put unkeyed connection")
+
+        if not close and not conn.closed:
+            try:
+                # Nunca devolver una conexión con una transacción a medias
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                close = True
+        else:
+            close = True
+
+        if close or self._closed:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "max": self.maxconn,
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "checkouts": self._checkouts,
+                "checkout_failures": self._checkout_failures,
+                "wait_avg_ms": round(self._wait_total / self._checkouts * 1000, 2) if self._checkouts else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 2),
+                "recycled": self._recycled
+            }
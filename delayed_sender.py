@@ -0,0 +1,104 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+import logging
+
+
+class DelayScheduler:
+    """
+    Cola de retardos basada en heap para los envíos con "typing" humanizado.
+
+    En lugar de dormir un hilo por mensaje, cada envío se guarda con su hora
+    de vencimiento; un único hilo temporizador los libera al vencer y los
+    entrega a un hilo de despacho elegido por destinatario, así el orden por
+    destinatario se mantiene y miles de retardos pendientes solo cuestan memoria.
+    """
+
+    def __init__(self, dispatch_threads=4):
+        self._heap = []
+        self._seq = itertools.count()
+        self._last_due = {}       # key -> vencimiento del último envío programado
+        self._cond = threading.Condition()
+        self._running = True
+
+        self._timer = threading.Thread(target=self._timer_loop, name="delay-timer", daemon=True)
+        self._timer.start()
+
+        self._shards = []
+        for i in range(dispatch_threads):
+            shard = queue.Queue()
+            thread = threading.Thread(
+                target=self._dispatch_loop, args=(shard,), name=f"delay-dispatch-{i}", daemon=True
+            )
+            thread.start()
+            self._shards.append((shard, thread))
+
+    def schedule(self, key, delay, callback, *args):
+        """
+        Programa callback(*args) para dentro de `delay` segundos, contados
+        desde el último envío pendiente de la misma key (como si se escribiera
+        un mensaje detrás de otro).
+        """
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("El scheduler de envíos está detenido")
+
+            now = time.monotonic()
+            due = max(now, self._last_due.get(key, now)) + delay
+            self._last_due[key] = due
+            heapq.heappush(self._heap, (due, next(self._seq), key, callback, args))
+            # Solo despertar al temporizador si este es el nuevo más próximo
+            if self._heap[0][0] == due:
+                self._cond.notify()
+        return due
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _timer_loop(self):
+        while True:
+            with self._cond:
+                while self._running and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+
+                if not self._running and not self._heap:
+                    break
+
+                due, _, key, callback, args = heapq.heappop(self._heap)
+                if self._last_due.get(key) == due:
+                    del self._last_due[key]
+
+            shard, _ = self._shards[hash(key) % len(self._shards)]
+            shard.put((key, callback, args))
+
+        for shard, _ in self._shards:
+            shard.put(None)
+
+    def _dispatch_loop(self, shard):
+        while True:
+            task = shard.get()
+            if task is None:
+                return
+            key, callback, args = task
+            try:
+                callback(*args)
+            except Exception as e:
+                logging.error(f"Error en envío programado para {key}: {e}")
+
+    def stop(self, timeout=10.0):
+        """
+        Deja de aceptar envíos; los ya programados se despachan de inmediato
+        (sin esperar su retardo) para no perder respuestas al apagar.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+        self._timer.join(max(0.0, deadline - time.monotonic()))
+        for _, thread in self._shards:
+            thread.join(max(0.0, deadline - time.monotonic()))
@@ -0,0 +1,172 @@
+"""
+Definición declarativa de los flujos conversacionales.
+
+Solo datos: conversation_flow.FlowEngine los compila una vez al importar.
+Cada paso indica el prompt que se envía al entrar, el validador que
+interpreta la respuesta (ver conversation_flow.PARSERS) y el paso siguiente.
+Para agregar un flujo (p. ej. postventa) basta con sumar sus pasos a FLOWS
+y apuntar a ellos desde un `next` con casos; el motor no cambia.
+
+Claves de un paso:
+    prompt     mensaje al entrar al paso (text/buttons/list/location/by_field);
+               los textos admiten {campos} de la conversación y {greeting}
+    parse      validador de la respuesta; sin parse el paso acepta cualquier texto
+    expected   formato esperado, para failed_validations
+    next       paso siguiente, o {"by": campo, "cases": {valor: paso}, "default": paso}
+    reprompt   en un error, reenviar el prompt con el aviso al inicio
+    coalesce   el cliente suele partir esta respuesta en varios mensajes
+    completes  al salir del paso la conversación queda COMPLETED
+    log        línea de log al completar el paso ({number})
+    reply      respuesta fija a cualquier mensaje (pasos terminales)
+    restart_on / restart_to   palabras que reinician el flujo y paso destino
+"""
+
+WELCOME = (
+    "👋 Te saluda el *Asistente Virtual* de *Gabriela Paucar* - 👩🏻‍💼 Asesora Comercial de "
+    "ISUZU CAMIONES AUTOMOTRIZ CISNE.\n📍 SEDE LIMA.\n\nPara atenderte mejor, por favor indícame: "
+    "*¿Cuál es tu nombre y apellido?*"
+)
+
+TRUCK_MODELS = [
+    {"id": "mod_1", "title": "FVR 10ton", "description": "Ideal para carga pesada"},
+    {"id": "mod_2", "title": "NLR 3TON", "description": "Urbano y versátil"},
+    {"id": "mod_3", "title": "NPS 4x4", "description": "Todo terreno"},
+]
+
+PICKUP_MODELS = [
+    {"id": "mod_4", "title": "Chevrolet Captiva", "description": "SUV Familiar"},
+    {"id": "mod_5", "title": "Subaru XL", "description": "Aventura y confort"},
+]
+
+# Cotización de unidades nuevas (camiones y camionetas)
+QUOTE_FLOW = {
+    "START": {
+        "next": "WAITING_NAME",
+    },
+    "WAITING_NAME": {
+        "prompt": {"type": "text", "body": WELCOME},
+        "parse": "full_name",
+        "expected": "Nombre y Apellido",
+        "coalesce": True,
+        "next": "WAITING_DNI_LOC",
+    },
+    "WAITING_DNI_LOC": {
+        "prompt": {
+            "type": "text",
+            "body": "{greeting} estimado *{name}*. Un gusto saludarte.\n\nPara continuar, por favor bríndame "
+                    "tu *DNI o RUC* y desde qué *Departamento/Provincia* nos escribes.\n\n"
+                    "_Ejemplo: 10283749, Huancayo_",
+        },
+        "parse": "dni_location",
+        "expected": "DNI/RUC + Ciudad",
+        "coalesce": True,
+        "next": "WAITING_CATEGORY",
+    },
+    "WAITING_CATEGORY": {
+        "prompt": {
+            "type": "buttons",
+            "body": "🚘 *Tipo de unidad*\n\n¿En qué tipo de unidad estás interesado?",
+            "buttons": ["Camión Isuzu", "Camionetas"],
+        },
+        "parse": "category",
+        "expected": "Camión o Camioneta",
+        "reprompt": True,
+        "next": "WAITING_MODEL",
+    },
+    "WAITING_MODEL": {
+        "prompt": {
+            "type": "by_field",
+            "field": "category",
+            "cases": {
+                "Camión Isuzu": {
+                    "type": "list",
+                    "header": "Modelos Disponibles",
+                    "body": "Excelente elección. Isuzu es líder en camiones. ¿Qué modelo buscas?",
+                    "options": TRUCK_MODELS,
+                    "button": "Ver Modelos",
+                },
+                "Camionetas": {
+                    "type": "list",
+                    "header": "Modelos Disponibles",
+                    "body": "¿Qué camioneta se ajusta a tus necesidades?",
+                    "options": PICKUP_MODELS,
+                    "button": "Ver Modelos",
+                },
+            },
+        },
+        "parse": "model",
+        "next": "WAITING_COLOR",
+    },
+    "WAITING_COLOR": {
+        "prompt": {
+            "type": "buttons",
+            "body": "Perfecto, el *{model}* es una gran máquina.\n¿Tienes algún color de preferencia?",
+            "buttons": ["Blanco", "Rojo", "Azul"],
+        },
+        "parse": "color",
+        "next": "WAITING_CALL_TIME",
+    },
+    "WAITING_CALL_TIME": {
+        "prompt": {
+            "type": "text",
+            "body": "Gracias *{name}*. Tengo registrado tu interés en un *{model}* color {color}.\n\n"
+                    "📞 *¿A qué hora prefieres que la asesora Gabriela te llame?*\n\n"
+                    "_Ejemplo: Mañana 10am, Hoy 3pm, etc._",
+        },
+        "parse": "call_time",
+        "completes": True,
+        "log": "✅ Lead completado: {number}",
+        "next": "FINISHED",
+    },
+    "FINISHED": {
+        "prompt": {
+            "type": "text",
+            "body": "✅ ¡Perfecto! La asesora *Gabriela Paucar* se comunicará contigo en el horario indicado.\n\n"
+                    "🙏 Muchas gracias por contactar a *Isuzu Automotriz Cisne*.\n\n"
+                    "_Si necesitas algo más, escríbeme cuando quieras._",
+        },
+        "reply": {
+            "type": "text",
+            "body": "Tu solicitud ya fue registrada. La asesora Gabriela se comunicará contigo pronto.\n\n"
+                    "¿Deseas hacer *otra cotización*? Responde *SI* para comenzar de nuevo.",
+        },
+        "restart_on": ["si", "sí", "yes", "ok"],
+        "restart_to": "START",
+    },
+    # La asesora atiende por fuera; el bot no responde
+    "EN_ATENCION_HUMANA": {},
+}
+
+FLOWS = {
+    "cotizacion": QUOTE_FLOW,
+}
+
+# Intenciones globales: se atienden en cualquier paso, antes del flujo.
+# Las que no figuran aquí (p. ej. 'ayuda') siguen al paso actual.
+GLOBAL_INTENTS = {
+    "ubicacion": {
+        "messages": [
+            {"type": "text", "body": "📍 Nuestra sede está en:\n\n*ISUZU CAMIONES AUTOMOTRIZ CISNE*"},
+            {"type": "location"},
+            {"type": "text", "body": "¿Deseas continuar con la cotización? Responde *SI* para continuar."},
+        ],
+    },
+    "hablar_humano": {
+        "messages": [
+            {"type": "text", "body": "🙋‍♀️ Entendido. En un momento la asesora *Gabriela Paucar* se comunicará "
+                                     "contigo personalmente.\n\n📞 También puedes llamarnos directamente al "
+                                     "*01-XXX-XXXX*"},
+        ],
+        "next": "EN_ATENCION_HUMANA",
+        "set": {"status": "HUMAN_HANDOFF", "notes": "Cliente solicitó atención humana"},
+        # TODO: Notificación Telegram deshabilitada por ahora
+        "log": "HANDOFF solicitado por {number}",
+    },
+    "salir": {
+        "messages": [
+            {"type": "text", "body": "Entendido. Si cambias de opinión, escríbenos cuando quieras. ¡Hasta pronto! 👋"},
+        ],
+        "next": "FINISHED",
+        "completes": True,
+    },
+}
@@ -3,12 +3,68 @@ import os
 # Leer el puerto de la variable de entorno PORT
 port = os.getenv("PORT", "8080")
 
+# APP_MODE=async: webhook aiohttp + asyncpg en un event loop (async_app.py)
+ASYNC_MODE = os.getenv("APP_MODE", "sync") == "async"
+
 # Configuración de gunicorn
 bind = f"0.0.0.0:{port}"
-workers = 1
-worker_class = "sync"
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+# Cada worker importa la app después del fork: pools, hilos y sesiones HTTP
+# son propios de cada proceso (nunca compartir sockets heredados del master)
+preload_app = False
+
+# Varias instancias (workers × APP_NODES réplicas detrás del balanceador): es un
+# perfil de consistencia y redundancia, no de rendimiento. La concurrencia de un
+# proceso la dan los hilos gthread y QUEUE_WORKERS; más workers solo suman
+# throughput con núcleos libres (en 1 vCPU bajó de ~160 a 66–97 msg/s con 2–4
+# workers, benchmarks/load_test.py) y el escalado en varios núcleos no está medido
+os.environ["WEB_CONCURRENCY"] = str(workers)
+if workers > (os.cpu_count() or 1):
+    print(f"⚠️ WEB_CONCURRENCY={workers} supera los {os.cpu_count()} núcleos: los workers "
+          f"compiten por la CPU y el throughput baja")
+if workers * int(os.getenv("APP_NODES", 1)) > 1:
+    # El modo async envía directo desde cada proceso (sin outbox compartido):
+    # con varias instancias las respuestas de un número podrían desordenarse
+    if ASYNC_MODE:
+        raise SystemExit("APP_MODE=async admite una sola instancia (WEB_CONCURRENCY=1, APP_NODES=1); "
+                         "para varias instancias use el modo sync")
+    # Turnos de un mismo número serializados con advisory locks en Postgres y
+    # envíos ordenados por número desde el outbox compartido
+    os.environ.setdefault("SENDER_LOCKS", "1")
+    os.environ.setdefault("OUTBOX_ENABLED", "1")
+
+if ASYNC_MODE:
+    wsgi_app = "async_app:create_app"
+    worker_class = "aiohttp.GunicornWebWorker"
+else:
+    wsgi_app = "app:app"
+    # gthread: las descargas en streaming (/advisor/leads, historial con
+    # ?stream=1) ocupan un hilo y el webhook sigue atendiéndose en los demás.
+    # Con el worker "sync" una exportación larga bloquea el proceso y, pasado
+    # `timeout`, el arbiter lo mata con los mensajes aceptados aún en memoria
+    worker_class = "gthread"
+    threads = int(os.getenv("GUNICORN_THREADS", 4))
+    os.environ["GUNICORN_THREADS"] = str(threads)
+
+# Segundos sin latido del worker antes de reiniciarlo. Con gthread/aiohttp el
+# latido no depende de la duración de las requests, así que un streaming largo
+# no lo dispara; solo detecta workers colgados
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+# Al reiniciar/apagar: tiempo para drenar colas y outbox (worker_exit usa hasta ~30s)
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 40))
 accesslog = "-"
 errorlog = "-"
 loglevel = "info"
 
-print(f"Gunicorn configurado para escuchar en: {bind}")
\ No newline at end of file
+print(f"Gunicorn configurado para escuchar en: {bind} "
+      f"({'async' if ASYNC_MODE else f'sync, {threads} hilos'}, {workers} workers, timeout {timeout}s)")
+
+def worker_exit(server, worker):
+    if ASYNC_MODE:
+        return  # async_app drena la cola en on_shutdown
+    # Terminar de procesar los mensajes ya aceptados antes de salir
+    from app import conversation_queue, delayed_sender, outbox_worker, db
+    conversation_queue.stop(timeout=float(os.getenv("QUEUE_DRAIN_TIMEOUT", 20)))
+    delayed_sender.stop(timeout=5)
+    outbox_worker.stop(timeout=5)
+    db.message_writer.close()
\ No newline at end of file
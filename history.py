@@ -0,0 +1,67 @@
+"""
+Historial de mensajes para la asesora: paginación keyset sobre
+(timestamp, id), más reciente primero.
+
+El cursor de página es opaco para el cliente: base64 URL-safe, sin relleno,
+de "<microsegundos epoch>.<id>" del último mensaje entregado, así viaja en
+?before= sin escapar. Cada página es una consulta corta por índice,
+sin OFFSET: pedir la página 100 cuesta lo mismo que la primera.
+"""
+import base64
+import hmac
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+COLUMNS = ("id", "conversation_id", "message_type", "content_type", "content",
+           "intent", "wa_message_id", "delivery_status", "timestamp")
+
+
+def encode_cursor(message):
+    micros = (message["timestamp"] - EPOCH) // timedelta(microseconds=1)
+    raw = f"{micros}.{message['id']}".encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def decode_cursor(value):
+    """Returns: (timestamp, id) o None. Lanza ValueError si el cursor no es válido"""
+    if not value:
+        return None
+    raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)).decode()
+    micros, message_id = raw.split(".")
+    return EPOCH + timedelta(microseconds=int(micros)), int(message_id)
+
+
+def page_size(value, default=DEFAULT_PAGE_SIZE):
+    """Tamaño de página pedido, acotado a 1..MAX_PAGE_SIZE"""
+    return max(1, min(int(value), MAX_PAGE_SIZE)) if value else default
+
+
+def serialize(message):
+    """Fila → dict apto para JSON"""
+    row = dict(message)
+    row["timestamp"] = row["timestamp"].isoformat()
+    return row
+
+
+def advisor_authorized(authorization):
+    """Header Authorization: Bearer <ADVISOR_TOKEN>. Sin ADVISOR_TOKEN configurado, nadie accede"""
+    token = os.getenv("ADVISOR_TOKEN")
+    if not token or not authorization or not authorization.startswith("Bearer "):
+        return False
+    return hmac.compare_digest(authorization[len("Bearer "):].encode(), token.encode())
+
+
+def ndjson_line(message):
+    return (json.dumps(serialize(message), ensure_ascii=False) + "\n").encode()
+
+
+def ndjson(messages):
+    """Filas → líneas NDJSON (bytes), para respuestas en streaming"""
+    for message in messages:
+        yield ndjson_line(message)
@@ -0,0 +1,44 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class SeenMessages:
+    """
+    Conjunto acotado de IDs de mensajes de WhatsApp ya recibidos.
+
+    Primer filtro contra reenvíos de Meta: O(1) y sin tocar la BD. Es LRU
+    con TTL, así que solo cubre reenvíos recientes dentro de este proceso;
+    la tabla processed_messages es la garantía durable.
+    """
+
+    def __init__(self, max_entries=50000, ttl=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()   # message_id -> expires_at
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def add(self, message_id):
+        """Returns: True si el ID es nuevo, False si ya se había visto"""
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._entries.get(message_id)
+            if expires_at is not None and expires_at > now:
+                self.duplicates += 1
+                return False
+
+            self._entries[message_id] = now + self.ttl
+            self._entries.move_to_end(message_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return True
+
+    def discard(self, message_id):
+        """Olvida un ID (p. ej. si no se pudo encolar y Meta debe reintentar)"""
+        with self._lock:
+            self._entries.pop(message_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "duplicates": self.duplicates}
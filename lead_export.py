@@ -0,0 +1,232 @@
+"""
+Exportación masiva de leads (COMPLETED y HUMAN_HANDOFF) a CSV o Parquet.
+
+Lee con un cursor con nombre (server-side) en lotes de tamaño fijo y escribe
+cada lote apenas llega: la memoria no crece con el número de filas. Usa una
+conexión propia de solo lectura (EXPORT_DATABASE_URL o DATABASE_URL), fuera
+del pool del webhook, igual que analytics.py.
+
+    python lead_export.py leads.csv [--since 2026-01-01] [--until 2026-02-01]
+    python lead_export.py leads.parquet --format parquet      # requiere pyarrow
+    python lead_export.py leads.csv --state export_state.json # solo lo nuevo
+
+Con --state la exportación es incremental: arranca después de la marca
+(updated_at, id) de la última fila exportada y la actualiza solo cuando el
+archivo quedó completo. Así también salen los leads viejos que se completan
+(o cambian) después, aunque su id sea menor. El endpoint /advisor/leads
+entrega el mismo CSV en streaming (?after_updated_at=&after_id= con los
+valores de la última fila recibida). El endpoint necesita un worker con
+hilos (gthread, el de gunicorn.conf.py) para no bloquear el webhook; para
+volcados grandes conviene este CLI.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import logging
+from datetime import date, datetime, timezone
+import psycopg2
+
+COLUMNS = ("id", "phone_number", "name", "dni_ruc", "location", "category", "model",
+           "color", "preferred_call_time", "status", "created_at", "completed_at", "updated_at")
+
+EXPORT_SQL = f"""
+    SELECT {', '.join(COLUMNS)}
+    FROM conversations
+    WHERE status IN ('COMPLETED', 'HUMAN_HANDOFF')
+    AND (updated_at, id) > (%(after_updated_at)s, %(after_id)s)
+    AND updated_at <= NOW() - make_interval(secs => %(lag)s)
+    AND created_at >= %(since)s AND created_at < %(until)s
+    ORDER BY updated_at, id
+"""
+
+BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 2000))
+
+# Igual que en analytics.py: una transacción en curso puede confirmar filas con
+# updated_at anterior a su commit, así que la marca se queda LAG segundos atrás
+LAG_SECONDS = float(os.getenv("EXPORT_LAG_SECONDS", 60))
+
+NO_MARK = ("-infinity", 0)
+
+# Fechas del filtro y columnas *_at en hora de Perú
+TIMEZONE = os.getenv("EXPORT_TZ", "America/Lima")
+
+
+def connect():
+    """Conexión dedicada y de solo lectura, visible en pg_stat_activity"""
+    conn = psycopg2.connect(
+        os.getenv("EXPORT_DATABASE_URL") or os.environ["DATABASE_URL"],
+        application_name="whatsapp-bot-export"
+    )
+    with conn.cursor() as cursor:
+        cursor.execute("SET TIME ZONE %s", (TIMEZONE,))
+    conn.commit()
+    conn.set_session(readonly=True)
+    return conn
+
+
+def parse_mark(updated_at, row_id):
+    """Marca (updated_at, id) desde texto; sin updated_at no hay marca. Lanza ValueError"""
+    if not updated_at:
+        if row_id:
+            raise ValueError("after_id requiere after_updated_at")
+        return None
+    return datetime.fromisoformat(updated_at), int(row_id or 0)
+
+
+def parse_range(args):
+    """since/until (AAAA-MM-DD) y marca after_updated_at/after_id de una query string. Lanza ValueError"""
+    since, until = (date.fromisoformat(args[key]) if args.get(key) else None for key in ("since", "until"))
+    return since, until, parse_mark(args.get("after_updated_at"), args.get("after_id"))
+
+
+def iter_batches(conn, since=None, until=None, after=None, batch_size=BATCH_SIZE):
+    """Lotes de filas (tuplas en el orden de COLUMNS) ordenados por (updated_at, id)"""
+    after_updated_at, after_id = after or NO_MARK
+    params = {
+        "after_updated_at": after_updated_at,
+        "after_id": after_id,
+        "lag": LAG_SECONDS,
+        "since": since or "-infinity",
+        "until": until or "infinity",
+    }
+    try:
+        # Cursor con nombre: las filas quedan en el servidor y llegan de a batch_size
+        with conn.cursor(name="lead_export") as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(EXPORT_SQL, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+    finally:
+        conn.rollback()
+
+
+def _csv_value(value):
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+
+def csv_chunks(batches, progress=None):
+    """
+    CSV en trozos (bytes), uno por lote. Empieza con BOM para que Excel
+    respete las tildes. progress(rows) se llama con cada lote escrito.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(COLUMNS)
+    for rows in batches:
+        writer.writerows([_csv_value(value) for value in row] for row in rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+        if progress:
+            progress(rows)
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def write_parquet(batches, path, progress=None):
+    """Parquet columnar: un row group por lote"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("El formato parquet requiere pyarrow (pip install pyarrow)")
+
+    timestamp = pa.timestamp("us", tz="UTC")
+    schema = pa.schema([
+        (column, pa.int64() if column == "id" else timestamp if column.endswith("_at") else pa.string())
+        for column in COLUMNS
+    ])
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in batches:
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema
+            ))
+            if progress:
+                progress(rows)
+
+
+def load_state(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path, state):
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def export(conn, output, fmt="csv", since=None, until=None, after=None, batch_size=BATCH_SIZE):
+    """
+    Escribe el archivo completo (vía output.part y rename, así un corte no
+    deja un archivo a medias). Returns: (filas exportadas, marca (updated_at, id) de la última fila)
+    """
+    exported = {"rows": 0, "mark": after}
+
+    def progress(rows):
+        exported["rows"] += len(rows)
+        exported["mark"] = (rows[-1][COLUMNS.index("updated_at")], rows[-1][0])
+
+    batches = iter_batches(conn, since, until, after, batch_size)
+    partial = output + ".part"
+    if fmt == "parquet":
+        write_parquet(batches, partial, progress)
+    else:
+        with open(partial, "wb") as f:
+            for chunk in csv_chunks(batches, progress):
+                f.write(chunk)
+    os.replace(partial, output)
+    return exported["rows"], exported["mark"]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("output")
+    parser.add_argument("--format", choices=("csv", "parquet"), default="csv")
+    parser.add_argument("--since", type=date.fromisoformat, help="creadas desde (AAAA-MM-DD)")
+    parser.add_argument("--until", type=date.fromisoformat, help="creadas antes de (AAAA-MM-DD)")
+    parser.add_argument("--after-updated-at", help="exportar solo filas posteriores a esta marca (ISO 8601)")
+    parser.add_argument("--after-id", help="desempate por id dentro del mismo updated_at")
+    parser.add_argument("--state", help="archivo JSON con la marca de la última fila exportada")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv[1:])
+
+    try:
+        after = parse_mark(args.after_updated_at, args.after_id)
+    except ValueError as e:
+        parser.error(str(e))
+    if after is None:
+        state = load_state(args.state)
+        # Un estado viejo con solo last_id no sirve de marca: se exporta todo una vez
+        after = parse_mark(state.get("updated_at"), state.get("last_id"))
+
+    conn = connect()
+    try:
+        rows, mark = export(conn, args.output, args.format, args.since, args.until, after, args.batch_size)
+    finally:
+        conn.close()
+
+    print(f"Leads exportados: {rows} → {args.output}")
+    if args.state and mark:
+        updated_at, last_id = mark
+        save_state(args.state, {
+            "updated_at": updated_at.isoformat(),
+            "last_id": last_id,
+            "exported_at": datetime.now(timezone.utc).isoformat()
+        })
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv))
@@ -1,13 +1,49 @@
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from psycopg2 import pool
+from psycopg2.extras import RealDictCursor, Json, execute_values
 import os
+import atexit
 import logging
+import threading
+from contextlib import contextmanager
+import metrics
+from batch_writer import MessageLogWriter
+from conversation_cache import ConversationCache
+from retry_counter import RetryCounter
+from db_migrations import apply_migrations
+from db_pool import HealthCheckedPool, pool_size_from_env, app_processes, SENDER_LOCK_CLASS
+from history import COLUMNS as HISTORY_COLUMNS
 
+NO_CURSOR = ("infinity", 0)
+
+# Cada método público queda medido en neon_call_seconds{method=...}
+@metrics.instrument_methods(exclude=("return_connection", "pool_stats", "sender_lock", "iter_conversation_history"))
 class NeonDB:
     def __init__(self):
+        # El pool se abre en el primer uso, dentro del proceso worker:
+        # importar este módulo (p. ej. en el master de gunicorn) no conecta
         self.connection_pool = None
-        self._initialize_pool()
+        self._init_lock = threading.Lock()
+        
+        # Con varios workers/nodos cada turno toma un lock por número en Postgres
+        self.sender_locks = os.getenv("SENDER_LOCKS", "0") == "1"
+        
+        # Los mensajes se guardan en lotes fuera del camino del webhook
+        self.message_writer = MessageLogWriter(
+            self,
+            flush_size=int(os.getenv("MESSAGE_LOG_BATCH_SIZE", 100)),
+            flush_interval=float(os.getenv("MESSAGE_LOG_FLUSH_SECONDS", 1.0)),
+            # Meta reintenta un webhook hasta por unos días; más allá el ID ya no sirve
+            processed_retention=float(os.getenv("PROCESSED_MESSAGES_RETENTION_DAYS", 7)) * 86400
+        )
+        atexit.register(self.message_writer.close)
+        
+        # Estado de conversaciones activas (write-through)
+        self.conversation_cache = ConversationCache(
+            max_entries=int(os.getenv("CONVERSATION_CACHE_SIZE", 5000)),
+            ttl=float(os.getenv("CONVERSATION_CACHE_TTL", 900))
+        )
+        
+        # Reintentos recientes por paso (ventana de 5 minutos)
+        self.retry_counter = RetryCounter(window=float(os.getenv("RETRY_WINDOW_SECONDS", 300)))
     
     def _initialize_pool(self):
         try:
@@ -17,24 +53,103 @@ class NeonDB:
             if not db_url:
                 raise Exception("❌ La variable DATABASE_URL no está configurada en Railway")
             
-            # Creamos el pool usando la URL directamente (más seguro y simple)
-            self.connection_pool = psycopg2.pool.SimpleConnectionPool(
+            # Pool thread-safe con validación de conexiones caducadas
+            self.connection_pool = HealthCheckedPool(
+                dsn=db_url,  # DSN (Data Source Name) acepta la URL completa
                 minconn=1,
-                maxconn=10,
-                dsn=db_url  # DSN (Data Source Name) acepta la URL completa
+                maxconn=pool_size_from_env(minimum=self._pool_minimum()),
+                checkout_timeout=float(os.getenv("DB_POOL_TIMEOUT", 5)),
+                ping_after=float(os.getenv("DB_POOL_PING_AFTER", 30)),
+                max_lifetime=float(os.getenv("DB_POOL_MAX_LIFETIME", 1800)),
+                statement_timeout_ms=int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 15000))
             )
-            logging.info("✅ Conexión a Neon DB exitosa")
+            logging.info(f"✅ Conexión a Neon DB exitosa (pid {os.getpid()}, pool {self.connection_pool.maxconn})")
             
         except Exception as e:
             logging.error(f"❌ Error fatal conectando a base de datos: {e}")
             raise e
     
+    def _pool_minimum(self):
+        """
+        Conexiones que este proceso puede tener tomadas a la vez: cada worker de
+        conversation_queue usa una (dos con SENDER_LOCKS, el lock retiene la suya
+        durante el turno), más los hilos HTTP, el volcado en lote y el outbox
+        """
+        per_turn = 2 if self.sender_locks else 1
+        return (per_turn * int(os.getenv("QUEUE_WORKERS", 4))
+                + int(os.getenv("GUNICORN_THREADS", 1)) + 2)
+    
+    def _connect(self):
+        with self._init_lock:
+            if self.connection_pool is not None:
+                return
+            self._initialize_pool()
+            conn = self.connection_pool.getconn()
+            try:
+                if os.getenv("RUN_MIGRATIONS", "1") == "1":
+                    apply_migrations(conn)
+                self._check_connection_budget(conn)
+            finally:
+                self.connection_pool.putconn(conn)
+    
+    def _check_connection_budget(self, conn):
+        """Avisa si workers × nodos × pool supera el max_connections de Neon"""
+        processes = app_processes()
+        with conn.cursor() as cursor:
+            cursor.execute("SHOW max_connections")
+            max_connections = int(cursor.fetchone()[0])
+        conn.rollback()
+        if processes * self.connection_pool.maxconn > max_connections:
+            logging.warning(
+                f"⚠️ {processes} procesos × {self.connection_pool.maxconn} conexiones "
+                f"superan max_connections={max_connections} de Neon; ajusta DB_POOL_MAX o NEON_MAX_CONNECTIONS"
+            )
+    
     def get_connection(self):
+        if self.connection_pool is None:
+            self._connect()
         return self.connection_pool.getconn()
     
     def return_connection(self, conn):
         self.connection_pool.putconn(conn)
     
+    def pool_stats(self):
+        return self.connection_pool.stats() if self.connection_pool is not None else None
+    
+    @contextmanager
+    def sender_lock(self, phone_number):
+        """
+        Serializa los turnos de un número entre workers y nodos con un
+        advisory lock de sesión (requiere el endpoint directo de Neon, no el
+        -pooler). Con el lock tomado se descarta el estado en cache, que otro
+        proceso pudo haber cambiado.
+        """
+        if not self.sender_locks:
+            yield
+            return
+        
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_lock(%s, hashtext(%s))", (SENDER_LOCK_CLASS, phone_number))
+            conn.commit()
+        except Exception:
+            self.connection_pool.putconn(conn, close=True)
+            raise
+        
+        try:
+            self.conversation_cache.invalidate(phone_number)
+            yield
+        finally:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_unlock(%s, hashtext(%s))", (SENDER_LOCK_CLASS, phone_number))
+                conn.commit()
+                self.return_connection(conn)
+            except Exception:
+                # Cerrar la sesión también libera el lock
+                self.connection_pool.putconn(conn, close=True)
+    
     # ==================== CONVERSACIONES ====================
     
     def get_or_create_conversation(self, phone_number):
@@ -42,33 +157,40 @@ class NeonDB:
         Obtiene conversación existente o crea una nueva
         Returns: dict con datos de la conversación
         """
+        cached = self.conversation_cache.get(phone_number)
+        if cached is not None:
+            return cached
+        
         conn = self.get_connection()
         try:
             with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                # Intentar obtener conversación existente
-                cursor.execute("""
-                    SELECT * FROM conversations 
-                    WHERE phone_number = %s 
-                    AND status != 'COMPLETED'
-                    ORDER BY created_at DESC 
-                    LIMIT 1
-                """, (phone_number,))
-                
-                conversation = cursor.fetchone()
-                
-                if conversation:
-                    return dict(conversation)
-                
-                # Crear nueva conversación
-                cursor.execute("""
-                    INSERT INTO conversations (phone_number, current_step, status)
-                    VALUES (%s, 'START', 'IN_PROGRESS')
-                    RETURNING *
-                """, (phone_number,))
-                
+                # Upsert atómico sobre el índice único parcial de conversaciones activas:
+                # un solo round trip y sin duplicados aunque lleguen mensajes simultáneos.
+                # DO NOTHING no toca la fila existente (no dispara el trigger de updated_at);
+                # si no hubo INSERT, el SELECT de la misma sentencia la devuelve.
+                for _ in range(2):
+                    cursor.execute("""
+                        WITH ins AS (
+                            INSERT INTO conversations (phone_number, current_step, status)
+                            VALUES (%(phone)s, 'START', 'IN_PROGRESS')
+                            ON CONFLICT (phone_number) WHERE status != 'COMPLETED' DO NOTHING
+                            RETURNING *
+                        )
+                        SELECT * FROM ins
+                        UNION ALL
+                        SELECT * FROM conversations
+                        WHERE phone_number = %(phone)s AND status != 'COMPLETED'
+                        AND NOT EXISTS (SELECT 1 FROM ins)
+                    """, {"phone": phone_number})
+                    conversation = cursor.fetchone()
+                    # Vacío solo si otra transacción insertó después de nuestro snapshot:
+                    # la segunda vuelta ya la ve
+                    if conversation is not None:
+                        break
+
                 conn.commit()
-                new_conv = cursor.fetchone()
-                return dict(new_conv)
+                self.conversation_cache.put(phone_number, conversation)
+                return dict(conversation)
                 
         except Exception as e:
             conn.rollback()
@@ -77,10 +199,11 @@ class NeonDB:
         finally:
             self.return_connection(conn)
     
-    def update_conversation_step(self, phone_number, step, **kwargs):
+    def update_conversation_step(self, phone_number, step, outbox=None, **kwargs):
         """
         Actualiza el paso actual y opcionalmente otros campos
         kwargs puede incluir: name, dni_ruc, location, category, model, color, etc.
+        outbox: [(payload, delay_segundos)] mensajes a encolar en la misma transacción
         """
         conn = self.get_connection()
         try:
@@ -100,10 +223,23 @@ class NeonDB:
                     UPDATE conversations 
                     SET {', '.join(fields)}
                     WHERE phone_number = %s
+                    AND status != 'COMPLETED'
+                    RETURNING id
                 """
                 
                 cursor.execute(query, values)
+                updated = cursor.fetchone()
+                
+                # Transición y respuesta se confirman juntas (transactional outbox)
+                if outbox:
+                    self._insert_outbox(cursor, phone_number, updated[0] if updated else None, outbox)
                 conn.commit()
+            
+            self.conversation_cache.update(
+                phone_number,
+                current_step=step,
+                **{key: value for key, value in kwargs.items() if value is not None}
+            )
                 
         except Exception as e:
             conn.rollback()
@@ -123,8 +259,10 @@ class NeonDB:
                         current_step = 'FINISHED',
                         completed_at = NOW()
                     WHERE phone_number = %s
+                    AND status != 'COMPLETED'
                 """, (phone_number,))
                 conn.commit()
+            self.conversation_cache.invalidate(phone_number)
         finally:
             self.return_connection(conn)
     
@@ -139,90 +277,302 @@ class NeonDB:
                         current_step = 'EN_ATENCION_HUMANA',
                         notes = %s
                     WHERE phone_number = %s
+                    AND status != 'COMPLETED'
                 """, (reason, phone_number))
                 conn.commit()
+            self.conversation_cache.update(
+                phone_number,
+                status='HUMAN_HANDOFF',
+                current_step='EN_ATENCION_HUMANA',
+                notes=reason
+            )
+        finally:
+            self.return_connection(conn)
+    
+    # ==================== OUTBOX ====================
+    
+    def _insert_outbox(self, cursor, phone_number, conversation_id, messages):
+        # send_after acumula los delays para que cada mensaje salga tras el anterior
+        rows = []
+        delay_total = 0.0
+        for payload, delay in messages:
+            delay_total += delay
+            # Las plantillas ya vienen serializadas (util.Payload)
+            body = payload.decode("utf-8") if isinstance(payload, bytes) else Json(payload)
+            rows.append((phone_number, conversation_id, body, delay_total))
+        
+        execute_values(cursor, """
+            INSERT INTO outbox (phone_number, conversation_id, payload, send_after)
+            VALUES %s
+        """, rows, template="(%s, %s, %s, NOW() + make_interval(secs => %s))")
+    
+    def enqueue_outbox(self, phone_number, conversation_id, messages):
+        """Encola respuestas sin cambio de paso. messages: [(payload, delay_segundos)]"""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                self._insert_outbox(cursor, phone_number, conversation_id, messages)
+                conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Error en enqueue_outbox: {e}")
+            raise
         finally:
             self.return_connection(conn)
     
-    # ==================== MENSAJES ====================
+    def claim_outbox(self, limit=20, lease_seconds=60):
+        """
+        Reclama mensajes vencidos para enviar. Varios workers/nodos pueden
+        drenar a la vez: SKIP LOCKED evita que dos reclamen la misma fila y
+        el lease (send_after en el futuro) la oculta mientras se envía; si el
+        worker muere, la fila vuelve a estar disponible al vencer el lease.
+        Solo se reclama el mensaje pendiente más antiguo de cada número, así
+        se respeta el orden por destinatario.
+        """
+        conn = self.get_connection()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute("""
+                    UPDATE outbox
+                    SET attempts = attempts + 1,
+                        send_after = NOW() + make_interval(secs => %s)
+                    WHERE id IN (
+                        SELECT o.id FROM outbox o
+                        WHERE o.status = 'PENDING'
+                        AND o.send_after <= NOW()
+                        AND NOT EXISTS (
+                            SELECT 1 FROM outbox p
+                            WHERE p.phone_number = o.phone_number
+                            AND p.status = 'PENDING'
+                            AND p.id < o.id
+                        )
+                        ORDER BY o.id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, phone_number, conversation_id, payload, attempts
+                """, (lease_seconds, limit))
+                rows = [dict(row) for row in cursor.fetchall()]
+                conn.commit()
+                return rows
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Error en claim_outbox: {e}")
+            raise
+        finally:
+            self.return_connection(conn)
     
-    def log_message(self, phone_number, message_type, content, content_type='text', intent=None):
+    def next_outbox_due(self):
         """
-        Registra cada mensaje enviado/recibido
-        message_type: 'incoming' o 'outgoing'
+        Segundos hasta que vence el próximo mensaje reclamable (el pendiente
+        más antiguo de cada número), negativo si ya venció, None si no hay
+        pendientes. Los que esperan detrás de otro del mismo número no cuentan.
         """
         conn = self.get_connection()
         try:
             with conn.cursor() as cursor:
-                # Obtener conversation_id
-                cursor.execute(
-                    "SELECT id FROM conversations WHERE phone_number = %s ORDER BY created_at DESC LIMIT 1",
-                    (phone_number,)
-                )
-                result = cursor.fetchone()
-                conversation_id = result[0] if result else None
-                
                 cursor.execute("""
-                    INSERT INTO messages 
-                    (conversation_id, phone_number, message_type, content_type, content, intent)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (conversation_id, phone_number, message_type, content_type, content, intent))
-                
+                    SELECT EXTRACT(EPOCH FROM MIN(o.send_after) - NOW())
+                    FROM outbox o
+                    WHERE o.status = 'PENDING'
+                    AND NOT EXISTS (
+                        SELECT 1 FROM outbox p
+                        WHERE p.phone_number = o.phone_number
+                        AND p.status = 'PENDING'
+                        AND p.id < o.id
+                    )
+                """)
+                due = cursor.fetchone()[0]
+                conn.commit()
+                return float(due) if due is not None else None
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Error en next_outbox_due: {e}")
+            raise
+        finally:
+            self.return_connection(conn)
+    
+    def mark_outbox_sent(self, sent):
+        """sent: [(outbox_id, wa_message_id)]"""
+        if not sent:
+            return
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                execute_values(cursor, """
+                    UPDATE outbox o
+                    SET status = 'SENT', sent_at = NOW(), wa_message_id = v.wa_message_id
+                    FROM (VALUES %s) AS v(id, wa_message_id)
+                    WHERE o.id = v.id
+                """, sent)
+                conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Error en mark_outbox_sent: {e}")
+            raise
+        finally:
+            self.return_connection(conn)
+    
+    def mark_outbox_failed(self, outbox_id, error, retry_in=None):
+        """Programa un reintento en retry_in segundos, o la marca DEAD si es None"""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                if retry_in is None:
+                    cursor.execute("""
+                        UPDATE outbox SET status = 'DEAD', last_error = %s WHERE id = %s
+                    """, (error, outbox_id))
+                else:
+                    cursor.execute("""
+                        UPDATE outbox
+                        SET last_error = %s, send_after = NOW() + make_interval(secs => %s)
+                        WHERE id = %s
+                    """, (error, retry_in, outbox_id))
                 conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Error en mark_outbox_failed: {e}")
+            raise
+        finally:
+            self.return_connection(conn)
+    
+    def purge_outbox(self, older_than_seconds, batch_size=5000):
+        """
+        Borra filas SENT enviadas hace más de older_than_seconds, en lotes
+        cortos para no bloquear al worker. Las DEAD se conservan para revisión.
+        Returns: filas borradas
+        """
+        purged = 0
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                while True:
+                    cursor.execute("""
+                        DELETE FROM outbox
+                        WHERE id IN (
+                            SELECT id FROM outbox
+                            WHERE status = 'SENT'
+                            AND sent_at < NOW() - make_interval(secs => %s)
+                            LIMIT %s
+                        )
+                    """, (older_than_seconds, batch_size))
+                    conn.commit()
+                    purged += cursor.rowcount
+                    if cursor.rowcount < batch_size:
+                        return purged
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Error en purge_outbox: {e}")
+            raise
+        finally:
+            self.return_connection(conn)
+    
+    # ==================== MENSAJES ====================
+    
+    def log_message(self, phone_number, message_type, content, content_type='text', intent=None,
+                    conversation_id=None, wa_message_id=None):
+        """
+        Registra cada mensaje enviado/recibido (escritura en lote, no bloquea)
+        message_type: 'incoming' o 'outgoing'
+        conversation_id: pasarlo si ya se conoce para evitar resolverlo por teléfono
+        wa_message_id: ID de WhatsApp, para deduplicar y seguir estados de entrega
+        """
+        try:
+            self.message_writer.add({
+                "conversation_id": conversation_id,
+                "phone_number": phone_number,
+                "message_type": message_type,
+                "content_type": content_type,
+                "content": content,
+                "intent": intent,
+                "wa_message_id": wa_message_id
+            })
         except Exception as e:
             logging.error(f"Error logging message: {e}")
             # No lanzar excepción para no romper flujo principal
+    
+    def update_message_statuses(self, statuses):
+        """
+        Actualiza en lote el estado de entrega (sent/delivered/read/failed)
+        statuses: lista de (wa_message_id, status, unix_timestamp)
+        """
+        try:
+            self.message_writer.add_statuses(statuses)
+        except Exception as e:
+            logging.error(f"Error registrando estados de entrega: {e}")
+    
+    def claim_message(self, wa_message_id, phone_number):
+        """
+        Registra el ID de un mensaje entrante antes de procesarlo.
+        Returns: True si es la primera vez que se ve, False si es un reenvío
+        """
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO processed_messages (wa_message_id, phone_number)
+                    VALUES (%s, %s)
+                    ON CONFLICT (wa_message_id) DO NOTHING
+                """, (wa_message_id, phone_number))
+                conn.commit()
+                return cursor.rowcount == 1
+        except Exception:
+            conn.rollback()
+            raise
         finally:
             self.return_connection(conn)
     
-    def get_conversation_history(self, phone_number, limit=50):
-        """Obtiene historial de mensajes de una conversación"""
+    def get_conversation_history(self, phone_number, limit=50, before=None):
+        """
+        Una página del historial del número, más reciente primero.
+        before: (timestamp, id) del último mensaje de la página anterior
+        """
         conn = self.get_connection()
         try:
             with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute("""
-                    SELECT m.* 
-                    FROM messages m
-                    JOIN conversations c ON m.conversation_id = c.id
-                    WHERE c.phone_number = %s
-                    ORDER BY m.timestamp DESC
+                # Keyset sobre (timestamp, id): rango por índice, sin OFFSET ni JOIN
+                cursor.execute(f"""
+                    SELECT {', '.join(HISTORY_COLUMNS)}
+                    FROM messages
+                    WHERE phone_number = %s
+                    AND (timestamp, id) < (%s, %s)
+                    ORDER BY timestamp DESC, id DESC
                     LIMIT %s
-                """, (phone_number, limit))
+                """, (phone_number, *(before or NO_CURSOR), limit))
                 
                 return [dict(row) for row in cursor.fetchall()]
         finally:
             self.return_connection(conn)
     
+    def iter_conversation_history(self, phone_number, before=None, page_size=500):
+        """
+        Todo el historial desde `before` hacia atrás, como generador.
+        Cada página es una consulta corta y la conexión vuelve al pool entre
+        páginas: una descarga lenta no retiene una conexión del webhook.
+        """
+        while True:
+            page = self.get_conversation_history(phone_number, page_size, before)
+            yield from page
+            if len(page) < page_size:
+                return
+            before = (page[-1]["timestamp"], page[-1]["id"])
+    
     # ==================== VALIDACIONES ====================
     
     def log_failed_validation(self, phone_number, step, user_input, expected_format):
-        """Registra intentos fallidos para análisis"""
-        conn = self.get_connection()
+        """
+        Registra un intento fallido y devuelve el número de reintento.
+        El conteo sale de memoria (RetryCounter) y la fila para análisis se
+        guarda en lote, así el mensaje de error no espera a Neon.
+        """
+        retry_count = self.retry_counter.record(phone_number, step)
         try:
-            with conn.cursor() as cursor:
-                # Verificar si ya existe un registro reciente
-                cursor.execute("""
-                    SELECT retry_count FROM failed_validations
-                    WHERE phone_number = %s 
-                    AND step = %s
-                    AND timestamp > NOW() - INTERVAL '5 minutes'
-                    ORDER BY timestamp DESC
-                    LIMIT 1
-                """, (phone_number, step))
-                
-                result = cursor.fetchone()
-                retry_count = (result[0] + 1) if result else 1
-                
-                cursor.execute("""
-                    INSERT INTO failed_validations 
-                    (phone_number, step, user_input, expected_format, retry_count)
-                    VALUES (%s, %s, %s, %s, %s)
-                """, (phone_number, step, user_input, expected_format, retry_count))
-                
-                conn.commit()
-                return retry_count
-        finally:
-            self.return_connection(conn)
+            self.message_writer.add_failed_validation(
+                (phone_number, step, user_input, expected_format, retry_count)
+            )
+        except Exception as e:
+            logging.error(f"Error registrando validación fallida: {e}")
+        return retry_count
     
     # ==================== REPORTES ====================
     
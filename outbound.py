@@ -0,0 +1,209 @@
+import asyncio
+import threading
+import time
+import logging
+import metrics
+
+
+class TokenBucket:
+    """
+    Limitador de throughput (token bucket). La Graph API limita los mensajes
+    por segundo de cada número de WhatsApp Business; excederlo dispara 429.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """Toma un token si hay. Returns: 0 o los segundos que faltan para el próximo"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Toma un token, esperando lo justo si no hay. Returns: segundos esperados"""
+        waited = 0.0
+        while True:
+            wait = self._take()
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self):
+        """Como acquire(), pero cede el event loop mientras espera"""
+        waited = 0.0
+        while True:
+            wait = self._take()
+            if not wait:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+
+class ReplyPlan:
+    """
+    Resultado de un turno: uno o más mensajes para el mismo número que deben
+    salir en orden (p. ej. texto + ubicación + seguimiento) y, si corresponde,
+    la transición de paso que se guarda junto con ellos.
+    """
+
+    def __init__(self, number, conversation_id=None):
+        self.number = number
+        self.conversation_id = conversation_id
+        self.messages = []
+        self.next_step = None
+        self.fields = {}
+
+    def add(self, data):
+        self.messages.append(data)
+        return self
+
+    def transition(self, step, **fields):
+        """Paso siguiente y campos a guardar (se aplican al confirmar el turno)"""
+        self.next_step = step
+        self.fields.update(fields)
+        return self
+
+    def __len__(self):
+        return len(self.messages)
+
+
+class OutboundDispatcher:
+    """
+    Servicio de envío: recibe planes de respuesta, programa cada mensaje con
+    su delay humanizado en el DelayScheduler (que mantiene el orden por
+    destinatario y despacha en paralelo sobre el pool HTTP) y limita el
+    throughput total con un token bucket.
+    """
+
+    def __init__(self, scheduler, send, typing_delay, on_sent=None, rate=80, burst=None):
+        self.scheduler = scheduler
+        self.send = send
+        self.typing_delay = typing_delay
+        self.on_sent = on_sent
+        self.bucket = TokenBucket(rate, burst)
+
+        self._lock = threading.Lock()
+        self._plans = 0
+        self._sent = 0
+        self._failed = 0
+        self._throttled_seconds = 0.0
+
+    def submit(self, plan):
+        """Programa todos los mensajes del plan (no bloquea)"""
+        if not plan.messages:
+            return
+        for data in plan.messages:
+            delay = self.typing_delay()
+            metrics.typing_delay_seconds.observe(delay)
+            self.scheduler.schedule(plan.number, delay, self._deliver, plan, data)
+        with self._lock:
+            self._plans += 1
+
+    def _deliver(self, plan, data):
+        waited = self.bucket.acquire()
+        result = self.send(data)
+
+        with self._lock:
+            self._throttled_seconds += waited
+            if result is not None:
+                self._sent += 1
+            else:
+                self._failed += 1
+
+        if result is None:
+            logging.error(f"No se pudo enviar mensaje a {plan.number}")
+            return
+        if self.on_sent:
+            self.on_sent(plan.number, plan.conversation_id, data, result)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "plans": self._plans,
+                "sent": self._sent,
+                "failed": self._failed,
+                "scheduled": self.scheduler.pending(),
+                "throttled_seconds": round(self._throttled_seconds, 3)
+            }
+
+
+class AsyncOutboundDispatcher:
+    """
+    Equivalente de OutboundDispatcher para el modo async: cada plan corre
+    como una tarea que espera el delay humanizado con asyncio.sleep, así miles
+    de respuestas pendientes no ocupan hilos. Los planes de un mismo número
+    se encadenan (cada uno espera al anterior) para mantener el orden.
+    """
+
+    def __init__(self, send, typing_delay, on_sent=None, rate=80, burst=None):
+        self.send = send                # coroutine function(data) -> dict | None
+        self.typing_delay = typing_delay
+        self.on_sent = on_sent
+        self.bucket = TokenBucket(rate, burst)
+
+        self._tails = {}                # number -> última tarea de envío
+        self._plans = 0
+        self._sent = 0
+        self._failed = 0
+        self._throttled_seconds = 0.0
+
+    def submit(self, plan):
+        """Programa todos los mensajes del plan (no bloquea; requiere event loop)"""
+        if not plan.messages:
+            return
+        previous = self._tails.get(plan.number)
+        task = asyncio.get_running_loop().create_task(self._run_plan(plan, previous))
+        self._tails[plan.number] = task
+        task.add_done_callback(lambda done, number=plan.number: self._forget(number, done))
+        self._plans += 1
+
+    def _forget(self, number, task):
+        if self._tails.get(number) is task:
+            del self._tails[number]
+
+    async def _run_plan(self, plan, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        for data in plan.messages:
+            delay = self.typing_delay()
+            metrics.typing_delay_seconds.observe(delay)
+            await asyncio.sleep(delay)
+            await self._deliver(plan, data)
+
+    async def _deliver(self, plan, data):
+        self._throttled_seconds += await self.bucket.acquire_async()
+        result = await self.send(data)
+
+        if result is None:
+            self._failed += 1
+            logging.error(f"No se pudo enviar mensaje a {plan.number}")
+            return
+        self._sent += 1
+        if self.on_sent:
+            self.on_sent(plan.number, plan.conversation_id, data, result)
+
+    async def drain(self, timeout=5.0):
+        """Espera a que salgan los planes pendientes (al apagar)"""
+        pending = list(self._tails.values())
+        if pending:
+            await asyncio.wait(pending, timeout=timeout)
+
+    def stats(self):
+        return {
+            "plans": self._plans,
+            "sent": self._sent,
+            "failed": self._failed,
+            "senders_pending": len(self._tails),
+            "throttled_seconds": round(self._throttled_seconds, 3)
+        }
@@ -0,0 +1,155 @@
+import random
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+class OutboxWorker:
+    """
+    Drena la tabla outbox: reclama lotes con FOR UPDATE SKIP LOCKED, los envía
+    en paralelo (son de números distintos) y marca cada fila como SENT o
+    programa su reintento con backoff exponencial. Tras `max_attempts`
+    intentos la fila queda DEAD para revisión manual. Las filas SENT se
+    borran tras `retention_seconds`, cada `purge_interval` segundos.
+
+    Entre lotes duerme hasta que vence el próximo mensaje pendiente (el
+    delay humanizado vive en send_after), no un intervalo fijo: wake()
+    despierta al encolar y `poll_interval` solo acota la espera sin
+    pendientes, para recoger filas de otros procesos sin mantener Neon activo.
+
+    Puede correr en varios workers/nodos a la vez sin duplicar envíos.
+    """
+
+    def __init__(self, db, send, on_sent=None, batch_size=20, poll_interval=300.0,
+                 lease_seconds=60, max_attempts=5, backoff_base=5.0, backoff_max=600.0,
+                 concurrency=4, retention_seconds=7 * 86400, purge_interval=3600.0):
+        self.db = db
+        self.send = send
+        self.on_sent = on_sent
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retention_seconds = retention_seconds
+        self.purge_interval = purge_interval
+        self._next_purge = time.monotonic() + purge_interval
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="outbox-send")
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._retried = 0
+        self._dead = 0
+        self._purged = 0
+        self._sent_at_purge = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="outbox-worker", daemon=True)
+        self._thread.start()
+        return self
+
+    def wake(self):
+        """Avisar que hay mensajes nuevos (evita esperar al siguiente poll)"""
+        self._wake.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            # Antes de reclamar: un wake() durante el lote no se pierde
+            self._wake.clear()
+            try:
+                drained = self.drain_once()
+                # Lote lleno: quedan vencidos, se reclama de inmediato
+                wait = 0 if drained >= self.batch_size else self._next_wait()
+            except Exception as e:
+                logging.error(f"Error drenando outbox: {e}")
+                wait = self.backoff_base
+
+            # Solo se purga si hubo envíos: un bot inactivo no despierta a Neon
+            if time.monotonic() >= self._next_purge and self._sent != self._sent_at_purge:
+                self._next_purge = time.monotonic() + self.purge_interval
+                self._sent_at_purge = self._sent
+                try:
+                    self.purge_once()
+                except Exception as e:
+                    logging.error(f"Error purgando outbox: {e}")
+
+            if wait > 0:
+                self._wake.wait(wait)
+
+    def _next_wait(self):
+        """
+        Segundos hasta el próximo mensaje vencido. Se consulta después de
+        mark_outbox_sent: el siguiente mensaje de los mismos números ya es
+        reclamable y, si su delay pasó, se envía sin esperar.
+        """
+        due = self.db.next_outbox_due()
+        if due is None:
+            return self.poll_interval
+        return min(max(due, 0), self.poll_interval)
+
+    def drain_once(self):
+        """Reclama y envía un lote. Returns: filas procesadas"""
+        rows = self.db.claim_outbox(self.batch_size, self.lease_seconds)
+        if not rows:
+            return 0
+
+        results = list(self._executor.map(self._send_row, rows))
+
+        sent = []
+        for row, result in zip(rows, results):
+            if result is not None:
+                wa_message_id = (result.get("messages") or [{}])[0].get("id")
+                sent.append((row["id"], wa_message_id))
+                if self.on_sent:
+                    self.on_sent(row["phone_number"], row["conversation_id"], row["payload"], result)
+            else:
+                self._fail(row, "Graph API no aceptó el mensaje")
+
+        self.db.mark_outbox_sent(sent)
+        with self._lock:
+            self._sent += len(sent)
+        return len(rows)
+
+    def purge_once(self):
+        """Borra las filas SENT más viejas que la retención. Returns: filas borradas"""
+        purged = self.db.purge_outbox(self.retention_seconds)
+        with self._lock:
+            self._purged += purged
+        return purged
+
+    def _send_row(self, row):
+        try:
+            return self.send(row["payload"])
+        except Exception as e:
+            logging.error(f"Error enviando outbox #{row['id']}: {e}")
+            return None
+
+    def _fail(self, row, error):
+        if row["attempts"] >= self.max_attempts:
+            logging.error(f"Outbox #{row['id']} para {row['phone_number']} descartado tras {row['attempts']} intentos")
+            self.db.mark_outbox_failed(row["id"], error, retry_in=None)
+            with self._lock:
+                self._dead += 1
+            return
+
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (row["attempts"] - 1)))
+        self.db.mark_outbox_failed(row["id"], error, retry_in=delay * random.uniform(0.8, 1.2))
+        with self._lock:
+            self._retried += 1
+
+    def stop(self, timeout=10.0):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            return {"sent": self._sent, "retried": self._retried, "dead": self._dead, "purged": self._purged}
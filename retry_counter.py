@@ -0,0 +1,37 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RetryCounter:
+    """
+    Reintentos recientes por (número, paso), en memoria.
+
+    Misma regla que la consulta anterior a failed_validations: un error
+    cuenta como reintento si el anterior en ese paso fue hace menos de
+    `window` segundos; si no, vuelve a 1. LRU acotado a `max_entries`, así
+    que responder a un error no espera ningún round trip a Neon.
+    """
+
+    def __init__(self, window=300, max_entries=20000):
+        self.window = window
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # (number, step) -> (expires_at, retry_count)
+        self._lock = threading.Lock()
+
+    def record(self, number, step):
+        """Registra un error de validación. Returns: número de reintento (1, 2, ...)"""
+        key = (number, step)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            retry_count = entry[1] + 1 if entry is not None and entry[0] > now else 1
+            self._entries[key] = (now + self.window, retry_count)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return retry_count
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries)}
@@ -0,0 +1,228 @@
+"""
+Máquina de estados if/elif previa a FlowEngine, congelada como referencia
+para tests/test_flow_engine.py. No se usa en producción: no editar salvo
+que un cambio de comportamiento del flujo sea intencional en ambos lados.
+"""
+import logging
+from datetime import datetime
+import pytz
+
+import util
+from conversation_intelligence import intelligence, response_builder
+
+def get_time_greeting():
+    """Obtiene saludo según hora en Perú"""
+    tz_peru = pytz.timezone('America/Lima')
+    hora_actual = datetime.now(tz_peru).hour
+    
+    if 5 <= hora_actual < 12:
+        return "Buenos días"
+    elif 12 <= hora_actual < 18:
+        return "Buenas tardes"
+    else:
+        return "Buenas noches"
+
+def run_state_machine(text, number, conversation, reply, log_failed_validation):
+    """
+    Máquina de estados principal con validaciones.
+    No escribe en la base: la transición y los mensajes quedan en `reply`
+    y cada modo (sync/async) los confirma a su manera.
+    log_failed_validation(number, step, text, expected) -> retry_count
+    """
+    step = conversation.get("current_step")
+    
+    # ====== DETECCIÓN DE INTENCIONES GLOBALES ======
+    intent = intelligence.detect_intent(text)
+    
+    if intent == 'ubicacion':
+        msg = "📍 Nuestra sede está en:\n\n*ISUZU CAMIONES AUTOMOTRIZ CISNE*"
+        data = util.TextMessage(msg, number)
+        reply.add(data)
+        
+        # Enviar ubicación
+        location_data = util.LocationMessage(number)
+        reply.add(location_data)
+        
+        msg_continue = "¿Deseas continuar con la cotización? Responde *SI* para continuar."
+        data = util.TextMessage(msg_continue, number)
+        reply.add(data)
+        return
+    
+    elif intent == 'hablar_humano':
+        reply.transition(
+            "EN_ATENCION_HUMANA",
+            status="HUMAN_HANDOFF",
+            notes="Cliente solicitó atención humana"
+        )
+        
+        msg = "🙋‍♀️ Entendido. En un momento la asesora *Gabriela Paucar* se comunicará contigo personalmente.\n\n📞 También puedes llamarnos directamente al *01-XXX-XXXX*"
+        data = util.TextMessage(msg, number)
+        reply.add(data)
+        
+        # TODO: Notificación Telegram deshabilitada por ahora
+        logging.info(f"HANDOFF solicitado por {number}")
+        return
+    
+    elif intent == 'salir':
+        reply.transition("FINISHED", status="COMPLETED", completed_at=datetime.now(pytz.utc))
+        msg = "Entendido. Si cambias de opinión, escríbenos cuando quieras. ¡Hasta pronto! 👋"
+        data = util.TextMessage(msg, number)
+        reply.add(data)
+        return
+    
+    # ====== FLUJO CONVERSACIONAL ======
+    
+    # --- PASO 0: SALUDO INICIAL ---
+    if step == "START":
+        msg = "👋 Te saluda el *Asistente Virtual* de *Gabriela Paucar* - 👩🏻‍💼 Asesora Comercial de ISUZU CAMIONES AUTOMOTRIZ CISNE.\n📍 SEDE LIMA.\n\nPara atenderte mejor, por favor indícame: *¿Cuál es tu nombre y apellido?*"
+        data = util.TextMessage(msg, number)
+        reply.add(data)
+        
+        reply.transition("WAITING_NAME")
+    
+    # --- PASO 1: CAPTURAR NOMBRE ---
+    elif step == "WAITING_NAME":
+        # Extraer nombre limpio
+        name = intelligence.extract_name(text)
+        
+        if len(name.split()) < 2:
+            # Nombre muy corto, validación fallida
+            retry_count = log_failed_validation(number, step, text, "Nombre y Apellido")
+            error_msg = response_builder.format_error_retry(step, retry_count)
+            data = util.TextMessage(error_msg, number)
+            reply.add(data)
+            return
+        
+        # Nombre válido
+        reply.transition("WAITING_DNI_LOC", name=name)
+        
+        saludo = get_time_greeting()
+        msg = f"{saludo} estimado *{name}*. Un gusto saludarte.\n\nPara continuar, por favor bríndame tu *DNI o RUC* y desde qué *Departamento/Provincia* nos escribes.\n\n_Ejemplo: 10283749, Huancayo_"
+        
+        data = util.TextMessage(msg, number)
+        reply.add(data)
+    
+    # --- PASO 2: CAPTURAR DNI Y UBICACIÓN ---
+    elif step == "WAITING_DNI_LOC":
+        # Extraer DNI y ubicación
+        extracted = intelligence.extract_dni_location(text)
+        
+        if not extracted['dni'] or not extracted['location']:
+            retry_count = log_failed_validation(number, step, text, "DNI/RUC + Ciudad")
+            error_msg = response_builder.format_error_retry(step, retry_count)
+            data = util.TextMessage(error_msg, number)
+            reply.add(data)
+            return
+        
+        # Datos válidos
+        reply.transition(
+            "WAITING_CATEGORY",
+            dni_ruc=extracted['dni'],
+            location=extracted['location']
+        )
+        
+        # Enviar botones de categoría
+        buttons = ["Camión Isuzu", "Camionetas"]
+        msg_body = "🚘 *Tipo de unidad*\n\n¿En qué tipo de unidad estás interesado?"
+        
+        data = util.ButtonsMessage(number, msg_body, buttons)
+        reply.add(data)
+    
+    # --- PASO 3: ELEGIR CATEGORÍA ---
+    elif step == "WAITING_CATEGORY":
+        # Validar categoría
+        category = intelligence.validate_category(text)
+        
+        if not category:
+            retry_count = log_failed_validation(number, step, text, "Camión o Camioneta")
+            error_msg = response_builder.format_error_retry(step, retry_count)
+            
+            # Reenviar botones
+            buttons = ["Camión Isuzu", "Camionetas"]
+            msg_body = f"{error_msg}\n\n🚘 *Tipo de unidad*\n\n¿En qué tipo de unidad estás interesado?"
+            data = util.ButtonsMessage(number, msg_body, buttons)
+            reply.add(data)
+            return
+        
+        # Categoría válida
+        reply.transition("WAITING_MODEL", category=category)
+        
+        # Preparar lista de modelos
+        options = []
+        msg_body = ""
+        header_list = "Modelos Disponibles"
+
+        if "Camión" in category:
+            options = [
+                {"id": "mod_1", "title": "FVR 10ton", "description": "Ideal para carga pesada"},
+                {"id": "mod_2", "title": "NLR 3TON", "description": "Urbano y versátil"},
+                {"id": "mod_3", "title": "NPS 4x4", "description": "Todo terreno"}
+            ]
+            msg_body = "Excelente elección. Isuzu es líder en camiones. ¿Qué modelo buscas?"
+            
+        else:  # Camionetas
+            options = [
+                {"id": "mod_4", "title": "Chevrolet Captiva", "description": "SUV Familiar"},
+                {"id": "mod_5", "title": "Subaru XL", "description": "Aventura y confort"}
+            ]
+            msg_body = "¿Qué camioneta se ajusta a tus necesidades?"
+
+        data = util.ListMessage(number, header_list, msg_body, options, "Ver Modelos")
+        reply.add(data)
+    
+    # --- PASO 4: ELEGIR MODELO ---
+    elif step == "WAITING_MODEL":
+        # Guardar modelo seleccionado
+        reply.transition("WAITING_COLOR", model=text)
+        
+        buttons = ["Blanco", "Rojo", "Azul"]
+        msg = f"Perfecto, el *{text}* es una gran máquina.\n¿Tienes algún color de preferencia?"
+        
+        data = util.ButtonsMessage(number, msg, buttons)
+        reply.add(data)
+    
+    # --- PASO 5: ELEGIR COLOR ---
+    elif step == "WAITING_COLOR":
+        # Validar color
+        color = intelligence.validate_color(text)
+        
+        if not color:
+            color = text.capitalize()  # Aceptar cualquier texto como color
+        
+        reply.transition("WAITING_CALL_TIME", color=color)
+        
+        nombre = conversation.get("name", "")
+        modelo = conversation.get("model", "")
+        
+        msg = f"Gracias *{nombre}*. Tengo registrado tu interés en un *{modelo}* color {color}.\n\n📞 *¿A qué hora prefieres que la asesora Gabriela te llame?*\n\n_Ejemplo: Mañana 10am, Hoy 3pm, etc._"
+        
+        data = util.TextMessage(msg, number)
+        reply.add(data)
+    
+    # --- PASO 6: AGENDAR LLAMADA ---
+    elif step == "WAITING_CALL_TIME":
+        # Guardar horario y marcar como completada
+        reply.transition(
+            "FINISHED",
+            preferred_call_time=text,
+            status="COMPLETED",
+            completed_at=datetime.now(pytz.utc)
+        )
+        
+        msg = "✅ ¡Perfecto! La asesora *Gabriela Paucar* se comunicará contigo en el horario indicado.\n\n🙏 Muchas gracias por contactar a *Isuzu Automotriz Cisne*.\n\n_Si necesitas algo más, escríbeme cuando quieras._"
+        data = util.TextMessage(msg, number)
+        reply.add(data)
+        
+        # Log de lead completado
+        logging.info(f"✅ Lead completado: {number}")
+    
+    # --- CONVERSACIÓN TERMINADA ---
+    elif step == "FINISHED":
+        msg = "Tu solicitud ya fue registrada. La asesora Gabriela se comunicará contigo pronto.\n\n¿Deseas hacer *otra cotización*? Responde *SI* para comenzar de nuevo."
+        data = util.TextMessage(msg, number)
+        reply.add(data)
+        
+        # Si dice "si", reiniciar conversación
+        if text.lower() in ['si', 'sí', 'yes', 'ok']:
+            reply.transition("START")
+            run_state_machine("", number, dict(conversation, current_step="START"), reply, log_failed_validation)  # Trigger START
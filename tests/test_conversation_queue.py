@@ -0,0 +1,111 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import conversation_flow
+from conversation_queue import ConversationQueue
+
+
+def text_message(body):
+    return {"type": "text", "id": f"wamid.{body}", "text": {"body": body}}
+
+
+def bodies(messages):
+    return [message["text"]["body"] for message in messages]
+
+
+def test_coalesce_messages_splits_name_from_dni_location():
+    messages = [text_message("Juan"), text_message("Pérez"), text_message("45678912, Lima")]
+
+    turns, requeue = conversation_flow.coalesce_messages({"current_step": "WAITING_NAME"}, messages)
+    assert bodies(turns) == ["Juan Pérez"]
+    assert bodies(requeue) == ["45678912, Lima"]
+
+    # El sobrante se evalúa contra el paso siguiente
+    turns, requeue = conversation_flow.coalesce_messages({"current_step": "WAITING_DNI_LOC"}, requeue)
+    assert bodies(turns) == ["45678912, Lima"]
+    assert requeue == []
+
+
+def test_per_sender_order_and_exclusivity():
+    lock = threading.Lock()
+    seen = {}
+    busy = set()
+    overlaps = []
+
+    def handler(number, item):
+        with lock:
+            if number in busy:
+                overlaps.append(number)
+            busy.add(number)
+        time.sleep(0.001)
+        with lock:
+            busy.discard(number)
+            seen.setdefault(number, []).append(item)
+
+    queue = ConversationQueue(handler, workers=4)
+    for i in range(50):
+        for number in ("51900000001", "51900000002", "51900000003"):
+            queue.submit(number, i)
+    queue.stop()
+
+    assert overlaps == []
+    assert seen == {number: list(range(50)) for number in ("51900000001", "51900000002", "51900000003")}
+    assert queue.stats()["processed"] == 150
+
+
+def test_coalesce_requeues_leftover_against_next_step():
+    # El handler avanza el paso como lo haría la máquina de estados
+    conversation = {"current_step": "WAITING_NAME"}
+    handled = []
+
+    def handler(number, message):
+        handled.append(message["text"]["body"])
+        if conversation["current_step"] == "WAITING_NAME":
+            conversation["current_step"] = "WAITING_DNI_LOC"
+        else:
+            conversation["current_step"] = "WAITING_CATEGORY"
+
+    queue = ConversationQueue(
+        handler, workers=2, debounce=0.1,
+        should_debounce=lambda number: conversation_flow.should_debounce(conversation),
+        coalesce=lambda number, messages: conversation_flow.coalesce_messages(conversation, messages)
+    )
+    for body in ("Juan", "Pérez", "45678912, Lima"):
+        queue.submit("51900000001", text_message(body))
+    queue.stop()
+
+    assert handled == ["Juan Pérez", "45678912, Lima"]
+    assert queue.stats()["coalesced"] == 1
+    assert queue.stats()["processed"] == 2
+
+
+def test_stop_drains_pending_and_debouncing_mailboxes():
+    handled = []
+
+    def handler(number, item):
+        time.sleep(0.01)
+        handled.append((number, item))
+
+    # Con debounce largo: stop() no espera a que venza la ventana
+    queue = ConversationQueue(handler, workers=2, debounce=30.0,
+                              should_debounce=lambda number: number == "51900000002")
+    for i in range(10):
+        queue.submit("51900000001", i)
+    queue.submit("51900000002", "esperando")
+
+    started = time.monotonic()
+    queue.stop(timeout=5.0)
+
+    assert time.monotonic() - started < 5.0
+    assert [item for number, item in handled if number == "51900000001"] == list(range(10))
+    assert ("51900000002", "esperando") in handled
+    assert queue.stats()["depth"] == 0
+
+    with pytest.raises(RuntimeError):
+        queue.submit("51900000001", "tarde")
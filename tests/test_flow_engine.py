@@ -0,0 +1,43 @@
+import itertools
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import conversation_flow
+from outbound import ReplyPlan
+import baseline_flow
+
+STEPS = ["START", "WAITING_NAME", "WAITING_DNI_LOC", "WAITING_CATEGORY", "WAITING_MODEL",
+         "WAITING_COLOR", "WAITING_CALL_TIME", "FINISHED", "EN_ATENCION_HUMANA", "XYZ"]
+
+# Respuestas válidas e inválidas de cada paso y una por intención global
+TEXTS = ["", "hola", "Juan", "Juan Perez", "45678912, Huancayo", "45678912", "Camión Isuzu",
+         "Camionetas", "moto", "NLR 3TON", "rojo", "verde", "mañana 10am", "si", "no",
+         "donde queda la sede", "quiero hablar con un asesor", "chau", "ayuda"]
+
+# Conversación con datos previos, vacía y con nombre nulo (reinicio)
+CONVERSATIONS = [
+    {"id": 1, "name": "Ana Diaz", "model": "NLR", "category": "Camión Isuzu"},
+    {"id": 2},
+    {"id": 3, "name": None},
+]
+
+
+def run(run_state_machine, text, conversation):
+    reply = ReplyPlan("51999", conversation["id"])
+    calls = []
+    run_state_machine(text, "51999", dict(conversation), reply, lambda *args: calls.append(args) or 2)
+    messages = [json.loads(m) if isinstance(m, bytes) else m for m in reply.messages]
+    fields = {k: v for k, v in reply.fields.items() if k != "completed_at"}
+    return messages, reply.next_step, fields, calls, "completed_at" in reply.fields
+
+
+@pytest.mark.parametrize("step, text, conversation", itertools.product(STEPS, TEXTS, CONVERSATIONS))
+def test_flow_engine_matches_baseline(step, text, conversation):
+    conversation = dict(conversation, current_step=step)
+    assert run(conversation_flow.run_state_machine, text, conversation) == \
+        run(baseline_flow.run_state_machine, text, conversation)
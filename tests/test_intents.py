@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation_intelligence import ConversationIntelligence
+
+
+@pytest.mark.parametrize("text, intent", [
+    # Keywords solapadas: 'ya no' (salir) no debe tapar 'no entiendo' (ayuda)
+    ("ya no entiendo", "ayuda"),
+    ("ya no entiendo nada", "ayuda"),
+    ("Ya no entiendo qué poner", "ayuda"),
+    # Sin solapamiento se mantiene la prioridad por orden de intención
+    ("ya no gracias", "salir"),
+    ("no quiero, chau", "salir"),
+    ("donde esta la sede, ya no", "ubicacion"),
+    ("quiero hablar con la asesora", "hablar_humano"),
+    # Palabra completa: 'persona' no calza en 'personal'
+    ("es para uso personal", None),
+    ("Hola", None),
+])
+def test_detect_intent(text, intent):
+    assert ConversationIntelligence.detect_intent(text) == intent
@@ -0,0 +1,80 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from outbox_worker import OutboxWorker
+
+
+class FakeOutboxDB:
+    """Outbox en memoria que respeta send_after y el orden por número"""
+
+    def __init__(self):
+        self.rows = {}
+        self.lock = threading.Lock()
+
+    def enqueue(self, phone_number, delays):
+        send_after = time.monotonic()
+        with self.lock:
+            for delay in delays:
+                send_after += delay
+                row_id = len(self.rows) + 1
+                self.rows[row_id] = {"id": row_id, "phone_number": phone_number, "conversation_id": 1,
+                                     "payload": {"n": row_id}, "attempts": 0, "send_after": send_after}
+
+    def _heads(self):
+        heads = {}
+        for row_id in sorted(self.rows):
+            heads.setdefault(self.rows[row_id]["phone_number"], self.rows[row_id])
+        return list(heads.values())
+
+    def claim_outbox(self, limit, lease_seconds):
+        now = time.monotonic()
+        with self.lock:
+            rows = [row for row in self._heads() if row["send_after"] <= now][:limit]
+            for row in rows:
+                row["attempts"] += 1
+                row["send_after"] = now + lease_seconds
+            return [dict(row) for row in rows]
+
+    def next_outbox_due(self):
+        with self.lock:
+            heads = self._heads()
+        return min(row["send_after"] for row in heads) - time.monotonic() if heads else None
+
+    def mark_outbox_sent(self, sent):
+        with self.lock:
+            for row_id, _ in sent:
+                self.rows.pop(row_id)
+
+    def mark_outbox_failed(self, outbox_id, error, retry_in=None):
+        raise AssertionError(error)
+
+    def purge_outbox(self, older_than_seconds):
+        return 0
+
+
+def test_reply_follows_typing_delays_not_poll_interval():
+    db = FakeOutboxDB()
+    sent_at = []
+    started = time.monotonic()
+
+    def send(payload):
+        sent_at.append(time.monotonic() - started)
+        return {"messages": [{"id": f"wamid.{payload['n']}"}]}
+
+    worker = OutboxWorker(db, send=send, poll_interval=5.0).start()
+    try:
+        db.enqueue("51999", [0.2, 0.2, 0.2])
+        worker.wake()
+        deadline = time.monotonic() + 3
+        while len(sent_at) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        worker.stop()
+
+    assert len(sent_at) == 3
+    for expected, actual in zip((0.2, 0.4, 0.6), sent_at):
+        assert expected - 0.01 <= actual < expected + 0.15
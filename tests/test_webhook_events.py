@@ -0,0 +1,51 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webhook_events import group_by_sender, submit_by_sender
+
+
+def payload(messages=(), statuses=()):
+    return {"entry": [{"changes": [{"value": {"messages": list(messages), "statuses": list(statuses)}}]}]}
+
+
+def test_malformed_status_timestamp_is_counted_and_skipped():
+    body = payload(
+        messages=[{"from": "51999", "type": "text", "id": "m1"}],
+        statuses=[
+            {"id": "s1", "status": "sent", "timestamp": "1700000000"},
+            {"id": "s2", "status": "delivered", "timestamp": "ayer"},
+            {"id": "s3", "status": "read", "timestamp": {"bad": 1}},
+            {"id": "s4", "status": "read"},
+        ],
+    )
+    messages, statuses, invalid = group_by_sender(body)
+    assert list(messages) == ["51999"]
+    assert statuses == [("s1", "sent", 1700000000), ("s4", "read", 0)]
+    assert invalid == 2
+
+
+def test_rejected_submit_forgets_ids_of_every_unsubmitted_sender():
+    seen = set()
+    body = payload(messages=[
+        {"from": "51001", "type": "text", "id": "a1"},
+        {"from": "51002", "type": "text", "id": "b1"},
+        {"from": "51003", "type": "text", "id": "c1"},
+        {"from": "51002", "type": "text", "id": "b2"},
+    ])
+    messages_by_sender, _, _ = group_by_sender(body, is_new=lambda i: i not in seen and not seen.add(i))
+    assert seen == {"a1", "b1", "b2", "c1"}
+
+    submitted = []
+
+    def submit(number, messages):
+        # La cola se detiene después del primer remitente
+        if submitted:
+            raise RuntimeError("La cola de conversaciones está detenida")
+        submitted.append(number)
+
+    assert not submit_by_sender(messages_by_sender, submit, seen.discard)
+    assert submitted == ["51001"]
+    # El reintento de Meta trae de nuevo a 51002 y 51003
+    assert seen == {"a1"}
@@ -1,3 +1,5 @@
+import json
+
 def GetTextUser(message):
     text = ""
     typeMessage = message["type"]
@@ -163,3 +165,111 @@ def ListMessage(number, header_text, body_text, options_list, title_list="Opcion
     }
     return data
 
+
+
+# ==================== PLANTILLAS PRE-SERIALIZADAS ====================
+# Los mensajes del flujo repiten la misma estructura (botones, catálogo de
+# modelos, ubicación); se serializan una sola vez y por envío solo se
+# insertan el número y el texto variable, ya como bytes para el body HTTP.
+
+# Límites de la Cloud API de WhatsApp
+MAX_TEXT_BODY = 4096
+MAX_INTERACTIVE_BODY = 1024
+MAX_BUTTONS = 3
+MAX_BUTTON_TITLE = 20
+MAX_LIST_HEADER = 60
+MAX_LIST_BUTTON = 20
+MAX_LIST_ROWS = 10
+MAX_ROW_TITLE = 24
+MAX_ROW_DESCRIPTION = 70
+
+_TO_SLOT = "@@TO@@"
+_BODY_SLOT = "@@BODY@@"
+
+
+class Payload(bytes):
+    """JSON listo para enviar; conserva el tipo y el texto para el log"""
+
+    def __new__(cls, data, message_type, content):
+        payload = super().__new__(cls, data)
+        payload.message_type = message_type
+        payload.content = content
+        return payload
+
+
+class PayloadTemplate:
+    """
+    Mensaje serializado una vez con huecos para el número y el cuerpo.
+    render() solo concatena: no arma diccionarios ni vuelve a llamar a json.
+    """
+
+    def __init__(self, data, body_limit=None):
+        self.message_type = data["type"]
+        self.body_limit = body_limit
+        serialized = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+        # Partes fijas intercaladas con los huecos, en orden de aparición
+        self._parts = []
+        self._slots = []
+        rest = serialized
+        while True:
+            positions = [(rest.find(f'"{slot}"'), slot) for slot in (_TO_SLOT, _BODY_SLOT)]
+            positions = [(index, slot) for index, slot in positions if index >= 0]
+            if not positions:
+                break
+            index, slot = min(positions)
+            self._parts.append(rest[:index])
+            self._slots.append(slot)
+            rest = rest[index + len(slot) + 2:]
+        self._parts.append(rest)
+
+    def render(self, number, body=""):
+        if self.body_limit and len(body) > self.body_limit:
+            raise ValueError(f"Texto de {len(body)} caracteres excede el límite de {self.body_limit}")
+        values = {_TO_SLOT: json.dumps(number), _BODY_SLOT: json.dumps(body, ensure_ascii=False)}
+        chunks = [self._parts[0]]
+        for slot, part in zip(self._slots, self._parts[1:]):
+            chunks.append(values[slot])
+            chunks.append(part)
+        return Payload("".join(chunks).encode("utf-8"), self.message_type, body)
+
+
+def _check_length(kind, value, limit):
+    if len(value) > limit:
+        raise ValueError(f"{kind} '{value}' excede {limit} caracteres")
+
+
+def TextTemplate():
+    return PayloadTemplate(TextMessage(_BODY_SLOT, _TO_SLOT), body_limit=MAX_TEXT_BODY)
+
+
+def ButtonsTemplate(buttons_list):
+    if not 1 <= len(buttons_list) <= MAX_BUTTONS:
+        raise ValueError(f"Se admiten de 1 a {MAX_BUTTONS} botones, se recibieron {len(buttons_list)}")
+    for title in buttons_list:
+        _check_length("Botón", title, MAX_BUTTON_TITLE)
+    return PayloadTemplate(ButtonsMessage(_TO_SLOT, _BODY_SLOT, buttons_list), body_limit=MAX_INTERACTIVE_BODY)
+
+
+def ListTemplate(header_text, options_list, title_list="Opciones"):
+    if not 1 <= len(options_list) <= MAX_LIST_ROWS:
+        raise ValueError(f"Se admiten de 1 a {MAX_LIST_ROWS} opciones, se recibieron {len(options_list)}")
+    _check_length("Encabezado", header_text, MAX_LIST_HEADER)
+    _check_length("Botón de lista", title_list, MAX_LIST_BUTTON)
+    for option in options_list:
+        _check_length("Opción", option["title"], MAX_ROW_TITLE)
+        _check_length("Descripción", option.get("description", ""), MAX_ROW_DESCRIPTION)
+    return PayloadTemplate(ListMessage(_TO_SLOT, header_text, _BODY_SLOT, options_list, title_list),
+                           body_limit=MAX_INTERACTIVE_BODY)
+
+
+def LocationTemplate():
+    return PayloadTemplate(LocationMessage(_TO_SLOT))
+
+
+def GetPayloadContent(data):
+    """Returns: (tipo, texto) de un mensaje saliente, para el log"""
+    if isinstance(data, Payload):
+        return data.message_type, data.content
+    content = data.get('text', {}).get('body', '') or str(data.get('interactive', ''))
+    return data.get('type', 'text'), content
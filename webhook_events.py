@@ -0,0 +1,74 @@
+def iter_events(body):
+    """
+    Recorre todo el payload del webhook y produce cada evento que contiene.
+
+    Meta puede agrupar varios entry, changes, messages y statuses en un solo
+    POST; aquí no se descarta ninguno.
+    Yields: ("message", message_dict) o ("status", status_dict)
+    """
+    for entry in body.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+            for message in value.get("messages") or []:
+                yield "message", message
+            for status in value.get("statuses") or []:
+                yield "status", status
+
+
+def group_by_sender(body, is_new=None):
+    """
+    Agrupa los mensajes del payload por remitente (en orden de llegada) y
+    junta los estados de entrega.
+
+    is_new: filtro opcional por message id (deduplicación)
+    Returns: ({number: [message, ...]}, [(wa_message_id, status, timestamp), ...], inválidos)
+    """
+    messages_by_sender = {}
+    statuses = []
+    invalid = 0
+
+    for kind, event in iter_events(body):
+        if kind == "message":
+            if "from" not in event or "type" not in event:
+                invalid += 1
+                continue
+            message_id = event.get("id")
+            if message_id and is_new is not None and not is_new(message_id):
+                continue
+            messages_by_sender.setdefault(event["from"], []).append(event)
+        else:
+            if "id" not in event or "status" not in event:
+                invalid += 1
+                continue
+            try:
+                timestamp = int(event.get("timestamp") or 0)
+            except (TypeError, ValueError):
+                # Un timestamp malformado invalida solo este estado, no el lote
+                invalid += 1
+                continue
+            statuses.append((event["id"], event["status"], timestamp))
+
+    return messages_by_sender, statuses, invalid
+
+
+def submit_by_sender(messages_by_sender, submit, forget):
+    """
+    Encola los mensajes de cada remitente con submit(number, messages).
+
+    Los IDs ya quedaron marcados como vistos en group_by_sender: si la cola
+    rechaza un lote (RuntimeError, proceso apagándose) se olvidan los de ese
+    remitente y los de todos los que faltaban, para que el reintento de Meta
+    no se descarte como duplicado.
+    Returns: True si se encolaron todos
+    """
+    senders = list(messages_by_sender.items())
+    for i, (number, messages) in enumerate(senders):
+        try:
+            submit(number, messages)
+        except RuntimeError:
+            for _, unsubmitted in senders[i:]:
+                for message in unsubmitted:
+                    if message.get("id"):
+                        forget(message["id"])
+            return False
+    return True
@@ -1,18 +1,175 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
+import random
+import threading
+import time
+import logging
+from collections import deque
+import metrics
+
+DEFAULT_API_URL = "https://graph.facebook.com/v21.0"
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class WhatsAppClient:
+    """
+    Cliente reutilizable para la Graph API de WhatsApp.
+
+    Mantiene una sesión keep-alive con su propio pool de conexiones (evita el
+    handshake TCP+TLS por mensaje), aplica timeouts, reintenta 429/5xx con
+    backoff respetando Retry-After y registra la latencia de cada llamada.
+
+    El POST no es idempotente: los errores de conexión (la request no llegó)
+    se reintentan, pero un timeout de lectura no, porque la API pudo haber
+    aceptado el mensaje y el cliente lo recibiría dos veces.
+    """
+
+    def __init__(self, token, phone_id, base_url=DEFAULT_API_URL, pool_size=4,
+                 connect_timeout=3.05, read_timeout=10.0, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0):
+        self.api_url = f"{base_url.rstrip('/')}/{phone_id}/messages"
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "content-type": "application/json",
+            "authorization": "Bearer " + token
+        })
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self._calls = 0
+        self._failures = 0
+        self._retries = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            token=os.getenv("WHATSAPP_TOKEN", ""),
+            phone_id=os.getenv("PHONE_NUMBER_ID"),
+            base_url=os.getenv("WHATSAPP_API_URL", DEFAULT_API_URL),
+            pool_size=int(os.getenv("WHATSAPP_POOL_SIZE", os.getenv("SEND_THREADS", 4))),
+            connect_timeout=float(os.getenv("WHATSAPP_CONNECT_TIMEOUT", 3.05)),
+            read_timeout=float(os.getenv("WHATSAPP_READ_TIMEOUT", 10)),
+            max_retries=int(os.getenv("WHATSAPP_MAX_RETRIES", 3))
+        )
+
+    def send(self, data):
+        """
+        Envía un mensaje. Returns: dict con la respuesta de la API
+        (incluye messages[0].id) o None si falló tras los reintentos.
+        """
+        body = data if isinstance(data, (bytes, str)) else json.dumps(data)
+
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                response = self.session.post(self.api_url, data=body, timeout=self.timeout)
+            except requests.ConnectionError as e:
+                # Incluye ConnectTimeout: no se pudo conectar, es seguro reintentar
+                self._record(time.monotonic() - started, ok=False)
+                logging.warning(f"Graph API sin conexión (intento {attempt + 1}): {e}")
+                retry_after = None
+            except requests.RequestException as e:
+                self._record(time.monotonic() - started, ok=False)
+                logging.error(f"Graph API sin respuesta tras enviar, no se reintenta para no duplicar: {e}")
+                return None
+            else:
+                ok = response.status_code == 200
+                self._record(time.monotonic() - started, ok=ok)
+                if ok:
+                    try:
+                        return response.json()
+                    except ValueError:
+                        return {}
+
+                if not self._is_retryable(response):
+                    logging.error(f"Graph API rechazó el mensaje ({response.status_code}): {response.text[:300]}")
+                    return None
+
+                retry_after = self._retry_after(response)
+                logging.warning(f"Graph API {response.status_code} (intento {attempt + 1}), reintentando")
+
+            if attempt < self.max_retries:
+                with self._lock:
+                    self._retries += 1
+                time.sleep(self._backoff(attempt, retry_after))
+
+        return None
+
+    @staticmethod
+    def _is_retryable(response):
+        if response.status_code in RETRY_STATUS:
+            return True
+        # La Graph API marca algunos errores 4xx como transitorios
+        try:
+            return bool(response.json().get("error", {}).get("is_transient"))
+        except ValueError:
+            return False
+
+    @staticmethod
+    def _retry_after(response):
+        value = response.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        delay = self.backoff_base * (2 ** attempt)
+        return min(delay, self.backoff_max) * random.uniform(0.5, 1.0)
+
+    def _record(self, latency, ok):
+        with self._lock:
+            self._calls += 1
+            if not ok:
+                self._failures += 1
+            self._latencies.append(latency)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {"calls": self._calls, "failures": self._failures, "retries": self._retries}
+        if latencies:
+            stats["latency_p50"] = round(latencies[len(latencies) // 2], 4)
+            stats["latency_p95"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 4)
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Cliente compartido del proceso (se crea en el primer envío)"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = WhatsAppClient.from_env()
+    return _client
 
 def SendMessageWhatsapp(data):
+    """Returns: respuesta de la API (con messages[0].id) o None si falló"""
+    started = time.perf_counter()
     try:
-        token = os.getenv("WHATSAPP_TOKEN")
-        phone_id = os.getenv("PHONE_NUMBER_ID")
-        api_url = f"https://graph.facebook.com/v21.0/{phone_id}/messages"
-        headers = {"content-type": "application/json", "authorization": "Bearer " + token}
-        response = requests.post(api_url, data=json.dumps(data), headers=headers)
-        
-        if response.status_code == 200:
-            return True
-        return False
+        result = get_client().send(data)
     except Exception as exception:
         print(exception)
-        return False
+        result = None
+    metrics.whatsapp_seconds.observe(time.perf_counter() - started, "ok" if result is not None else "error")
+    return result